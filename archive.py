@@ -0,0 +1,214 @@
+import os
+import time
+import fcntl
+import errno
+import shutil
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+### Background archiving of raw movies to the output directory.
+###
+### Copies are queued in the session ledger ('archive' table), so a restarted
+### watcher resumes whatever was queued or half-copied. A small thread pool does
+### the copies away from the scan loop:
+###   - same filesystem: reflink (FICLONE) first, shares the extents, no data moved
+###   - otherwise copy_file_range, so the kernel (or an NFS server-side copy) moves
+###     the data, falling back to streaming in large blocks where it is not supported
+###   - with verify (the default, --archive_no_verify turns it off) the source and
+###     the destination are hashed and compared; a streamed copy hashes the source
+###     as it is read
+### A shared token bucket caps the total bandwidth, so archiving does not starve
+### MotionCor2 reading the same movies. Each copy goes to '<dst>.part' and is
+### renamed into place only after it has been verified.
+
+FICLONE = 0x40049409    # _IOW(0x94, 9, int)
+
+BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class TokenBucket:
+    """ Shared bandwidth limit in bytes per second. rate=None means unlimited."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else (rate or 0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.rate:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                # A block larger than the burst is let through once the bucket is full
+                if self.tokens >= min(amount, self.capacity):
+                    self.tokens -= amount
+                    return
+                wait = (min(amount, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _reflink(src_fd, dst_fd):
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EBADF, errno.ENOSYS):
+            return False
+        raise
+
+
+def _hash_file(path, bucket=None):
+    digest = hashlib.blake2b()
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            block = f.read(BLOCK_SIZE)
+            if not block:
+                break
+            if bucket is not None:
+                bucket.consume(len(block))
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_file(src, dst, bucket=None, verify=True):
+    """ Copy src to dst via '<dst>.part'. Returns (method, checksum); checksum is None when not computed."""
+    src, dst = Path(src), Path(dst)
+    part = dst.with_name(dst.name + ".part")
+    size = os.stat(src).st_size
+    method, checksum = None, None
+    with open(src, 'rb', buffering=0) as fsrc, open(part, 'wb', buffering=0) as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        if _reflink(src_fd, dst_fd):
+            method = "reflink"
+        elif hasattr(os, "copy_file_range"):
+            method = "copy_file_range"
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(src_fd, dst_fd, min(BLOCK_SIZE, size - copied))
+                    if n == 0:
+                        break
+                    copied += n
+                    if bucket is not None:
+                        bucket.consume(n)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                # Not supported between these filesystems: start over with a plain stream
+                os.lseek(src_fd, 0, os.SEEK_SET)
+                os.ftruncate(dst_fd, 0)
+                os.lseek(dst_fd, 0, os.SEEK_SET)
+                method = None
+        if method is None:
+            method = "stream"
+            digest = hashlib.blake2b()
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(src_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                block = fsrc.read(BLOCK_SIZE)
+                if not block:
+                    break
+                if bucket is not None:
+                    bucket.consume(len(block))
+                digest.update(block)
+                view = memoryview(block)
+                while view:
+                    view = view[os.write(dst_fd, view):]
+            checksum = digest.hexdigest()
+        os.fsync(dst_fd)
+    shutil.copystat(src, part)
+
+    written_size = os.stat(part).st_size
+    if written_size != size:
+        os.unlink(part)
+        raise IOError(f"size mismatch archiving {src}: {written_size} != {size}")
+    if verify:
+        # Kernel copies (reflink, copy_file_range) never saw the data: hash the source now
+        if checksum is None:
+            checksum = _hash_file(src, bucket)
+        written = _hash_file(part, bucket)
+        if written != checksum:
+            os.unlink(part)
+            raise IOError(f"checksum mismatch archiving {src}")
+    os.replace(part, dst)
+    return method, checksum
+
+
+class Archiver:
+    """ Copies queued in the ledger, done by a bounded thread pool.
+
+    enqueue(paths) queues the movies (persisted first, then scheduled);
+    resume() reschedules what an earlier run left queued or unfinished.
+    """
+
+    def __init__(self, ledger, output_dir, permissions=None, workers=2, bandwidth=None, verify=True, retries=3):
+        self.ledger = ledger
+        self.output_dir = Path(output_dir)
+        self.permissions = permissions      # PermissionEngine applied to every finished copy
+        self.verify = verify
+        self.retries = retries
+        self.bucket = TokenBucket(bandwidth)
+        self.copied_bytes = 0
+        self.copy_seconds = 0.0
+        self._lock = threading.Lock()
+        self._scheduled = set()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="archive")
+
+    def destination(self, src):
+        return self.output_dir / Path(src).name
+
+    def enqueue(self, paths):
+        pairs = [(Path(src), self.destination(src)) for src in paths]
+        self.ledger.queue_archive(pairs)
+        for src, dst in pairs:
+            self._schedule(src, dst)
+
+    def resume(self):
+        rows = self.ledger.archive_pending()
+        for row in rows:
+            self._schedule(Path(row["src"]), Path(row["dst"]))
+        return len(rows)
+
+    def _schedule(self, src, dst):
+        with self._lock:
+            if src in self._scheduled:
+                return
+            self._scheduled.add(src)
+        self._pool.submit(self._copy, src, dst)
+
+    def _copy(self, src, dst):
+        for attempt in range(1, self.retries + 1):
+            self.ledger.mark_archive(src, "copying", attempts=attempt)
+            started = time.monotonic()
+            try:
+                method, checksum = copy_file(src, dst, self.bucket, self.verify)
+                if self.permissions is not None:
+                    self.permissions.apply(dst)
+            except OSError as e:
+                print(f"Archiving {src.name} failed (attempt {attempt}/{self.retries}): {e}")
+                self.ledger.mark_archive(src, "queued", error=str(e))
+                time.sleep(2 ** attempt)
+                continue
+            size = os.stat(dst).st_size
+            with self._lock:
+                self.copied_bytes += size
+                self.copy_seconds += time.monotonic() - started
+            self.ledger.mark_archive(src, "done", size=size, method=method, checksum=checksum,
+                                     error=None, finished_at=time.time())
+            return
+        self.ledger.mark_archive(src, "failed")
+
+    def stats(self):
+        with self._lock:
+            rate = self.copied_bytes / self.copy_seconds / 1e6 if self.copy_seconds else 0.0
+            return f"archive: {self.ledger.archive_counts()} {self.copied_bytes / 1e9:.1f} GB at {rate:.0f} MB/s per copy"
+
+    def close(self, wait=True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,65 @@
+import math
+
+### Batching policy for run_slurm2.py: how many ready movies go into one job and
+### how long a partial chunk may wait before it is flushed.
+###
+###   latency     one movie per GPU per job, partial chunks flushed after a few
+###               seconds, so the newest movie is never held back for a batch.
+###   throughput  during a backlog, several movies per GPU per job so that the
+###               job start overhead stays a small fraction of the job runtime;
+###               partial chunks wait longer for company.
+
+BATCH_MODES = ("latency", "throughput")
+
+DEFAULT_TARGET_LATENCY = {"latency": 10.0, "throughput": 120.0}
+
+
+class BatchPolicy:
+    def __init__(self, mode="latency", num_gpus=4, target_latency=None, job_overhead=30.0,
+                 overhead_fraction=0.1, max_chunk=64, movie_runtime=60.0):
+        if mode not in BATCH_MODES:
+            raise ValueError(f"unknown batch mode {mode!r}, expected one of {BATCH_MODES}")
+        self.mode = mode
+        self.num_gpus = max(1, num_gpus)
+        self.target_latency = DEFAULT_TARGET_LATENCY[mode] if target_latency is None else target_latency
+        self.job_overhead = job_overhead            # seconds from sbatch to the first MotionCor2
+        self.overhead_fraction = overhead_fraction  # acceptable overhead / job runtime in throughput mode
+        self.max_chunk = max_chunk
+        self.movie_runtime = movie_runtime          # smoothed seconds per movie, updated by observe_runtime
+        self._observed = 0
+
+    def observe_runtime(self, seconds, weight=0.2):
+        """ Fold one observed per-movie runtime into the running estimate."""
+        if seconds <= 0:
+            return
+        if self._observed == 0:
+            self.movie_runtime = seconds
+        else:
+            self.movie_runtime += weight * (seconds - self.movie_runtime)
+        self._observed += 1
+
+    def movies_per_gpu(self):
+        """ Movies each GPU should get per job so start overhead stays below overhead_fraction."""
+        if self.mode == "latency":
+            return 1
+        return max(1, math.ceil(self.job_overhead / (self.overhead_fraction * self.movie_runtime)))
+
+    def chunk_size(self, backlog):
+        """ Number of movies for the next job given 'backlog' ready movies."""
+        full = min(self.max_chunk, self.num_gpus * self.movies_per_gpu())
+        if self.mode == "throughput" and backlog > full:
+            # Deep backlog: fill every GPU evenly, several movies each
+            per_gpu = min(backlog // self.num_gpus, self.max_chunk // self.num_gpus)
+            return max(full, per_gpu * self.num_gpus)
+        return max(1, full)
+
+    def flush_in(self, oldest_wait):
+        """ Seconds until a partial chunk whose oldest movie has waited 'oldest_wait' must go out."""
+        return max(0.0, self.target_latency - oldest_wait)
+
+    def should_flush(self, oldest_wait):
+        return self.flush_in(oldest_wait) <= 0
+
+    def __str__(self):
+        return (f"{self.mode} mode, {self.num_gpus} GPU slot(s), target latency {self.target_latency:.0f}s, "
+                f"~{self.movie_runtime:.0f}s per movie")
@@ -0,0 +1,173 @@
+import time
+from pathlib import Path
+
+### Runtime cost model: predicted seconds of the GPU stage (MotionCor2) and the CPU
+### stage (ctffind5 + stigma) of a movie, from its frame count and file size.
+###
+### Workers report when a movie started, was aligned and finished (ledger
+### started_at / aligned_at / finished_at). Movies are grouped by what changes the
+### cost per frame — scope, file format, binning and patch count — and each group
+### keeps a least-squares fit, forgetting old movies slowly,
+###
+###   seconds = a + b * frames + c * GB
+###
+### Until a group has enough movies it is predicted from its seconds per frame,
+### then from the seconds per frame of all groups, then from the defaults.
+
+STAGES = ("gpu", "cpu")
+
+
+def _solve3(a, b):
+    # Gaussian elimination with partial pivoting; None if singular
+    m = [row[:] + [value] for row, value in zip(a, b)]
+    for col in range(3):
+        pivot = max(range(col, 3), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, 3):
+            factor = m[r][col] / m[col][col]
+            for c in range(col, 4):
+                m[r][c] -= factor * m[col][c]
+    x = [0.0] * 3
+    for r in (2, 1, 0):
+        x[r] = (m[r][3] - sum(m[r][c] * x[c] for c in range(r + 1, 3))) / m[r][r]
+    return x
+
+
+class _Fit:
+    """ Exponentially forgetting least squares of seconds on (1, frames, GB)."""
+
+    def __init__(self, forget, min_samples, ridge=1e-3):
+        self.forget = forget
+        self.min_samples = min_samples
+        self.ridge = ridge
+        self.xtx = [[0.0] * 3 for _ in range(3)]
+        self.xty = [0.0] * 3
+        self.n = 0
+        self.seconds = 0.0      # forgetting totals for the per-frame fallback
+        self.frames = 0.0
+        self._coef = None
+
+    def add(self, x, y):
+        for i in range(3):
+            self.xty[i] = self.forget * self.xty[i] + x[i] * y
+            for j in range(3):
+                self.xtx[i][j] = self.forget * self.xtx[i][j] + x[i] * x[j]
+        self.seconds = self.forget * self.seconds + y
+        self.frames = self.forget * self.frames + x[1]
+        self.n += 1
+        self._coef = None
+
+    def per_frame(self):
+        return self.seconds / self.frames if self.frames > 0 else None
+
+    def predict(self, x):
+        if self.n < self.min_samples:
+            return None
+        if self._coef is None:
+            # Ridge relative to each diagonal term, so frames and size being proportional stays solvable
+            a = [[self.xtx[i][j] * (1 + self.ridge if i == j else 1) for j in range(3)] for i in range(3)]
+            self._coef = _solve3(a, self.xty) or False
+        if not self._coef:
+            return None
+        seconds = sum(c * v for c, v in zip(self._coef, x))
+        # Outside the range seen so far a linear fit can go negative
+        return seconds if seconds > 0 else None
+
+
+class CostModel:
+    def __init__(self, default_gpu=60.0, default_cpu=20.0, forget=0.99, min_samples=8):
+        self.defaults = {"gpu": default_gpu, "cpu": default_cpu}
+        self.forget = forget
+        self.min_samples = min_samples
+        self.fits = {}          # (stage, group) -> _Fit
+        self.overall = {stage: _Fit(forget, min_samples) for stage in STAGES}
+
+    def _fit(self, stage, group):
+        key = (stage, group)
+        if key not in self.fits:
+            self.fits[key] = _Fit(self.forget, self.min_samples)
+        return self.fits[key]
+
+    def observe(self, group, frames, size, gpu_seconds, cpu_seconds):
+        """ Fold in one finished movie; a stage time that is None or negative is skipped."""
+        if not frames:
+            return
+        x = (1.0, float(frames), (size or 0) / 1e9)
+        for stage, seconds in (("gpu", gpu_seconds), ("cpu", cpu_seconds)):
+            if seconds is not None and seconds >= 0:
+                self._fit(stage, group).add(x, seconds)
+                self.overall[stage].add(x, seconds)
+
+    def observe_row(self, group, row):
+        """ Fold in a finished ledger row that has its stage times."""
+        if row["started_at"] is None or row["aligned_at"] is None or row["finished_at"] is None:
+            return
+        self.observe(group, row["frame_num"], row["size"], row["aligned_at"] - row["started_at"],
+                     row["finished_at"] - row["aligned_at"])
+
+    def predict(self, group, frames, size, stage="gpu"):
+        """ Predicted seconds of one stage; frames may be None when the header was not read yet."""
+        fit = self.fits.get((stage, group))
+        if frames:
+            x = (1.0, float(frames), (size or 0) / 1e9)
+            for candidate in (fit, self.overall[stage]):
+                if candidate is None:
+                    continue
+                seconds = candidate.predict(x)
+                if seconds is None and candidate.per_frame() is not None:
+                    seconds = candidate.per_frame() * frames
+                if seconds is not None:
+                    return seconds
+        for candidate in (fit, self.overall[stage]):
+            if candidate is not None and candidate.n:
+                return candidate.seconds * (1 - candidate.forget) / (1 - candidate.forget ** candidate.n)
+        return self.defaults[stage]
+
+    def __str__(self):
+        groups = {group for _stage, group in self.fits}
+        return f"{len(groups)} group(s), {self.overall['gpu'].n} movie(s) observed"
+
+
+def similar_cost(backlog, places, cost, window=4):
+    """ 'places' movies from the backlog (oldest first) with similar predicted costs, longest first.
+
+    The oldest movie always goes, so nothing starves; the others are the movies
+    closest to it in cost among the next window * places, ties broken by age.
+    """
+    if places <= 0 or not backlog:
+        return []
+    candidates = backlog[:window * places]
+    target = cost(candidates[0])
+    ranked = sorted(range(1, len(candidates)), key=lambda i: (abs(cost(candidates[i]) - target), i))
+    chosen = [candidates[0]] + [candidates[i] for i in ranked[:places - 1]]
+    return sorted(chosen, key=cost, reverse=True)
+
+
+def backlog_eta(gpu_seconds, cpu_tail, num_gpus, now=None):
+    """ Epoch time at which 'gpu_seconds' of MotionCor2 over num_gpus GPUs, plus the last CPU stage, is done."""
+    now = time.time() if now is None else now
+    return now + gpu_seconds / max(1, num_gpus) + cpu_tail
+
+
+def slot_report(rows):
+    """ MotionCor2 throughput per GPU by slots per GPU and movie size, as printable lines, from done ledger rows.
+
+    With k slots busy a GPU finishes k movies per MotionCor2 run time, so the
+    rate is 3600 * k / (mean run time) movies per hour.
+    """
+    groups = {}
+    for row in rows:
+        if row["started_at"] is None or row["aligned_at"] is None:
+            continue
+        size_bucket = max(0.5, round((row["size"] or 0) / 1e9 * 2) / 2)
+        entry = groups.setdefault((Path(row["name"]).suffix.lower(), size_bucket, row["gpu_slots"] or 1), [0, 0.0])
+        entry[0] += 1
+        entry[1] += row["aligned_at"] - row["started_at"]
+    lines = []
+    for (suffix, size_bucket, slots), (movies, seconds) in sorted(groups.items()):
+        mean = max(seconds / movies, 1e-3)
+        lines.append(f"MotionCor2 {suffix} ~{size_bucket:g} GB, {slots} slot(s) per GPU: {movies} movie(s), "
+                     f"{mean:.0f}s each, ~{3600 * slots / mean:.0f} movies/h per GPU")
+    return lines
@@ -0,0 +1,114 @@
+import os
+import sys
+import math
+from typing import NamedTuple
+
+### ctffind5 result files without pandas.
+###
+### A ctffind5 .txt is a few '#' header lines followed by one whitespace-separated
+### line per micrograph; the workers only need the last one. read_ctffind5_txt()
+### seeks to the end of the file and reads backwards until it has a complete data
+### line. load_ctffind5_results() reads a whole session into one NumPy structured
+### array (NumPy is only imported there).
+
+
+class CtfResult(NamedTuple):
+    """ One ctffind5 data line. Columns missing from older ctffind versions are NaN."""
+    micrograph: float
+    defocus_1: float
+    defocus_2: float
+    astig_azimuth: float
+    phase_shift: float
+    cross_correlation: float
+    ctf_fit_resolution: float
+    tilt_axis_angle: float
+    tilt_angle: float
+    sample_thickness: float
+
+    @property
+    def avg_defocus(self):
+        return (self.defocus_1 + self.defocus_2) / 2
+
+    @property
+    def delta_defocus(self):
+        return self.defocus_1 - self.defocus_2
+
+
+CTFFIND5_DTYPE = [("name", "U128")] + [(field, "f8") for field in CtfResult._fields]
+
+
+def read_last_data_line(txt_file, block_size=4096):
+    """ Last non-empty line not starting with '#', read backwards from the end of the file."""
+    with open(txt_file, 'rb') as f:
+        position = f.seek(0, os.SEEK_END)
+        tail = b""
+        while True:
+            lines = tail.splitlines()
+            # The first line of 'tail' may be cut in the middle unless we reached the file start
+            complete = lines if position == 0 else lines[1:]
+            for line in reversed(complete):
+                line = line.strip()
+                if line and not line.startswith(b"#"):
+                    return line.decode()
+            if position == 0:
+                raise ValueError(f"no ctffind5 data line in {txt_file}")
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+
+
+def parse_ctffind5_line(line):
+    values = [float(value) for value in line.split()]
+    if len(values) < 7:
+        raise ValueError(f"unexpected ctffind5 line {line!r}")
+    values = values[:len(CtfResult._fields)]
+    values += [math.nan] * (len(CtfResult._fields) - len(values))
+    return CtfResult(*values)
+
+
+def read_ctffind5_txt(txt_file):
+    return parse_ctffind5_line(read_last_data_line(txt_file))
+
+
+def load_ctffind5_results(txt_files, skip_errors=True):
+    """ Structured array (fields of CTFFIND5_DTYPE) with one row per ctffind5 .txt, in input order."""
+    import numpy as np
+    rows = []
+    for txt_file in txt_files:
+        try:
+            result = read_ctffind5_txt(txt_file)
+        except (OSError, ValueError) as e:
+            if not skip_errors:
+                raise
+            print(f"Skipping {txt_file}: {e}")
+            continue
+        rows.append((os.path.basename(str(txt_file))[:-4], *result))
+    return np.array(rows, dtype=CTFFIND5_DTYPE)
+
+
+def main(argv):
+    """ Session summary: python ctffind_results.py <ctffind5_dir or .txt files>"""
+    import numpy as np
+    txt_files = []
+    for arg in argv:
+        if os.path.isdir(arg):
+            with os.scandir(arg) as it:
+                # ctffind5 also writes <name>_avrot.txt next to <name>.txt
+                txt_files.extend(sorted(entry.path for entry in it
+                                        if entry.name.endswith(".txt") and not entry.name.endswith("_avrot.txt")))
+        else:
+            txt_files.append(arg)
+    results = load_ctffind5_results(txt_files)
+    print(f"{len(results)} micrograph(s)")
+    if len(results):
+        avg_defocus = (results["defocus_1"] + results["defocus_2"]) / 2
+        for label, values in (("Defocus [A]", avg_defocus),
+                              ("Astigmatism [A]", results["defocus_1"] - results["defocus_2"]),
+                              ("CTF fit [A]", results["ctf_fit_resolution"])):
+            print(f"{label:16s} median {np.nanmedian(values):10.1f}  min {np.nanmin(values):10.1f}  max {np.nanmax(values):10.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,233 @@
+import os
+import time
+import subprocess
+from pathlib import Path
+
+from spool import init_spool, push_task, request_stop, requeue_stale, pending_count, task_states, LEASE_INTERVAL
+from slurm_backend import SQUEUE_CMD, SACCT_CMD, GPUS_PER_NODE, job_states, queue_depth, resource_args
+
+### Execution backends for run_slurm2.py (--executor).
+###
+###   slurm  one job-array task per chunk, submitted in the background (ArraySubmitter)
+###   spool  persistent SLURM worker jobs pulling single movies from a spool directory
+###   local  persistent worker processes on this machine, one per GPU
+###          (CUDA_VISIBLE_DEVICES), pulling from a local spool; no SLURM at all
+###
+### Whatever the backend, workers report running/done/failed through the session
+### ledger journal, and submit() reports where each movie went through
+### callback(movies, job_id), with job_id None when submission failed.
+### 'avoid' lists the "host:gpu" places a retried movie already failed on, 'lane'
+### is the movie's submission lane (lanes.py): live or backfill.
+### job_states() maps job ids of this backend to SLURM-style states (see
+### slurm_backend.LIVE_STATES), so a restarted watcher can adopt live jobs.
+### queue_depth() is the number of jobs waiting to start, which the watcher keeps
+### bounded (throttle.py) so surplus movies stay in its own ready queue.
+
+EXECUTORS = ("slurm", "spool", "local")
+
+
+class Executor:
+    name = None
+
+    def start(self):
+        pass
+
+    def submit(self, movies, frame_nums, callback=None, avoid=(), lane=None):
+        raise NotImplementedError
+
+    def poll(self):
+        """ Housekeeping, called once per scan loop."""
+
+    def job_states(self, job_ids):
+        """ {job id: state} for the ids that belong to this backend; other ids are left out."""
+        return {}
+
+    def pending(self):
+        return 0
+
+    def queue_depth(self):
+        """ Jobs or tasks waiting to start, including those not handed over yet."""
+        return self.pending()
+
+    def close(self):
+        pass
+
+
+class SlurmArrayExecutor(Executor):
+    """ task_args(movies, frame_nums, avoid) -> worker command line of one array task.
+
+    'packing' (slurm_backend.PACKINGS) decides the array tasks of a chunk and the
+    GPUs they ask for; with gpu packing a chunk becomes one single-GPU task for
+    each of up to 'gpus' GPUs, its movies dealt out in order so every task starts
+    with one of the most urgent ones. Shared-node tasks get cpus_per_gpu CPUs
+    (and ctffind5/stigma jobs) per GPU, and --num_gpus so they stay on their own GPUs.
+    With exclude_nodes, retries are kept off the nodes they failed on (sbatch --exclude);
+    backfill arrays get sbatch --nice=backfill_nice so live arrays start first.
+    The queue depth counts all pending jobs on 'partition'; it is refreshed from
+    squeue at most every depth_interval seconds, and our own tasks submitted since
+    are added until the next refresh.
+    """
+    name = "slurm"
+
+    def __init__(self, submitter, task_args, exclude_nodes=False, squeue_cmd=SQUEUE_CMD, sacct_cmd=SACCT_CMD,
+                 backfill_nice=0, partition="pp", depth_interval=15.0, packing="node", gpus=GPUS_PER_NODE, cpus_per_gpu=2):
+        self.submitter = submitter
+        self.task_args = task_args
+        self.exclude_nodes = exclude_nodes
+        self.squeue_cmd = squeue_cmd
+        self.sacct_cmd = sacct_cmd
+        self.backfill_nice = backfill_nice
+        self.partition = partition
+        self.packing = packing
+        self.gpus = max(1, gpus)
+        self.cpus_per_gpu = cpus_per_gpu
+        self.depth_interval = depth_interval
+        self._depth = 0
+        self._depth_tasks = 0       # submitter.submitted_tasks at the last refresh
+        self._next_depth = 0.0
+
+    def tasks(self, movies, frame_nums):
+        """ [(movies, frame_nums, GPUs)] of the array tasks for one chunk."""
+        if self.packing == "node":
+            return [(movies, frame_nums, GPUS_PER_NODE)]
+        if self.packing == "chunk":
+            return [(movies, frame_nums, min(len(movies), GPUS_PER_NODE))]
+        count = min(len(movies), self.gpus)
+        return [(movies[i::count], frame_nums[i::count], 1) for i in range(count)]
+
+    def submit(self, movies, frame_nums, callback=None, avoid=(), lane=None):
+        common = []
+        hosts = sorted({entry.rpartition(":")[0] for entry in avoid})
+        if self.exclude_nodes and hosts:
+            common.append(f"--exclude={','.join(hosts)}")
+        if lane == "backfill" and self.backfill_nice:
+            common.append(f"--nice={self.backfill_nice}")
+        for task_movies, task_frame_nums, gpus in self.tasks(list(movies), list(frame_nums)):
+            task_args = self.task_args(task_movies, task_frame_nums, avoid)
+            sbatch_args = list(common)
+            if self.packing != "node":
+                # Arrays are grouped by sbatch arguments, so each array asks for one task size
+                sbatch_args += resource_args(gpus, self.cpus_per_gpu)
+                # The worker cannot tell its GPUs from the node's; sudo keeps CUDA_VISIBLE_DEVICES (create_slurm_script)
+                task_args = [*task_args, "--num_gpus", str(gpus), "--cpu_workers", str(gpus * self.cpus_per_gpu)]
+            self.submitter.submit(task_args, None if callback is None else
+                                  lambda job_id, task_movies=task_movies: callback(task_movies, job_id), sbatch_args)
+
+    def job_states(self, job_ids):
+        # Spool/local ids look like "<executor>:<task file>"
+        return job_states([job_id for job_id in job_ids if ":" not in job_id], self.squeue_cmd, self.sacct_cmd)
+
+    def poll(self):
+        if time.monotonic() < self._next_depth:
+            return
+        self._next_depth = time.monotonic() + self.depth_interval
+        submitted_tasks = self.submitter.submitted_tasks
+        try:
+            self._depth = queue_depth(self.partition, self.squeue_cmd)
+            self._depth_tasks = submitted_tasks
+        except (subprocess.CalledProcessError, OSError) as e:
+            # Keep the last known depth rather than flooding or stalling the queue
+            print(f"squeue failed, queue depth stays at {self._depth}: {e}")
+
+    def pending(self):
+        return self.submitter.pending()
+
+    def queue_depth(self):
+        return self._depth + self.submitter.submitted_tasks - self._depth_tasks + self.submitter.pending()
+
+    def close(self):
+        self.submitter.close()
+
+
+class SpoolExecutor(Executor):
+    """ make_task(movie, frame_num) -> spool task; start_workers() launches the worker jobs.
+
+    poll() requeues the tasks of workers that died, on any node (spool.requeue_stale).
+    """
+    name = "spool"
+
+    def __init__(self, spool_dir, make_task, start_workers=None):
+        self.spool_dir = Path(spool_dir)
+        self.make_task = make_task
+        self.start_workers = start_workers
+        self._next_requeue = 0.0
+
+    def start(self):
+        init_spool(self.spool_dir)
+        if self.start_workers is not None:
+            self.start_workers()
+
+    def submit(self, movies, frame_nums, callback=None, avoid=(), lane=None):
+        for movie, frame_num in zip(movies, frame_nums):
+            task = self.make_task(movie, frame_num)
+            if avoid:
+                task["avoid"] = list(avoid)
+            if lane is not None:
+                task["lane"] = lane
+            task_path = push_task(self.spool_dir, task)
+            if callback is not None:
+                callback([movie], f"{self.name}:{task_path.name}")
+
+    def poll(self):
+        # Tasks of workers whose node died (lease expired) go back to the queue
+        if time.monotonic() < self._next_requeue:
+            return
+        self._next_requeue = time.monotonic() + LEASE_INTERVAL
+        requeued = requeue_stale(self.spool_dir)
+        if requeued:
+            print(f"Requeued {requeued} task(s) of workers that stopped renewing their lease")
+
+    def job_states(self, job_ids):
+        prefix = f"{self.name}:"
+        names = {job_id[len(prefix):]: job_id for job_id in job_ids if job_id.startswith(prefix)}
+        return {names[name]: state for name, state in task_states(self.spool_dir, list(names)).items()}
+
+    def pending(self):
+        return pending_count(self.spool_dir)
+
+    def close(self):
+        request_stop(self.spool_dir)
+
+
+class LocalExecutor(SpoolExecutor):
+    """ One persistent worker process per local GPU. worker_cmd is the worker's '--serve' command line."""
+    name = "local"
+
+    def __init__(self, spool_dir, make_task, worker_cmd, gpu_ids, log_dir, restart_delay=10):
+        super().__init__(spool_dir, make_task)
+        self.worker_cmd = list(worker_cmd)
+        self.gpu_ids = list(gpu_ids)
+        self.log_dir = Path(log_dir)
+        self.restart_delay = restart_delay
+        self.processes = {}         # gpu id -> (Popen, start time)
+
+    def _launch(self, gpu_id):
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(gpu_id))
+        log = open(self.log_dir / f"local_worker_gpu{gpu_id}.log", 'a')
+        process = subprocess.Popen(self.worker_cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+        self.processes[gpu_id] = (process, time.monotonic())
+
+    def start(self):
+        super().start()
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        for gpu_id in self.gpu_ids:
+            self._launch(gpu_id)
+        print(f"Started {len(self.gpu_ids)} local worker(s) on GPU(s) {','.join(map(str, self.gpu_ids))}")
+
+    def poll(self):
+        super().poll()
+        # A worker that died leaves its claimed movies behind: put them back and restart it
+        for gpu_id, (process, started) in list(self.processes.items()):
+            if process.poll() is None or time.monotonic() - started < self.restart_delay:
+                continue
+            requeued = requeue_stale(self.spool_dir)
+            print(f"Local worker on GPU {gpu_id} exited with {process.returncode}, restarting "
+                  f"({requeued} task(s) requeued)")
+            self._launch(gpu_id)
+
+    def close(self, wait=True):
+        super().close()
+        if wait:
+            for process, _started in self.processes.values():
+                process.wait()
@@ -0,0 +1,232 @@
+import os
+import sys
+import struct
+import hashlib
+import tempfile
+import subprocess
+from pathlib import Path
+
+import numpy as np
+
+from tiff_header import read_image_layout, TiffHeaderError
+from archive import copy_file
+
+### Gain reference conversion without IMOD / EMAN2.
+###
+###   .dm4   (Gatan K2/K3)    -> float32 MRC                      (was: dm2mrc)
+###   .gain  (Falcon EER, TIFF) -> float32 MRC of the reciprocal  (was: tif2mrc + e2proc2d math.reciprocal)
+###
+### Both are flipped in Y like the IMOD tools, so the MRC matches what
+### MotionCor2 was given before. Results are kept in a facility-wide cache keyed
+### by a content hash of the source gain, so a gain reused across sessions is
+### converted once and then only copied (reflinked where possible).
+
+GAIN_CACHE_DIR = os.environ.get("PP_GAIN_CACHE", "/home/pp/gain_cache")
+
+# Bump when the conversion output changes, so old cache entries are not reused
+CONVERTER_VERSION = 1
+
+_MRC_HEADER_SIZE = 1024
+
+
+class GainFormatError(ValueError):
+    pass
+
+
+### DM4 reader: just enough of the tag tree to find the image arrays
+
+# DM tag encoded type -> numpy type code
+_DM_TYPES = {2: "i2", 3: "i4", 4: "u2", 5: "u4", 6: "f4", 7: "f8", 8: "u1", 9: "i1", 10: "u1", 11: "i8", 12: "u8"}
+_STRUCT_CODES = {"i1": "b", "u1": "B", "i2": "h", "u2": "H", "i4": "i", "u4": "I", "i8": "q", "u8": "Q",
+                 "f4": "f", "f8": "d"}
+_DM_ARRAY = 20
+_DM_GROUP, _DM_DATA = 20, 21
+
+
+class _Dm4Reader:
+    def __init__(self, f):
+        self.f = f
+        version, _root_size, little = struct.unpack(">iQi", f.read(16))
+        if version != 4:
+            raise GainFormatError(f"DM version {version} is not supported, only DM4")
+        self.bo = "<" if little == 1 else ">"
+        self.images = []        # one dict per ImageData group: dims, dtype, offset, count
+
+    def _read(self, fmt):
+        return struct.unpack(fmt, self.f.read(struct.calcsize(fmt)))
+
+    def read_group(self, path, image=None):
+        _sorted, _open, ntags = self._read(">BBQ")
+        if path and path[-1] == "ImageData":
+            image = {"dims": []}
+            self.images.append(image)
+        for _ in range(ntags):
+            kind, label_len = self._read(">BH")
+            label = self.f.read(label_len).decode("latin-1")
+            (size,) = self._read(">Q")
+            end = self.f.tell() + size
+            if kind == _DM_GROUP:
+                self.read_group(path + [label], image)
+            elif kind == _DM_DATA:
+                self._read_data(path + [label], image)
+            else:
+                raise GainFormatError(f"unknown DM4 tag kind {kind}")
+            self.f.seek(end)
+
+    def _read_data(self, path, image):
+        if self.f.read(4) != b"%%%%":
+            raise GainFormatError("corrupt DM4 data tag")
+        (ninfo,) = self._read(">Q")
+        info = self._read(f">{ninfo}Q")
+        if image is None:
+            return
+        parent = path[-2]
+        if path[-1] == "Data" and parent == "ImageData" and info[0] == _DM_ARRAY and info[1] in _DM_TYPES:
+            image.update(dtype=self.bo + _DM_TYPES[info[1]], count=info[2], offset=self.f.tell())
+        elif parent == "Dimensions" and path[-3] == "ImageData" and info[0] in _DM_TYPES:
+            (value,) = self._read(self.bo + _STRUCT_CODES[_DM_TYPES[info[0]]])
+            image["dims"].append(value)
+
+
+def read_dm4(path):
+    """ Largest 2D image of a DM4 file as a read-only (ny, nx) memory map."""
+    with open(path, 'rb') as f:
+        reader = _Dm4Reader(f)
+        reader.read_group([])
+    images = [image for image in reader.images if "offset" in image and len(image["dims"]) == 2]
+    if not images:
+        raise GainFormatError(f"no 2D image in {path}")
+    # The first image of a DM file is usually the thumbnail
+    image = max(images, key=lambda image: image["count"])
+    nx, ny = image["dims"]
+    if nx * ny != image["count"]:
+        raise GainFormatError(f"image size {nx}x{ny} does not match {image['count']} values in {path}")
+    return np.memmap(path, dtype=np.dtype(image["dtype"]), mode='r', offset=image["offset"], shape=(ny, nx))
+
+
+def read_tiff_gain(path):
+    """ Uncompressed single-image TIFF (Falcon .gain) as a (ny, nx) array."""
+    layout = read_image_layout(path)
+    if layout["compression"] != 1 or layout["samples"] != 1:
+        raise GainFormatError(f"{path}: only uncompressed single-channel TIFF gains are supported")
+    kind = {1: "u", 2: "i", 3: "f"}.get(layout["sample_format"])
+    if kind is None:
+        raise GainFormatError(f"{path}: unsupported TIFF sample format {layout['sample_format']}")
+    dtype = np.dtype(f"{layout['byteorder']}{kind}{layout['bits'] // 8}")
+    nx, ny = layout["width"], layout["height"]
+    offsets, counts = layout["strip_offsets"], layout["strip_byte_counts"]
+    if all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1)):
+        # Contiguous strips: map the whole image directly
+        return np.memmap(path, dtype=dtype, mode='r', offset=offsets[0], shape=(ny, nx))
+    data = bytearray()
+    with open(path, 'rb') as f:
+        for offset, count in zip(offsets, counts):
+            f.seek(offset)
+            data += f.read(count)
+    return np.frombuffer(bytes(data), dtype=dtype, count=nx * ny).reshape(ny, nx)
+
+
+def write_mrc(path, image, reciprocal=False, flip_y=True, label="pp gain reference"):
+    """ float32 MRC (mode 2) of a 2D image, written through a memory map."""
+    ny, nx = image.shape
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, 'wb') as f:
+        f.truncate(_MRC_HEADER_SIZE + nx * ny * 4)
+    out = np.memmap(tmp, dtype="<f4", mode='r+', offset=_MRC_HEADER_SIZE, shape=(ny, nx))
+    out[:] = image[::-1] if flip_y else image
+    if reciprocal:
+        # Same as EMAN2 math.reciprocal: zero pixels stay zero
+        np.divide(1.0, out, out=out, where=out != 0)
+    dmin, dmax, dmean = float(out.min()), float(out.max()), float(out.mean(dtype=np.float64))
+    rms = float(out.std(dtype=np.float64))
+    out.flush()
+    del out
+
+    header = bytearray(_MRC_HEADER_SIZE)
+    struct.pack_into("<3ii3i3i3f3f3i3fii", header, 0, nx, ny, 1, 2, 0, 0, 0, nx, ny, 1,
+                     float(nx), float(ny), 1.0, 90.0, 90.0, 90.0, 1, 2, 3, dmin, dmax, dmean, 0, 0)
+    header[208:212] = b"MAP "
+    header[212:216] = b"\x44\x44\x00\x00"
+    struct.pack_into("<fi", header, 216, rms, 1)
+    header[224:224 + 80] = label.encode()[:80].ljust(80)
+    with open(tmp, 'r+b') as f:
+        f.write(header)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def gain_kind(gain_in):
+    suffix = Path(gain_in).suffix.lower()
+    if suffix not in (".dm4", ".gain"):
+        raise GainFormatError(f"unknown gain reference format {gain_in}")
+    return suffix
+
+
+def convert_gain_file(gain_in, gain_out):
+    """ Convert without the cache. .gain files are inverted, .dm4 files are not."""
+    if gain_kind(gain_in) == ".dm4":
+        write_mrc(gain_out, read_dm4(gain_in))
+    else:
+        write_mrc(gain_out, read_tiff_gain(gain_in), reciprocal=True)
+
+
+def convert_gain_imod(gain_in, gain_out):
+    """ The previous IMOD/EMAN2 route, kept for gain files the native reader does not understand."""
+    #### Trick: Running this script with sudo will clear the evironment, so we must start from source ~/.bashrc
+    if gain_kind(gain_in) == ".dm4":
+        subprocess.run('bash -c "source ~/.bashrc && module load pp && dm2mrc {} {}"'.format(gain_in, gain_out), shell=True, check=True)
+    else:
+        gain_out_temp = str(gain_out)[:-4] + "_temp.mrc"
+        subprocess.run('bash -c "source ~/.bashrc && module load pp && tif2mrc {} {}"'.format(gain_in, gain_out_temp), shell=True, check=True)
+        subprocess.run('bash -c "source ~/.bashrc && module load pp && source activate eman2 && e2proc2d.py --process math.reciprocal {} {}"'.format(gain_out_temp, gain_out), shell=True, check=True)
+
+
+def gain_hash(gain_in, block_size=16 * 1024 * 1024):
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"v{CONVERTER_VERSION}{gain_kind(gain_in)}".encode())
+    with open(gain_in, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def convert_gain(gain_in, gain_out, cache_dir=GAIN_CACHE_DIR):
+    """ Produce gain_out from gain_in through the shared cache. Returns 'cached', 'converted' or 'imod'."""
+    key = gain_hash(gain_in)
+    cached = Path(cache_dir) / f"{key}.mrc" if cache_dir else None
+    if cached is not None and cached.exists():
+        copy_file(cached, gain_out, verify=False)
+        return "cached"
+    try:
+        convert_gain_file(gain_in, gain_out)
+        how = "converted"
+    except (GainFormatError, TiffHeaderError) as e:
+        print(f"Native gain conversion failed ({e}), using IMOD")
+        convert_gain_imod(gain_in, gain_out)
+        how = "imod"
+    if cached is not None:
+        tmp = None
+        try:
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            # A name of our own, so concurrent conversions of the same gain cannot clobber each other
+            fd, tmp = tempfile.mkstemp(prefix=f".{key}.", suffix=".tmp", dir=cached.parent)
+            os.close(fd)
+            copy_file(gain_out, tmp, verify=False)
+            os.replace(tmp, cached)
+        except OSError as e:
+            print(f"Cannot store gain in cache {cache_dir}: {e}")
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+    return how
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print(f"usage: {sys.argv[0]} <gain.dm4|.gain> <out.mrc>", file=sys.stderr)
+        sys.exit(2)
+    print(convert_gain(sys.argv[1], sys.argv[2]))
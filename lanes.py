@@ -0,0 +1,101 @@
+import math
+import time
+from collections import deque
+
+### Two submission lanes for the ready movies of a session.
+###
+###   live      movies acquired within the last live_window seconds, newest first:
+###             the operator needs their stigma for the next exposures
+###   backfill  the older backlog, oldest first, with the remaining capacity
+###
+### When both lanes have work, live gets live_share of the places (at least one)
+### and backfill the rest; a lane that runs dry leaves its places to the other.
+### The lane travels with the movie to the executor: spool tasks of the live
+### lane are claimed first (see spool.py), backfill job arrays can be niced.
+
+LANES = ("live", "backfill")
+
+
+class LanePolicy:
+    def __init__(self, live_share=0.5, live_window=120.0):
+        if not 0 < live_share <= 1:
+            raise ValueError(f"live_share must be in (0, 1], got {live_share}")
+        self.live_share = live_share
+        self.live_window = live_window
+
+    def lane(self, acquired_at, now=None):
+        now = time.time() if now is None else now
+        return "live" if acquired_at is not None and now - acquired_at <= self.live_window else "backfill"
+
+    def pick(self, ready, acquired, count, now=None, arrange=None):
+        """ Up to 'count' of the 'ready' movies (oldest first) as [(movie, lane)], live ones first.
+
+        arrange(backlog, places) chooses the backfill movies, default the oldest 'places'.
+        """
+        now = time.time() if now is None else now
+        live, backlog = [], []
+        for movie in ready:
+            (live if self.lane(acquired.get(movie), now) == "live" else backlog).append(movie)
+        live.reverse()
+        if backlog:
+            live_places = min(len(live), max(1, round(count * self.live_share)))
+        else:
+            live_places = min(len(live), count)
+        chosen = [(movie, "live") for movie in live[:live_places]]
+        places = count - len(chosen)
+        backfill = backlog[:places] if arrange is None else arrange(backlog, places)
+        chosen += [(movie, "backfill") for movie in backfill]
+        chosen += [(movie, "live") for movie in live[live_places:live_places + count - len(chosen)]]
+        return chosen
+
+
+class LaneShare:
+    """ Which lane a worker should take next so that live gets about live_share of its recent claims."""
+
+    def __init__(self, live_share=0.5, history=20):
+        self.live_share = live_share
+        self.recent = deque(maxlen=history)
+
+    def preferred(self):
+        live = sum(1 for lane in self.recent if lane == "live")
+        return "live" if live <= self.live_share * len(self.recent) else "backfill"
+
+    def claimed(self, lane):
+        self.recent.append(lane if lane in LANES else "backfill")
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class LatencyStats:
+    """ Acquisition -> stigma output latency of the last 'window' movies of each lane."""
+
+    def __init__(self, window=200, report_interval=60.0):
+        self.samples = {lane: deque(maxlen=window) for lane in LANES}
+        self.report_interval = report_interval
+        self._next_report = time.monotonic() + report_interval
+        self._new = 0
+
+    def add(self, lane, seconds):
+        if seconds is None or seconds < 0:
+            return
+        self.samples[lane if lane in self.samples else "backfill"].append(seconds)
+        self._new += 1
+
+    def report_due(self):
+        """ True at most once per report_interval, and only when something finished since the last report."""
+        if self._new == 0 or time.monotonic() < self._next_report:
+            return False
+        self._next_report = time.monotonic() + self.report_interval
+        self._new = 0
+        return True
+
+    def __str__(self):
+        parts = []
+        for lane, samples in self.samples.items():
+            if samples:
+                parts.append(f"{lane} p50 {_percentile(samples, 0.5):.0f}s p90 {_percentile(samples, 0.9):.0f}s "
+                             f"max {max(samples):.0f}s (n={len(samples)})")
+        return "Latency acquisition->stigma: " + ("; ".join(parts) if parts else "no movies yet")
@@ -0,0 +1,351 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from pathlib import Path
+
+### Per-session processing ledger, replacing the per-movie .done flag files.
+###
+### run_slurm2.py owns a WAL-mode SQLite database (<session>/ledger/ledger.sqlite)
+### holding one row per movie with its state, timestamps, job id and outputs.
+### Workers run on other nodes, where SQLite locking over NFS is not safe, so they
+### append JSON lines to their own journal (<session>/ledger/journal/<host>-<pid>.jsonl)
+### and the watcher folds new journal lines into the database on every pass.
+### The 'archive' table is the persistent queue of raw-movie copies (see archive.py),
+### 'outcomes' keeps one row per finished attempt of a movie (done or failed).
+
+STATES = ("discovered", "stable", "submitted", "running", "done", "failed")
+
+# A movie only moves forward; 'failed' -> 'submitted' (retry) and 'done' -> 'failed' need force=True
+STATE_RANK = {"discovered": 0, "stable": 1, "submitted": 2, "running": 3, "done": 4, "failed": 4}
+
+FIELDS = ("path", "job_id", "attempts", "discovered_at", "stable_at", "submitted_at", "started_at",
+          "finished_at", "frame_num", "host", "gpu_id", "outputs", "error", "lane", "acquired_at", "aligned_at", "size",
+          "gpu_slots")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS movies (
+    name TEXT PRIMARY KEY,
+    path TEXT,
+    state TEXT NOT NULL,
+    state_rank INTEGER NOT NULL,
+    job_id TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    discovered_at REAL,
+    stable_at REAL,
+    submitted_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    frame_num INTEGER,
+    host TEXT,
+    gpu_id INTEGER,
+    outputs TEXT,
+    error TEXT,
+    lane TEXT,
+    acquired_at REAL,
+    aligned_at REAL,
+    size INTEGER,
+    gpu_slots INTEGER
+);
+CREATE INDEX IF NOT EXISTS movies_state ON movies(state);
+CREATE INDEX IF NOT EXISTS movies_job ON movies(job_id);
+CREATE TABLE IF NOT EXISTS journal_offsets (
+    file TEXT PRIMARY KEY,
+    offset INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS archive (
+    src TEXT PRIMARY KEY,
+    dst TEXT NOT NULL,
+    state TEXT NOT NULL,
+    size INTEGER,
+    method TEXT,
+    checksum TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    queued_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS archive_state ON archive(state);
+CREATE TABLE IF NOT EXISTS outcomes (
+    name TEXT NOT NULL,
+    attempt INTEGER NOT NULL,
+    outcome TEXT NOT NULL,
+    job_id TEXT,
+    host TEXT,
+    gpu_id INTEGER,
+    started_at REAL,
+    finished_at REAL,
+    error TEXT,
+    PRIMARY KEY (name, attempt)
+);
+"""
+
+# Columns added to 'movies' after ledgers were already in use: (name, type)
+_ADDED_COLUMNS = (("lane", "TEXT"), ("acquired_at", "REAL"), ("aligned_at", "REAL"), ("size", "INTEGER"),
+                  ("gpu_slots", "INTEGER"))
+
+ARCHIVE_STATES = ("queued", "copying", "done", "failed")
+
+
+def ledger_paths(session_dir):
+    ledger_dir = Path(session_dir) / "ledger"
+    return ledger_dir / "ledger.sqlite", ledger_dir / "journal"
+
+
+class Ledger:
+    """ SQLite state store for one session. Safe to share between threads."""
+
+    def __init__(self, db_path, journal_dir=None):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.journal_dir = Path(journal_dir) if journal_dir is not None else None
+        if self.journal_dir is not None:
+            self.journal_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(str(self.db_path), timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(_SCHEMA)
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(movies)")}
+        for column, kind in _ADDED_COLUMNS:
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE movies ADD COLUMN {column} {kind}")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def discover(self, paths, now=None, max_attempts=None):
+        """ Record newly seen movies. Returns the ones that still need processing.
+
+        Failed movies are returned again (their retry did not survive a restart) unless
+        they already used up 'max_attempts'.
+        """
+        now = time.time() if now is None else now
+        paths = list(paths)
+        if not paths:
+            return []
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO movies (name, path, state, state_rank, discovered_at) VALUES (?, ?, 'discovered', 0, ?)",
+                    [(Path(p).name, str(p), now) for p in paths])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            handled = set()
+            names = [Path(p).name for p in paths]
+            exhausted = " OR (state = 'failed' AND attempts >= ?)" if max_attempts is not None else ""
+            for i in range(0, len(names), 500):
+                batch = names[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT name FROM movies WHERE name IN ({','.join('?' * len(batch))}) "
+                    f"AND (state IN ('submitted', 'running', 'done'){exhausted})",
+                    batch + ([max_attempts] if max_attempts is not None else [])).fetchall()
+                handled.update(row["name"] for row in rows)
+        return [p for p in paths if Path(p).name not in handled]
+
+    def mark(self, names, state, force=False, **fields):
+        """ Move movies to 'state' and set extra columns. Never moves a movie backwards unless forced."""
+        if isinstance(names, (str, os.PathLike)):
+            names = [names]
+        names = [Path(name).name for name in names]
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"unknown ledger fields {sorted(unknown)}")
+        if "outputs" in fields and not isinstance(fields["outputs"], (str, type(None))):
+            fields["outputs"] = json.dumps(fields["outputs"])
+        rank = STATE_RANK[state]
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        sql = f"UPDATE movies SET state = ?, state_rank = ?{', ' + columns if columns else ''} WHERE name = ?"
+        if not force:
+            sql += " AND state_rank <= ?"
+            if state == "failed":
+                # A late failure of an earlier attempt must not undo a result
+                sql += " AND state != 'done'"
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                for name in names:
+                    self.conn.execute("INSERT OR IGNORE INTO movies (name, state, state_rank) VALUES (?, 'discovered', 0)", (name,))
+                    params = [state, rank, *fields.values(), name]
+                    if not force:
+                        params.append(rank)
+                    self.conn.execute(sql, params)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def names_in_state(self, *states):
+        with self._lock:
+            rows = self.conn.execute(
+                f"SELECT name FROM movies WHERE state IN ({','.join('?' * len(states))})", states).fetchall()
+        return {row["name"] for row in rows}
+
+    def rows(self, *states):
+        with self._lock:
+            if states:
+                return self.conn.execute(
+                    f"SELECT * FROM movies WHERE state IN ({','.join('?' * len(states))}) ORDER BY name", states).fetchall()
+            return self.conn.execute("SELECT * FROM movies ORDER BY name").fetchall()
+
+    def get(self, name):
+        with self._lock:
+            return self.conn.execute("SELECT * FROM movies WHERE name = ?", (Path(name).name,)).fetchone()
+
+    def counts(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) AS n FROM movies GROUP BY state").fetchall()
+        return {row["state"]: row["n"] for row in rows}
+
+    def import_done_flags(self, flag_dir):
+        """ One-off migration: movies with a legacy .done flag are done."""
+        try:
+            with os.scandir(flag_dir) as it:
+                names = [entry.name[:-5] for entry in it if entry.name.endswith(".done")]
+        except FileNotFoundError:
+            return 0
+        if names:
+            self.mark(names, "done")
+        return len(names)
+
+    def record_outcome(self, name, outcome):
+        """ Keep the current attempt of 'name' (job, host, GPU, times, error) in the outcomes table."""
+        with self._lock:
+            row = self.get(name)
+            if row is None:
+                return
+            self.conn.execute(
+                "INSERT OR REPLACE INTO outcomes (name, attempt, outcome, job_id, host, gpu_id, started_at, finished_at, error) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (row["name"], row["attempts"], outcome, row["job_id"], row["host"], row["gpu_id"], row["started_at"],
+                 row["finished_at"], row["error"] if outcome == "failed" else None))
+
+    def outcomes(self, name):
+        with self._lock:
+            return self.conn.execute("SELECT * FROM outcomes WHERE name = ? ORDER BY attempt", (Path(name).name,)).fetchall()
+
+    def queue_archive(self, pairs, now=None):
+        """ Add (src, dst) copies to the persistent archive queue. Already queued sources are kept."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO archive (src, dst, state, queued_at) VALUES (?, ?, 'queued', ?)",
+                    [(str(src), str(dst), now) for src, dst in pairs])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def archive_pending(self):
+        """ Copies not finished yet, including ones interrupted by a restart."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT * FROM archive WHERE state IN ('queued', 'copying') ORDER BY queued_at, src").fetchall()
+
+    def mark_archive(self, src, state, **fields):
+        columns = "".join(f", {key} = ?" for key in fields)
+        with self._lock:
+            self.conn.execute(f"UPDATE archive SET state = ?{columns} WHERE src = ?",
+                              [state, *fields.values(), str(src)])
+
+    def archive_counts(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT state, COUNT(*) AS n FROM archive GROUP BY state").fetchall()
+        return {row["state"]: row["n"] for row in rows}
+
+    def ingest(self):
+        """ Apply journal lines written by workers since the last call. Returns the applied events."""
+        if self.journal_dir is None:
+            return []
+        with self._lock:
+            offsets = {row["file"]: row["offset"] for row in self.conn.execute("SELECT file, offset FROM journal_offsets")}
+        events = []
+        with os.scandir(self.journal_dir) as it:
+            entries = [entry for entry in it if entry.name.endswith(".jsonl")]
+        for entry in entries:
+            start = offsets.get(entry.name, 0)
+            if entry.stat().st_size <= start:
+                continue
+            with open(entry.path, 'rb') as f:
+                f.seek(start)
+                data = f.read()
+            # Only whole lines; a line still being appended is picked up next time
+            end = data.rfind(b"\n") + 1
+            for line in data[:end].splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                    if event["state"] not in STATE_RANK:
+                        raise ValueError(f"unknown state {event['state']!r}")
+                    fields = {key: value for key, value in event.get("fields", {}).items() if key in FIELDS}
+                    attempt = event.get("attempt")
+                    if attempt is not None:
+                        attempt = int(attempt)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    # e.g. a worker killed mid-write on NFS; skipping it keeps the rest of the journal readable
+                    print(f"Skipping malformed line in journal {entry.name}: {e}")
+                    continue
+                row = self.get(event["name"])
+                if row is not None and event["state"] != "done" and attempt is not None and attempt != row["attempts"]:
+                    # Late report of an earlier attempt (a killed job, a requeued spool copy): the movie has
+                    # been resubmitted since. Only a result of any attempt still counts.
+                    continue
+                if event["state"] == "failed" and row is not None and row["state"] == "done":
+                    continue
+                self.mark(event["name"], event["state"], **fields)
+                if event["state"] in ("done", "failed"):
+                    self.record_outcome(event["name"], event["state"])
+                events.append(event)
+            # Offset is saved after the events are applied, so a crash replays rather than loses them
+            with self._lock:
+                self.conn.execute("INSERT OR REPLACE INTO journal_offsets (file, offset) VALUES (?, ?)", (entry.name, start + end))
+        return events
+
+
+class Journal:
+    """ Append-only event log written by one worker process."""
+
+    def __init__(self, journal_dir):
+        journal_dir = Path(journal_dir)
+        journal_dir.mkdir(parents=True, exist_ok=True)
+        self.host = socket.gethostname()
+        self.path = journal_dir / f"{self.host}-{os.getpid()}.jsonl"
+        self._lock = threading.Lock()
+
+    def record(self, name, state, attempt=None, **fields):
+        """ Append one event; 'attempt' is the movie's attempt number the watcher submitted it with."""
+        fields.setdefault("host", self.host)
+        event = {"name": Path(name).name, "state": state, "time": time.time(), "fields": fields}
+        if attempt is not None:
+            event["attempt"] = attempt
+        line = json.dumps(event) + "\n"
+        # One write per event with O_APPEND, so a reader never sees half of two lines interleaved
+        with self._lock:
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line.encode())
+            finally:
+                os.close(fd)
+
+
+_journals = {}
+
+
+def open_journal(journal_dir):
+    """ Journal for this process, or None when no journal directory is configured."""
+    if journal_dir is None:
+        return None
+    key = (str(journal_dir), os.getpid())
+    if key not in _journals:
+        _journals[key] = Journal(journal_dir)
+    return _journals[key]
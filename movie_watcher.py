@@ -0,0 +1,230 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+MOVIE_SUFFIXES = (".tif", ".tiff", ".eer")
+
+### inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF | IN_MOVE_SELF
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        libc_name = ctypes.util.find_library("c") or "libc.so.6"
+        _libc = ctypes.CDLL(libc_name, use_errno=True)
+    return _libc
+
+
+def inotify_init():
+    """ Return an inotify file descriptor, or None where inotify is unavailable."""
+    try:
+        libc = _load_libc()
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return fd
+
+
+def inotify_add_watch(fd, path, mask=WATCH_MASK):
+    libc = _load_libc()
+    wd = libc.inotify_add_watch(fd, os.fsencode(str(path)), ctypes.c_uint32(mask))
+    if wd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), str(path))
+    return wd
+
+
+def read_inotify_events(fd):
+    """ Drain pending events from fd as (wd, mask, name) tuples."""
+    events = []
+    while True:
+        try:
+            buf = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if not buf:
+            break
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buf):
+            wd, mask, _cookie, length = _EVENT_HEADER.unpack_from(buf, offset)
+            offset += _EVENT_HEADER.size
+            name = buf[offset:offset + length].split(b"\0", 1)[0]
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+    return events
+
+
+class MovieWatcher:
+    """ Report new movie files in a directory as they appear.
+
+    inotify is used when the kernel delivers events for the directory. Network
+    filesystems often never fire for writes from other hosts (the microscope PC
+    writes over NFS/SMB), so the directory mtime is also checked every
+    'fallback_interval' seconds and an incremental os.scandir pass picks up
+    anything inotify missed. Only names not seen before are returned.
+    """
+
+    def __init__(self, directory, suffixes=MOVIE_SUFFIXES, fallback_interval=1.0):
+        self.directory = Path(directory)
+        self.suffixes = tuple(suffixes)
+        self.fallback_interval = fallback_interval
+        self.closed = set()     # names reported by IN_CLOSE_WRITE / IN_MOVED_TO
+        self._seen = set()
+        self._dir_mtime = None
+        self._fd = inotify_init()
+        self._wd = None
+        self._scanned = False
+
+    @property
+    def uses_inotify(self):
+        return self._wd is not None
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._wd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _ensure_watch(self):
+        if self._fd is None or self._wd is not None:
+            return
+        try:
+            self._wd = inotify_add_watch(self._fd, self.directory)
+        except OSError:
+            self._wd = None
+
+    def _is_movie(self, name):
+        return name.lower().endswith(self.suffixes) and not name.startswith(".")
+
+    def _scan(self):
+        """ Incremental scandir pass: only runs when the directory mtime moved."""
+        try:
+            mtime = self.directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if mtime == self._dir_mtime:
+            return []
+        # Watch is (re)attached before listing so nothing slips in between
+        self._ensure_watch()
+        new = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name not in self._seen and self._is_movie(entry.name):
+                    self._seen.add(entry.name)
+                    new.append(entry.name)
+        self._dir_mtime = mtime
+        return new
+
+    def _drain_events(self):
+        new = []
+        for wd, mask, name in read_inotify_events(self._fd):
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped by the kernel, force a rescan
+                self._dir_mtime = None
+                new.extend(self._scan())
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self._wd = None
+                self._dir_mtime = None
+                continue
+            if not name or not self._is_movie(name):
+                continue
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.closed.add(name)
+            if name not in self._seen:
+                self._seen.add(name)
+                new.append(name)
+        return new
+
+    def poll(self, timeout=5.0):
+        """ Return movies that appeared since the last call, sorted by path.
+
+        Blocks for at most 'timeout' seconds and returns as soon as at least one
+        new movie is seen.
+        """
+        if not self._scanned:
+            self._scanned = True
+            new = self._scan()
+            if new:
+                return sorted(self.directory / name for name in new)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            wait = max(0.0, min(remaining, self.fallback_interval))
+            new = []
+            if self._wd is not None:
+                try:
+                    ready, _, _ = select.select([self._fd], [], [], wait)
+                except InterruptedError:
+                    ready = []
+                if ready:
+                    new = self._drain_events()
+            elif wait > 0:
+                time.sleep(wait)
+            if not new:
+                new = self._scan()
+            if new or remaining <= wait:
+                return sorted(self.directory / name for name in new)
+
+    def fileno(self):
+        """ inotify descriptor while the directory is watched, else None."""
+        return self._fd if self._wd is not None else None
+
+    def take_closed(self):
+        """ Names reported closed by the writer since the last call."""
+        closed, self.closed = self.closed, set()
+        return closed
+
+    def forget(self, path):
+        """ Allow 'path' to be reported again, e.g. after it was deleted and rewritten."""
+        name = Path(path).name
+        self._seen.discard(name)
+        self.closed.discard(name)
+
+
+def wait_any(watchers, timeout):
+    """ Wait until one of several watchers has inotify events, at most 'timeout' seconds.
+
+    Their poll(timeout=0) then picks up the events (or the scandir fallback).
+    """
+    fds = [fd for fd in (watcher.fileno() for watcher in watchers) if fd is not None]
+    if not fds:
+        time.sleep(max(0.0, timeout))
+        return
+    try:
+        select.select(fds, [], [], max(0.0, timeout))
+    except InterruptedError:
+        pass
@@ -0,0 +1,166 @@
+import os
+import pwd
+import errno
+import struct
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+### Ownership + ACL for session outputs, without one setfacl process per file.
+###
+### The access ACL is read and written directly as the 'system.posix_acl_access'
+### xattr (the format the kernel and setfacl use), adding the same named-user
+### entry as 'setfacl -m user:cryosparc-user:rwx' and recomputing the mask.
+### Files already owned by uid:gid with the entry in place are left alone.
+### apply() is called as outputs are created; apply_tree() walks the output
+### tree in parallel at the end and skips everything apply() already handled.
+
+ACL_USER = "cryosparc-user"
+ACL_XATTR = "system.posix_acl_access"
+
+_ACL_VERSION = 2
+_HEADER = struct.Struct("<I")
+_ENTRY = struct.Struct("<HHI")
+_UNDEFINED_ID = 0xFFFFFFFF
+
+# Entry tags, in the order the kernel expects them
+ACL_TAG_USER_OBJ = 0x01
+ACL_TAG_USER = 0x02
+ACL_TAG_GROUP_OBJ = 0x04
+ACL_TAG_GROUP = 0x08
+ACL_TAG_MASK = 0x10
+ACL_TAG_OTHER = 0x20
+
+
+def decode_acl(data):
+    """ xattr value -> list of (tag, perm, id)."""
+    (version,) = _HEADER.unpack_from(data)
+    if version != _ACL_VERSION:
+        raise ValueError(f"unsupported ACL version {version}")
+    return [_ENTRY.unpack_from(data, offset) for offset in range(_HEADER.size, len(data), _ENTRY.size)]
+
+
+def encode_acl(entries):
+    entries = sorted(entries, key=lambda e: (e[0], e[2] if e[0] in (ACL_TAG_USER, ACL_TAG_GROUP) else 0))
+    return _HEADER.pack(_ACL_VERSION) + b"".join(_ENTRY.pack(*entry) for entry in entries)
+
+
+def acl_from_mode(mode):
+    """ The minimal ACL equivalent to the permission bits."""
+    return [(ACL_TAG_USER_OBJ, (mode >> 6) & 7, _UNDEFINED_ID),
+            (ACL_TAG_GROUP_OBJ, (mode >> 3) & 7, _UNDEFINED_ID),
+            (ACL_TAG_OTHER, mode & 7, _UNDEFINED_ID)]
+
+
+def with_named_user(entries, uid, perm):
+    """ Add or replace a named-user entry and recompute the mask like 'setfacl -m'."""
+    entries = [e for e in entries if not (e[0] == ACL_TAG_USER and e[2] == uid) and e[0] != ACL_TAG_MASK]
+    entries.append((ACL_TAG_USER, perm, uid))
+    mask = 0
+    for tag, entry_perm, _id in entries:
+        if tag in (ACL_TAG_USER, ACL_TAG_GROUP_OBJ, ACL_TAG_GROUP):
+            mask |= entry_perm
+    entries.append((ACL_TAG_MASK, mask, _UNDEFINED_ID))
+    return entries
+
+
+class PermissionEngine:
+    """ chown + named-user ACL for files and whole trees."""
+
+    def __init__(self, uid, gid, acl_user=ACL_USER, acl_perm=7, workers=8):
+        self.uid, self.gid = uid, gid
+        self.acl_perm = acl_perm
+        self.workers = workers
+        try:
+            self.acl_uid = pwd.getpwnam(acl_user).pw_uid
+        except KeyError:
+            print(f"User {acl_user} does not exist, only ownership will be set")
+            self.acl_uid = None
+        self.checked = 0
+        self.changed = 0
+        self._done = {}         # path -> inode already handled in this session
+        self._lock = threading.Lock()
+
+    def _acl_ok(self, path):
+        try:
+            current = os.getxattr(path, ACL_XATTR)
+        except OSError as e:
+            if e.errno != errno.ENODATA:
+                raise
+            return False
+        return any(tag == ACL_TAG_USER and entry_id == self.acl_uid and perm == self.acl_perm
+                   for tag, perm, entry_id in decode_acl(current))
+
+    def _set_acl(self, path, mode):
+        try:
+            entries = decode_acl(os.getxattr(path, ACL_XATTR))
+        except OSError as e:
+            if e.errno != errno.ENODATA:
+                raise
+            entries = acl_from_mode(mode)
+        os.setxattr(path, ACL_XATTR, encode_acl(with_named_user(entries, self.acl_uid, self.acl_perm)))
+
+    def apply(self, path):
+        """ Bring one file or directory to uid:gid + ACL. Returns True if anything changed."""
+        path = str(path)
+        st = os.stat(path)
+        changed = False
+        if (st.st_uid, st.st_gid) != (self.uid, self.gid):
+            os.chown(path, self.uid, self.gid)
+            changed = True
+        if self.acl_uid is not None:
+            try:
+                if not self._acl_ok(path):
+                    self._set_acl(path, st.st_mode)
+                    changed = True
+            except OSError as e:
+                if e.errno not in (errno.EOPNOTSUPP, errno.ENOTSUP):
+                    raise
+                print(f"ACLs not supported on {path}, only ownership will be set")
+                self.acl_uid = None
+        with self._lock:
+            self._done[path] = st.st_ino
+            self.checked += 1
+            self.changed += changed
+        return changed
+
+    def apply_many(self, paths):
+        """ Incremental form: apply() to each existing path."""
+        for path in paths:
+            try:
+                self.apply(path)
+            except FileNotFoundError:
+                pass
+
+    def _apply_dir(self, directory):
+        subdirs = []
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                # Unchanged since apply() saw it: nothing to do, not even a stat
+                if self._done.get(entry.path) == entry.inode():
+                    continue
+                try:
+                    self.apply(entry.path)
+                except FileNotFoundError:
+                    pass
+        return subdirs
+
+    def apply_tree(self, root):
+        """ Parallel walk of 'root'. Returns (checked, changed) for this pass."""
+        checked, changed = self.checked, self.changed
+        self.apply(root)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="permissions") as pool:
+            pending = {pool.submit(self._apply_dir, str(root))}
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    for subdir in future.result():
+                        pending.add(pool.submit(self._apply_dir, subdir))
+        return self.checked - checked, self.changed - changed
+
+
+def recursive_chown_and_acl(path, uid, gid, acl_user=ACL_USER):
+    """ One-shot equivalent of chown -R uid:gid + setfacl -R -m user:<acl_user>:rwx."""
+    return PermissionEngine(uid, gid, acl_user).apply_tree(Path(path))
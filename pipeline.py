@@ -0,0 +1,427 @@
+import os
+import time
+import socket
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+### Two-stage pipeline used inside the worker: GPU slots run only MotionCor2 and
+### hand the aligned micrograph to a bounded CPU pool (ctffind5 + stigma), so the
+### next movie starts on the GPU while the previous CTF fit is still running.
+### Both stages spawn external programs, so threads are enough here.
+### Movies submitted without a GPU go to a shared queue that every GPU slot
+### takes from as soon as it is free, so one slow movie never holds the others.
+### A GPU can have several slots (concurrent MotionCor2 runs, which overlap one
+### movie's TIFF decode and disk I/O with another's GPU work); a slot only starts
+### a movie whose estimated memory footprint still fits on its GPU.
+### With a batch stage, a free slot also takes compatible movies that would
+### otherwise wait in the queue and runs them in one go (MotionCor2 -Serial),
+### handing each result to the CPU pool as soon as it is ready.
+
+
+def discover_gpus(default=4):
+    """ GPU ids to pass to MotionCor2 -Gpu, from the CUDA / SLURM environment or nvidia-smi."""
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None and visible.strip():
+        # CUDA renumbers the visible devices from 0
+        return list(range(len([gpu for gpu in visible.split(",") if gpu.strip()])))
+    for name in ("SLURM_STEP_GPUS", "SLURM_JOB_GPUS"):
+        value = os.environ.get(name)
+        if value and value.strip():
+            return [int(gpu) for gpu in value.split(",") if gpu.strip().isdigit()]
+    try:
+        result = subprocess.run(["nvidia-smi", "-L"], capture_output=True, text=True, timeout=10)
+        count = sum(1 for line in result.stdout.splitlines() if line.startswith("GPU "))
+        if result.returncode == 0 and count:
+            return list(range(count))
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    return list(range(default))
+
+
+def gpu_memory(gpu_ids, headroom=0.9):
+    """ {gpu id: MB usable by MotionCor2} from nvidia-smi, or None when it cannot be queried."""
+    try:
+        result = subprocess.run(["nvidia-smi", "--query-gpu=index,memory.total", "--format=csv,noheader,nounits"],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    total = {}
+    for line in result.stdout.splitlines():
+        index, _, mb = line.partition(",")
+        if index.strip().isdigit() and mb.strip().isdigit():
+            total[int(index)] = int(mb)
+    if not all(physical_gpu(gpu_id) in total for gpu_id in gpu_ids):
+        return None
+    return {gpu_id: total[physical_gpu(gpu_id)] * headroom for gpu_id in gpu_ids}
+
+
+def _visible_devices():
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if not visible or not visible.strip():
+        return None
+    return [gpu.strip() for gpu in visible.split(",") if gpu.strip()]
+
+
+def physical_gpu(gpu_id):
+    """ Device id on the node for a MotionCor2 -Gpu index, so different jobs on one node agree."""
+    visible = _visible_devices()
+    if visible is not None and 0 <= gpu_id < len(visible) and visible[gpu_id].isdigit():
+        return int(visible[gpu_id])
+    return gpu_id
+
+
+def avoided_gpus(avoid, gpu_ids, host=None):
+    """ MotionCor2 -Gpu indices of this node listed in 'avoid' ("host:gpu" entries of earlier failures)."""
+    host = host or socket.gethostname()
+    bad = set()
+    for entry in avoid or ():
+        entry_host, _, gpu = str(entry).rpartition(":")
+        if entry_host == host and gpu.isdigit():
+            bad.add(int(gpu))
+    return {gpu_id for gpu_id in gpu_ids if physical_gpu(gpu_id) in bad}
+
+
+class StageStats:
+    """ Queue-depth and timing counters for one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.queued = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.max_queued = 0
+        self.busy_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def enqueue(self):
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def start(self):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        return time.monotonic()
+
+    def finish(self, started, ok):
+        with self._lock:
+            self.running -= 1
+            self.busy_seconds += time.monotonic() - started
+            if ok:
+                self.done += 1
+            else:
+                self.failed += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {"queued": self.queued, "running": self.running, "done": self.done, "failed": self.failed,
+                    "max_queued": self.max_queued, "busy_seconds": round(self.busy_seconds, 1)}
+
+    def __str__(self):
+        snap = self.snapshot()
+        return (f"{self.name}: queued={snap['queued']} running={snap['running']} done={snap['done']} "
+                f"failed={snap['failed']} max_queued={snap['max_queued']} busy={snap['busy_seconds']}s")
+
+
+class SlotStats:
+    """ GPU stage times by the number of movies running on the GPU when each started."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.by_concurrency = {}        # concurrency -> [movies, seconds]
+        self._lock = threading.Lock()
+
+    def add(self, concurrency, seconds):
+        with self._lock:
+            entry = self.by_concurrency.setdefault(concurrency, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+    def __str__(self):
+        with self._lock:
+            items = sorted(self.by_concurrency.items())
+        parts = [f"{concurrency}x {movies} movie(s) {seconds / movies:.0f}s" for concurrency, (movies, seconds) in items]
+        return "gpu slots: " + (", ".join(parts) if parts else "no movies yet")
+
+
+class GpuCpuPipeline:
+    """ Run gpu_stage(item, gpu_id) on a GPU slot, then cpu_stage(item, gpu_result) on the CPU pool.
+
+    submit() returns a Future for the CPU stage result. With a gpu_id the item
+    waits for that GPU; without one it goes to the shared queue and runs on
+    whichever GPU frees up first, except the GPUs in 'avoid' (retries of movies
+    that failed there) unless that would leave none. At most 'cpu_workers' CPU
+    jobs run and at most 'cpu_backlog' more wait; when the backlog is full GPU
+    slots block before handing over, instead of piling up outputs.
+    Each GPU has slots_per_gpu slots. With 'memory' ({gpu id: MB}) and
+    footprint(item) -> MB (None: unknown, the movie runs alone), a slot waits
+    until the movie fits next to those already running on its GPU; a GPU
+    always takes one movie, however large.
+    With gpu_batch_stage(items, gpu_id, on_result) and batch_size > 1, a slot
+    takes up to batch_size movies with the same batch_key(item) that no idle
+    slot would start, no larger than the first; the batch stage calls
+    on_result(index, gpu_result) for each movie as it completes, and movies
+    it never reports fail.
+    """
+
+    def __init__(self, gpu_stage, cpu_stage, gpu_ids, cpu_workers=4, cpu_backlog=8, slots_per_gpu=1,
+                 memory=None, footprint=None, gpu_batch_stage=None, batch_size=1, batch_key=None):
+        self.gpu_stage = gpu_stage
+        self.cpu_stage = cpu_stage
+        self.gpu_ids = list(gpu_ids)
+        self.slots_per_gpu = max(1, slots_per_gpu)
+        self.memory = memory
+        self.footprint = footprint
+        self.gpu_batch_stage = gpu_batch_stage
+        self.batch_size = max(1, batch_size) if gpu_batch_stage is not None else 1
+        self.batch_key = batch_key
+        self.gpu_stats = StageStats("gpu")
+        self.cpu_stats = StageStats("cpu")
+        self.slot_stats = SlotStats()
+        self._cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="cpu-stage")
+        self._cpu_slots = threading.BoundedSemaphore(cpu_workers + cpu_backlog)
+        self._pinned = {gpu_id: deque() for gpu_id in self.gpu_ids}
+        self._shared = deque()
+        self._closing = False
+        self._assigned = {gpu_id: 0 for gpu_id in self.gpu_ids}    # movies queued on or running on each GPU
+        self._running = {gpu_id: 0 for gpu_id in self.gpu_ids}     # movies in MotionCor2 on each GPU
+        self._mem_used = {gpu_id: 0.0 for gpu_id in self.gpu_ids}
+        self._lock = threading.Lock()
+        self._work = threading.Condition(self._lock)
+        self._threads = []
+        for gpu_id in self.gpu_ids:
+            for slot in range(self.slots_per_gpu):
+                thread = threading.Thread(target=self._gpu_loop, args=(gpu_id,), name=f"gpu-{gpu_id}.{slot}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, item, gpu_id=None, avoid=()):
+        future = Future()
+        self.gpu_stats.enqueue()
+        avoid = frozenset(avoid)
+        if avoid >= set(self.gpu_ids):
+            avoid = frozenset()
+        mb = self.footprint(item) if self.footprint is not None else 0.0
+        with self._work:
+            if gpu_id is None:
+                self._shared.append((item, future, avoid, mb))
+            else:
+                self._assigned[gpu_id] += 1
+                self._pinned[gpu_id].append((item, future, mb))
+            self._work.notify_all()
+        return future
+
+    def free_slots(self, gpu_id):
+        # With batching, every slot can use batch_size queued movies
+        with self._lock:
+            return 0 if self._shared else max(0, self.slots_per_gpu * self.batch_size - self._assigned[gpu_id])
+
+    def idle_gpus(self):
+        """ GPUs with room for more movies, each listed once per movie."""
+        return [gpu_id for gpu_id in self.gpu_ids for _ in range(self.free_slots(gpu_id))]
+
+    def _fits(self, gpu_id, mb):
+        if self._running[gpu_id] == 0 or self.memory is None:
+            return True
+        return mb is not None and self._mem_used[gpu_id] + mb <= self.memory[gpu_id]
+
+    def _next(self, gpu_id):
+        with self._work:
+            while True:
+                pinned = self._pinned[gpu_id]
+                if pinned and self._fits(gpu_id, pinned[0][2]):
+                    item, future, mb = pinned.popleft()
+                    return self._admit(gpu_id, item, future, mb)
+                # Work stealing: a free slot takes the oldest unassigned movie it may run and has memory for
+                if not pinned:
+                    for index, (item, future, avoid, mb) in enumerate(self._shared):
+                        if gpu_id not in avoid and self._fits(gpu_id, mb):
+                            del self._shared[index]
+                            self._assigned[gpu_id] += 1
+                            return self._admit(gpu_id, item, future, mb)
+                if self._closing and not pinned and all(gpu_id in avoid for _item, _future, avoid, _mb in self._shared):
+                    return None
+                self._work.wait()
+
+    def _admit(self, gpu_id, item, future, mb):
+        # Called with the lock held; unknown footprints take the whole GPU
+        self._running[gpu_id] += 1
+        batch = [(item, future)]
+        if self.batch_size > 1:
+            batch += self._take_batch(gpu_id, item, mb)
+        mb = self.memory[gpu_id] if mb is None and self.memory is not None else (mb or 0.0)
+        self._mem_used[gpu_id] += mb
+        return batch, mb, self._running[gpu_id]
+
+    def _take_batch(self, gpu_id, first, first_mb):
+        # Only movies beyond what the idle slots would start anyway, so no GPU goes without work
+        key = self.batch_key(first) if self.batch_key is not None else None
+        def compatible(item, mb):
+            if self.batch_key is not None and self.batch_key(item) != key:
+                return False
+            return self.memory is None or first_mb is None or (mb is not None and mb <= first_mb)
+        taken = []
+        pinned = self._pinned[gpu_id]
+        spare = len(pinned) - (self.slots_per_gpu - self._running[gpu_id])
+        for entry in list(pinned):
+            if len(taken) >= self.batch_size - 1 or spare <= 0:
+                return taken
+            item, future, mb = entry
+            if compatible(item, mb):
+                pinned.remove(entry)
+                taken.append((item, future))
+                spare -= 1
+        if pinned:
+            return taken
+        spare = len(self._shared) - sum(self.slots_per_gpu - self._running[g] for g in self.gpu_ids if not self._pinned[g])
+        for entry in list(self._shared):
+            if len(taken) >= self.batch_size - 1 or spare <= 0:
+                break
+            item, future, avoid, mb = entry
+            if gpu_id not in avoid and compatible(item, mb):
+                self._shared.remove(entry)
+                self._assigned[gpu_id] += 1
+                taken.append((item, future))
+                spare -= 1
+        return taken
+
+    def _end_gpu_stage(self, gpu_id, mb):
+        with self._work:
+            self._running[gpu_id] -= 1
+            self._mem_used[gpu_id] -= mb
+            self._work.notify_all()
+
+    def _gpu_loop(self, gpu_id):
+        while True:
+            entry = self._next(gpu_id)
+            if entry is None:
+                break
+            batch, mb, concurrency = entry
+            if len(batch) > 1:
+                self._run_batch(gpu_id, batch, mb, concurrency)
+                continue
+            (item, future), = batch
+            started = self.gpu_stats.start()
+            try:
+                gpu_result = self.gpu_stage(item, gpu_id)
+            except BaseException as e:
+                self.gpu_stats.finish(started, False)
+                self._end_gpu_stage(gpu_id, mb)
+                self._release_gpu(gpu_id)
+                future.set_exception(e)
+                continue
+            self.gpu_stats.finish(started, True)
+            self.slot_stats.add(concurrency, time.monotonic() - started)
+            self._end_gpu_stage(gpu_id, mb)
+            self._hand_over(item, gpu_result, future)
+            self._release_gpu(gpu_id)
+
+    def _hand_over(self, item, gpu_result, future):
+        # Backpressure: wait for room in the CPU backlog before taking the next movie
+        self._cpu_slots.acquire()
+        self.cpu_stats.enqueue()
+        self._cpu_pool.submit(self._cpu_job, item, gpu_result, future)
+
+    def _run_batch(self, gpu_id, batch, mb, concurrency):
+        # The movies of a batch run one after the other; each counts from the end of the previous one
+        done = set()
+        started = [self.gpu_stats.start()]
+        def on_result(index, gpu_result):
+            if index in done:
+                return
+            done.add(index)
+            self.gpu_stats.finish(started[0], True)
+            self.slot_stats.add(concurrency, time.monotonic() - started[0])
+            if len(done) < len(batch):
+                started[0] = self.gpu_stats.start()
+            item, future = batch[index]
+            self._hand_over(item, gpu_result, future)
+            self._release_gpu(gpu_id)
+        error = None
+        try:
+            self.gpu_batch_stage([item for item, _future in batch], gpu_id, on_result)
+        except BaseException as e:
+            error = e
+        self._end_gpu_stage(gpu_id, mb)
+        missing = [index for index in range(len(batch)) if index not in done]
+        for position, index in enumerate(missing):
+            if position > 0:
+                started[0] = self.gpu_stats.start()
+            self.gpu_stats.finish(started[0], False)
+            self._release_gpu(gpu_id)
+            batch[index][1].set_exception(error or RuntimeError("batch finished without a result for this item"))
+
+    def _release_gpu(self, gpu_id):
+        with self._lock:
+            self._assigned[gpu_id] -= 1
+
+    def _cpu_job(self, item, gpu_result, future):
+        started = self.cpu_stats.start()
+        try:
+            result = self.cpu_stage(item, gpu_result)
+        except BaseException as e:
+            self.cpu_stats.finish(started, False)
+            future.set_exception(e)
+        else:
+            self.cpu_stats.finish(started, True)
+            future.set_result(result)
+        finally:
+            self._cpu_slots.release()
+
+    def stats(self):
+        if self.slots_per_gpu > 1:
+            return f"{self.gpu_stats} | {self.cpu_stats} | {self.slot_stats}"
+        return f"{self.gpu_stats} | {self.cpu_stats}"
+
+    def close(self):
+        # GPU slots finish everything queued, then exit
+        with self._work:
+            self._closing = True
+            self._work.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._cpu_pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_on_gpus(func, items, gpu_ids):
+    """ func(item, gpu_id) for every item, each GPU taking the next item when it is free.
+
+    Returns the results in item order; re-raises the first error once all items ran.
+    """
+    pending = deque(enumerate(items))
+    results = [None] * len(pending)
+    errors = []
+    lock = threading.Lock()
+
+    def gpu_loop(gpu_id):
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, item = pending.popleft()
+            try:
+                results[index] = func(item, gpu_id)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=gpu_loop, args=(gpu_id,), name=f"gpu-{gpu_id}") for gpu_id in gpu_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,224 @@
+#!/home/software/anaconda3/bin/python3
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from pathlib import Path
+
+from movie_watcher import wait_any
+from run_slurm2 import add_args, create_executor, Session, SessionError
+from throttle import SubmissionThrottle
+
+### One scheduler for all running sessions, instead of one run_slurm2.py per session.
+###
+### Every session is a JSON file in --sessions_dir holding run_slurm2.py options
+### for that session, e.g.
+###
+###   {"input": "/data/Titan3/20240101_xyz", "output": "/home/<user>/20240101_xyz",
+###    "pixel_size": 0.83, "dose": 50, "share": 1}
+###
+### (the scope comes from the /<root>/Titan<N>/ path unless "scope_num" is given;
+### Titan3 sessions are watched in their data/ subdirectory). Options missing from
+### a file come from the scheduler's own command line. Execution options
+### (--executor, --spool, --sbatch, ...) are the scheduler's, and all sessions share
+### one executor and its GPUs.
+###
+### One throttle (throttle.py) bounds the movies handed to the executor by its
+### queue depth and the observed throughput of all sessions. Free places go to
+### the session with the fewest movies in flight relative to its "share", so a
+### session that just started gets its first movies (and its stigma feedback)
+### through even while another session has a long backlog.
+### A session that saw no new movies for 30 minutes and has nothing in flight is
+### closed; its last archive copies and ACL pass run on a background thread, after
+### which its file is renamed to <name>.json.finished.
+
+# Options that belong to the shared executor and cannot be set per session
+SCHEDULER_OPTIONS = ("executor", "local_gpus", "local_cpu_workers", "spool", "workers", "sbatch", "array_window",
+                     "squeue", "sacct", "gpus", "retry_exclude_nodes", "max_queued_jobs", "queue_lookahead",
+                     "packing", "cpus_per_gpu", "gpu_slots", "serial_batch")
+
+
+# run_slurm2.py option -> its argparse action, to read session files like a command line
+_OPTION_ACTIONS = {action.dest: action for action in add_args(argparse.ArgumentParser())._actions}
+
+
+def option_value(key, value):
+    """ A session file value converted and checked the way argparse does it for --key."""
+    action = _OPTION_ACTIONS.get(key)
+    if action is None or value is None:
+        return value
+    if action.nargs == 0:
+        # Flags (store_true) may be written as true/false or "yes"/"no"
+        return value.strip().lower() in ("1", "true", "yes", "on") if isinstance(value, str) else bool(value)
+    if action.type is not None and not isinstance(value, bool):
+        try:
+            value = action.type(value)
+        except (TypeError, ValueError):
+            raise SessionError(f"invalid value {value!r} for session option {key!r}")
+    if action.choices is not None and value not in action.choices:
+        raise SessionError(f"session option {key!r} must be one of {', '.join(map(str, action.choices))}, got {value!r}")
+    return value
+
+
+def session_args(defaults, spec):
+    """ Namespace for one session: the scheduler's options overridden by the session file."""
+    values = vars(defaults).copy()
+    for key, value in spec.items():
+        if key not in values:
+            raise SessionError(f"unknown session option {key!r}")
+        if key in SCHEDULER_OPTIONS:
+            print(f"Ignoring session option {key!r}, it is set for the whole scheduler")
+            continue
+        values[key] = option_value(key, value)
+    return argparse.Namespace(**values)
+
+
+def load_session(spec_path, defaults):
+    with open(spec_path) as f:
+        spec = json.load(f)
+    share = float(spec.pop("share", 1))
+    if share <= 0:
+        raise SessionError(f"share must be positive, got {share}")
+    session = Session(session_args(defaults, spec))
+    session.share = share
+    return session
+
+
+def fair_share_order(sessions):
+    """ Sessions by movies in flight per share, oldest waiting movie first on ties."""
+    return sorted(sessions, key=lambda session: (len(session.in_flight) / session.share, session.oldest_ready()))
+
+
+def add_scheduler_args(parser):
+    add_args(parser)
+    parser.add_argument("--sessions_dir", type=str, required=True, help="Directory of <session>.json files, rescanned for new sessions")
+    parser.add_argument("--state_dir", type=str, default="/home/pp/pp_scheduler", help="Job scripts, worker logs and the default local spool")
+    parser.add_argument("--rescan", type=float, default=10, help="Seconds between scans of --sessions_dir")
+    parser.add_argument("--stats_interval", type=float, default=60, help="Seconds between status lines")
+    return parser
+
+
+def main(args):
+    sessions_dir = Path(args.sessions_dir)
+    state_dir = Path(args.state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    sessions = {}       # spec path -> Session
+    by_dir = {}         # watched directory -> Session
+    errors = {}         # spec path -> last setup error, reported once
+    closing = {}        # spec path -> thread finishing a closed session
+
+    ### The shared executor finds the session of a movie from its directory
+    def owner(movie):
+        return by_dir[Path(movie).parent]
+    def make_task(movie, frame_num):
+        return owner(movie).make_task(movie, frame_num)
+    def task_args(movies, frame_nums, avoid=()):
+        return owner(movies[0]).task_args(movies, frame_nums, avoid)
+
+    try:
+        executor, num_gpus = create_executor(args, make_task, task_args, state_dir, "pp", "scheduler", state_dir / "local_spool")
+    except SessionError as e:
+        print(e)
+        sys.exit(1)
+    if args.gpus is not None:
+        num_gpus = args.gpus
+    throttle = SubmissionThrottle(num_gpus * args.gpu_slots, args.queue_lookahead, args.max_queued_jobs)
+    executor.start()
+    print(f"Executor: {executor.name}, {num_gpus} GPU(s), {throttle}")
+
+    def open_sessions():
+        for spec_path in sorted(sessions_dir.glob("*.json")):
+            if spec_path in sessions or spec_path in closing:
+                continue
+            try:
+                session = load_session(spec_path, args)
+                if session.input_dir_data in by_dir:
+                    raise SessionError(f"{session.input_dir_data} is already watched")
+            except (SessionError, OSError, ValueError) as e:
+                if errors.get(spec_path) != str(e):
+                    print(f"Cannot open session {spec_path.name}: {e}")
+                    errors[spec_path] = str(e)
+                continue
+            errors.pop(spec_path, None)
+            session.start(executor, num_gpus, throttle)
+            sessions[spec_path] = session
+            by_dir[session.input_dir_data] = session
+            print(f"Opened session {spec_path.name} (share {session.share:g})")
+
+    def close_session(spec_path):
+        session = sessions.pop(spec_path)
+        print(f"Closing session {spec_path.name}")
+        # Nothing is in flight any more, so no task needs the directory entry
+        del by_dir[session.input_dir_data]
+        # Waiting for the archive copies and walking the output tree would hold up every other session
+        def finish():
+            session.close()
+            os.rename(spec_path, spec_path.with_name(spec_path.name + ".finished"))
+            print(f"Closed session {spec_path.name}")
+        closing[spec_path] = threading.Thread(target=finish, name=f"close-{spec_path.stem}")
+        closing[spec_path].start()
+
+    next_rescan = 0.0
+    blocked = False
+    next_stats = time.monotonic() + args.stats_interval
+    try:
+        while True:
+            if time.monotonic() >= next_rescan:
+                open_sessions()
+                next_rescan = time.monotonic() + args.rescan
+
+            ## Sleep until a watcher fires, a session has work, or the scandir fallback is due
+            active = list(sessions.values())
+            wait = min([session.next_wait(blocked=blocked) for session in active], default=args.rescan)
+            wait_any([session.watcher for session in active], min(wait, 1.0, max(0.0, next_rescan - time.monotonic())))
+            executor.poll()
+            for session in active:
+                session.poll(0)
+
+            ## Free places go to the session furthest below its fair share, its chunk cut down to
+            ## the free places; when there are none, nobody else jumps ahead of it
+            in_flight = sum(len(session.in_flight) for session in active)
+            blocked = False
+            submitted = set()
+            while True:
+                room = throttle.room(in_flight, executor.queue_depth())
+                ready = [(session, chunk) for session in fair_share_order(active) for chunk in [session.ready_chunk(room)] if chunk]
+                if not ready:
+                    break
+                session, chunk = ready[0]
+                if room == 0:
+                    blocked = True
+                    break
+                in_flight += session.submit_chunk(chunk)
+                submitted.add(session)
+
+            for spec_path, session in list(sessions.items()):
+                if session not in submitted and not session.new_tiff_files and session.check_idle():
+                    close_session(spec_path)
+            for spec_path, thread in list(closing.items()):
+                if not thread.is_alive():
+                    del closing[spec_path]
+
+            if time.monotonic() >= next_stats:
+                next_stats = time.monotonic() + args.stats_interval
+                for spec_path, session in sessions.items():
+                    print(f"{spec_path.stem}: {len(session.in_flight)} in flight, {len(session.new_tiff_files)} waiting, "
+                          f"{len(session.retries)} retrying")
+                print(f"Submission: {throttle}, {executor.queue_depth()} job(s) queued")
+    except KeyboardInterrupt:
+        print("Interrupted; movies in flight are adopted again on the next start")
+    finally:
+        executor.close()
+        for spec_path, thread in closing.items():
+            print(f"Waiting for session {spec_path.name} to close")
+            thread.join()
+
+
+if __name__ == "__main__":
+    parser = add_scheduler_args(argparse.ArgumentParser())
+    args = parser.parse_args()
+    print("Preprocessing System by Shanghaitech BioEM v1.1.1 (scheduler)")
+    print("---------------------------------------------------")
+    main(args)
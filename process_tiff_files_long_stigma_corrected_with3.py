@@ -1,12 +1,23 @@
 
 import os
+import math
+import itertools
+import socket
+import shutil
+import struct
 import subprocess
 import argparse
 from pathlib import Path
-import multiprocessing
-import pandas as pd
-import io
-import math
+import time
+from movie_watcher import MovieWatcher
+from pipeline import GpuCpuPipeline, discover_gpus, physical_gpu, avoided_gpus, gpu_memory
+from tiff_header import read_image_layout, TiffHeaderError
+from ledger import open_journal
+from spool import (init_spool, claim_task, finish_task, requeue_stale, owner_name, pending_count, stop_requested, lane_prefix,
+                   renew_lease, LEASE_INTERVAL)
+from lanes import LaneShare
+from ctffind_results import read_ctffind5_txt
+from stigma import SCOPE_CALIBRATION, stigma_correction, write_stigma_file, movie_number
 os.environ['PATH'] += '/home/software/cuda-11.6.0/bin'
 
 ld_library_path = os.environ.get('LD_LIBRARY_PATH', '')
@@ -17,79 +28,42 @@ os.environ['PATH'] += ':/usr/local/bin:/home/software/ctffind-5.0.2'
 
 TEMPLATE_BASH_SCRIPT = Path("/home/pp/code/template.sh")
 
-CTFFIND5_COLUMNS = ['Micrograph Number', 'Defocus 1 [Angstroms]', 'Defocus 2 [Angstroms]', 'Azimuth of Astigmatism',
-    'Additional Phase Shift [Radians]', 'Cross Correlation', 'CTF Rings Fit Spacing [Angstroms]',
-    'Estimated Tilt Axis Angle', 'Estimated Tilt Angle', 'Estimated Sample Thickness [Angstroms]']
-
-def read_ctffind5_txt(txt_file):
-    data_lines = []
-    with open(txt_file, 'r') as file:
-        for line in file:
-            line = line.strip()
-            if not line.startswith('#') and line:  # 跳过以#开头的注释行和空行
-                data_lines.append(line)
-    data = data_lines[-1]
-    df = pd.read_csv(io.StringIO(data), delim_whitespace=True, header=None, names=CTFFIND5_COLUMNS)
-    return df 
-
-def calculate_stigma(defocus_u, defocus_v, stigma_angle, scope, obj_stigma_x=0, obj_stigma_y=0):
-    # Constants from the original Perl script
-    if scope == 1:    
-        x_TEMstigma_step = 38.01
-        y_TEMstigma_step = 36.81
-        y_TEMstigma_angle = -23.61
-        x_TEMstigma_angle = -68.67
-    elif scope == 2:
-        x_TEMstigma_step = 37.01
-        y_TEMstigma_step = 35.58
-        x_TEMstigma_angle = 63.98
-        y_TEMstigma_angle = 19.06
-    elif scope == 3:
-        x_TEMstigma_step = 37.01
-        y_TEMstigma_step = 35.58
-        x_TEMstigma_angle = -19.06
-        y_TEMstigma_angle = -63.98
-
-      
-    # Calculations for Lx
-    x_angle_diff = x_TEMstigma_angle - stigma_angle
-    kx1 = math.sin(math.radians(x_angle_diff)) / math.cos(math.radians(x_angle_diff))
-    x_angle_diff += 90
-    kx2 = math.sin(math.radians(x_angle_diff)) / math.cos(math.radians(x_angle_diff))
-
-    Lx_sub1 = math.sqrt((kx1 * kx1 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * kx1 * kx1))
-    Lx_sub2 = math.sqrt((kx2 * kx2 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * kx2 * kx2))
-    Lx = 0.0001 * defocus_u * defocus_v * (Lx_sub1 - Lx_sub2) / x_TEMstigma_step
-
-    # Calculations for Ly
-    y_angle_diff = y_TEMstigma_angle - stigma_angle
-    ky1 = math.sin(math.radians(y_angle_diff)) / math.cos(math.radians(y_angle_diff))
-    y_angle_diff += 90
-    ky2 = math.sin(math.radians(y_angle_diff)) / math.cos(math.radians(y_angle_diff))
-
-    Ly_sub1 = math.sqrt((ky1 * ky1 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * ky1 * ky1))
-    Ly_sub2 = math.sqrt((ky2 * ky2 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * ky2 * ky2))
-    Ly = 0.0001 * defocus_u * defocus_v * (Ly_sub1 - Ly_sub2) / y_TEMstigma_step
-
-    # Calculate new stigma values
-    new_stigma_x = obj_stigma_x + Lx
-    new_stigma_x = -1 * new_stigma_x
-    new_stigma_y = obj_stigma_y + Ly
-    new_stigma_y = -1 * new_stigma_y
-    new_stigma_x_str = "{:+.5f}".format(new_stigma_x)
-    new_stigma_y_str = "{:+.5f}".format(new_stigma_y)
-    return new_stigma_x_str, new_stigma_y_str
+# Rough GPU memory of one MotionCor2 run: the frame stack as 16-bit pixels, a few
+# float32 frame-sized buffers (gain, sums, FFTs) and the CUDA context
+MOTIONCOR2_FRAME_BUFFERS = 6
+MOTIONCOR2_CONTEXT_MB = 500
+
+# Bytes per pixel of the MRC modes MotionCor2 may write
+MRC_MODE_BYTES = {0: 1, 1: 2, 2: 4, 6: 2, 12: 2}
 
 def process_tiff_file(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_dir, args, frame_num, gpu_id, scope, flag_dir):
+    mrc_file = run_motioncor2(tiff_file, gain_out, motioncor2_dir, args, frame_num, gpu_id, scope)
+    run_ctffind5_and_stigma(tiff_file, mrc_file, ctffind5_dir, stigma_dir, args, scope, flag_dir)
+
+def run_motioncor2(tiff_file, gain_out, motioncor2_dir, args, frame_num, gpu_id, scope, attempt=None):
+    # GPU stage: returns the aligned micrograph; 'attempt' stamps the journal events
     filename_without_extension = os.path.splitext(os.path.basename(tiff_file))[0]
-    inputfile = os.path.basename(tiff_file)
     mrc_file = motioncor2_dir / (filename_without_extension + ".mrc")
+    journal = open_journal(getattr(args, "journal_dir", None))
+    if journal is not None:
+        journal.record(tiff_file, "running", attempt, started_at=time.time(), gpu_id=physical_gpu(gpu_id),
+                       gpu_slots=getattr(args, "gpu_slots", 1))
     print(os.environ['PATH'])
     # Run MotionCor2
+    cmd = motioncor2_cmd(tiff_file, mrc_file, gain_out, motioncor2_dir, args, frame_num, gpu_id, scope)
+    print(f"Run command: {' '.join(cmd)}")
+    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    if journal is not None:
+        # End of the GPU stage, for the watcher's runtime cost model
+        journal.record(tiff_file, "running", attempt, aligned_at=time.time())
+    return mrc_file
+
+def motioncor2_cmd(in_path, out_path, gain_out, motioncor2_dir, args, frame_num, gpu_id, scope, serial_suffix=None):
+    # With serial_suffix, in_path and out_path are directories and MotionCor2 runs every movie in in_path
     if scope == 1 or scope == 2:    
         cmd = [
         "/home/software/MotionCor2_1.4.5/MotionCor2",
-        "-InTiff", str(tiff_file), "-Gain", str(gain_out), "-OutMrc", str(mrc_file),
+        "-InTiff", str(in_path), "-Gain", str(gain_out), "-OutMrc", str(out_path),
         "-FtBin", str(args.binning), "-Patch", f"{args.patch} {args.patch}",
         "-FmDose", str(args.dose / frame_num), "-PixSize", str(args.pixel_size),
         "-kV", str(args.accel_kv), "-Gpu", str(gpu_id), "-Mag", str(args.mag1), str(args.mag2), str(args.mag3) 
@@ -98,13 +72,96 @@ def process_tiff_file(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_
         Eer_frac_path = motioncor2_dir / "fraction"
         cmd = [
         "/home/software/MotionCor2_1.6.4/MotionCor2_1.6.4_Cuda116_Mar312023",
-        "-InEer", str(tiff_file), "-Gain", str(gain_out), "-OutMrc", str(mrc_file),
+        "-InEer", str(in_path), "-Gain", str(gain_out), "-OutMrc", str(out_path),
         "-FtBin", str(args.binning), "-EerSampling", str(args.eer_sampling), "-FmIntFile", str(Eer_frac_path), "-Patch", f"{args.patch} {args.patch}",
         "-PixSize", str(args.pixel_size),
         "-kV", str(args.accel_kv), "-Gpu", str(gpu_id)
     ]
-    print(f"Run command: {' '.join(cmd)}")
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    if serial_suffix is not None:
+        # Directories must end in a slash: MotionCor2 uses them as file name prefixes
+        cmd[2] = os.path.join(str(in_path), "")
+        cmd[6] = os.path.join(str(out_path), "")
+        cmd += ["-InSuffix", serial_suffix, "-Serial", "1"]
+    return cmd
+
+def mrc_complete(path):
+    """ True once the MRC file holds all the data its header announces."""
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(1024)
+            size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return False
+    if len(header) < 1024:
+        return False
+    nx, ny, nz, mode = struct.unpack("<4i", header[:16])
+    (nsymbt,) = struct.unpack("<i", header[92:96])
+    if mode not in MRC_MODE_BYTES or min(nx, ny, nz) <= 0:
+        return False
+    return size >= 1024 + nsymbt + nx * ny * nz * MRC_MODE_BYTES[mode]
+
+def motioncor2_batch_key(job):
+    """ Movies with the same key can go through one serial MotionCor2 run."""
+    return (Path(job["tiff_file"]).suffix.lower(), job["frame_num"], str(job["gain_out"]), str(job["motioncor2_dir"]),
+            job["scope"], tuple(sorted((key, str(value)) for key, value in vars(job["args"]).items())))
+
+_serial_runs = itertools.count()   # staging directory names within this process
+
+def run_motioncor2_serial(jobs, gpu_id, on_aligned, poll_interval=0.5):
+    """ GPU stage for a batch: one MotionCor2 -Serial run over a staging directory of symlinks to the movies.
+
+    on_aligned(index, mrc_file) is called as each aligned micrograph appears, so
+    ctffind5 starts on it while MotionCor2 works on the next movie.
+    """
+    first = jobs[0]
+    args, motioncor2_dir, scope = first["args"], first["motioncor2_dir"], first["scope"]
+    suffix = Path(first["tiff_file"]).suffix
+    stage_dir = motioncor2_dir / ".serial" / f"{socket.gethostname()}-{os.getpid()}-{gpu_id}-{next(_serial_runs)}"
+    stage_dir.mkdir(parents=True)
+    journal = open_journal(getattr(args, "journal_dir", None))
+    mrc_files = []
+    for job in jobs:
+        tiff_file = Path(job["tiff_file"])
+        (stage_dir / tiff_file.name).symlink_to(tiff_file.resolve())
+        mrc_file = motioncor2_dir / (tiff_file.stem + ".mrc")
+        # A leftover micrograph from an earlier attempt would look finished at once
+        mrc_file.unlink(missing_ok=True)
+        mrc_files.append(mrc_file)
+    started = time.time()
+    if journal is not None:
+        for job in jobs:
+            journal.record(job["tiff_file"], "running", job.get("attempt"), started_at=started, gpu_id=physical_gpu(gpu_id),
+                           gpu_slots=getattr(args, "gpu_slots", 1))
+    cmd = motioncor2_cmd(stage_dir, motioncor2_dir, first["gain_out"], motioncor2_dir, args, first["frame_num"], gpu_id,
+                         scope, serial_suffix=suffix)
+    print(f"Run command ({len(jobs)} movie(s)): {' '.join(cmd)}")
+    waiting = list(range(len(jobs)))
+    try:
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        while waiting:
+            exited = process.poll() is not None
+            for index in [index for index in waiting if mrc_complete(mrc_files[index])]:
+                waiting.remove(index)
+                aligned = time.time()
+                if journal is not None:
+                    # Movies run one after the other, each from the end of the previous one
+                    journal.record(jobs[index]["tiff_file"], "running", jobs[index].get("attempt"), started_at=started,
+                                   aligned_at=aligned)
+                started = aligned
+                on_aligned(index, mrc_files[index])
+            if exited:
+                break
+            time.sleep(poll_interval)
+        process.wait()
+    finally:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+def run_ctffind5_and_stigma(tiff_file, mrc_file, ctffind5_dir, stigma_dir, args, scope, flag_dir, attempt=None):
+    # CPU stage: ctffind5 on the aligned micrograph, stigma correction and done flag
+    filename_without_extension = os.path.splitext(os.path.basename(tiff_file))[0]
+    inputfile = os.path.basename(tiff_file)
 
     # Run bash script for ctffind5
     freq_mrc_file = ctffind5_dir / (filename_without_extension + ".mrc")
@@ -128,43 +185,30 @@ def process_tiff_file(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_
     txt_file = ctffind5_dir / (filename_without_extension + ".txt")
     ctf_params = read_ctffind5_txt(txt_file)
 
-    
-    defocus_u = ctf_params['Defocus 1 [Angstroms]'].values[0]
-    defocus_v = ctf_params['Defocus 2 [Angstroms]'].values[0]
-    avg_defocus = (defocus_u + defocus_v) / 2
-
-    avg_defocus_s = "{:.1f}".format(avg_defocus)
-    defocus_u_s = "{:.1f}".format(defocus_u)
-    defocus_v_s = "{:.1f}".format(defocus_v)
-
-    delta_def = defocus_u - defocus_v
-    delta_def_s = "{:.1f}".format(delta_def)
-    stigma_angle = ctf_params['Azimuth of Astigmatism'].values[0]
-    stigma_angle_s = "{:.1f}".format(stigma_angle)
-    name_str = str(tiff_file)
-    ctf_res = ctf_params['CTF Rings Fit Spacing [Angstroms]'].values[0]
-    ctf_res_s = "{:.2f}".format(ctf_res)
-    if scope == 3:
-        num_tiff = name_str[-14:-8]
-    else:
-        num_tiff = name_str[-8:-4]
-    
-    if scope != 3:
-        new_stigma_y, new_stigma_x = calculate_stigma(defocus_u, defocus_v, stigma_angle, scope)
-    else:
-        new_stigma_x, new_stigma_y = calculate_stigma(defocus_u, defocus_v, stigma_angle, scope)
-        new_stigma_x = -1 * new_stigma_x
-        new_stigma_y = -1 * new_stigma_y
 
+    # Stigmator correction from the scope's calibration profile, written to a file named after the values
+    new_stigma_x, new_stigma_y = stigma_correction(ctf_params.defocus_1, ctf_params.defocus_2, ctf_params.astig_azimuth,
+                                                   SCOPE_CALIBRATION[scope])
+    stigma_file = write_stigma_file(stigma_dir, movie_number(filename_without_extension, scope), new_stigma_x, new_stigma_y,
+                                    ctf_params.avg_defocus, ctf_params.delta_defocus, ctf_params.astig_azimuth,
+                                    ctf_params.ctf_fit_resolution)
+    journal = open_journal(getattr(args, "journal_dir", None))
+    if journal is not None:
+        # Session ledger replaces the per-movie done flag
+        journal.record(tiff_file, "done", attempt, finished_at=time.time(),
+                       outputs={"mrc": str(mrc_file), "ctffind5": str(txt_file), "spectrum": str(freq_mrc_file),
+                                "avrot": str(ctffind5_dir / (filename_without_extension + "_avrot.txt")),
+                                "stigma": str(stigma_file)})
+    else:
+        #generate done flag
+        flag_file = flag_dir / f"{inputfile}.done"
+        Path(flag_file).touch()
 
-    # Write stigma result to file
-    stigma_file = stigma_dir / f"{num_tiff}_X{new_stigma_x}_Y{new_stigma_y}_{avg_defocus_s}_{delta_def_s}_{stigma_angle_s}_{ctf_res_s}.txt"
-    with open(stigma_file, 'w') as file:
-        file.write(f"# Columns: #1 - new stigma x; #2 - new stigma y\n")
-        file.write(f"{new_stigma_x} {new_stigma_y}\n")
-    #generate done flag
-    flag_file = flag_dir / f"{inputfile}.done"
-    Path(flag_file).touch()
+def record_failure(job, error):
+    journal = open_journal(getattr(job["args"], "journal_dir", None))
+    if journal is not None:
+        journal.record(job["tiff_file"], "failed", job.get("attempt"), finished_at=time.time(),
+                       error=f"{type(error).__name__}: {error}")
 
 def main(args):
     tiff_files = args.tiff_files
@@ -173,25 +217,184 @@ def main(args):
     motioncor2_dir = Path(args.motioncor2_dir)
     ctffind5_dir = Path(args.ctffind5_dir)
     stigma_dir = Path(args.stigma_dir)
-    frame_num = args.frame_num
+    # One frame count per movie; a single value applies to the whole chunk
+    frame_nums = args.frame_num
+    if len(frame_nums) == 1:
+        frame_nums = frame_nums * len(tiff_files)
+    assert len(frame_nums) == len(tiff_files), "--frame_num needs one value or one per tiff file"
+    # Attempt number of each movie, stamped on its journal events (absent from older watchers)
+    attempts = args.attempts or [None] * len(tiff_files)
+    assert len(attempts) == len(tiff_files), "--attempts needs one value per tiff file"
     scope = args.scope_id
     flag_dir = Path(args.flag_dir)
 
-    with multiprocessing.Pool(processes=4) as pool:
-        pool.starmap(
-            process_tiff_file,
-            [(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_dir, args, frame_num, gpu_id, scope, flag_dir)
-             for tiff_file, gpu_id in zip(tiff_files, range(len(tiff_files)))]
-        )
+    # Chunks may hold any number of movies; each goes to whichever GPU frees up first.
+    # Retries list the GPUs the movie already failed on.
+    gpu_ids = worker_gpus(args.num_gpus)
+    avoid = avoided_gpus(args.avoid, gpu_ids)
+    pipeline = make_pipeline(args.cpu_workers, gpu_ids, args.gpu_slots, args.gpu_mem, args.serial_batch)
+    futures = []
+    for tiff_file, frame_num, attempt in zip(tiff_files, frame_nums, attempts):
+        job = dict(tiff_file=tiff_file, frame_num=frame_num, gain_out=gain_out, motioncor2_dir=motioncor2_dir,
+                   ctffind5_dir=ctffind5_dir, stigma_dir=stigma_dir, args=args, scope=scope, flag_dir=flag_dir, attempt=attempt)
+        futures.append((job, pipeline.submit(job, avoid=avoid)))
+    try:
+        for job, future in futures:
+            error = future.exception()
+            if error is not None:
+                record_failure(job, error)
+        for job, future in futures:
+            future.result()
+    finally:
+        pipeline.close()
+        print(pipeline.stats())
+
+def worker_gpus(num_gpus=None):
+    """ GPU ids for MotionCor2, discovered from the environment; only the first num_gpus if given."""
+    gpu_ids = discover_gpus()
+    if num_gpus is None:
+        return gpu_ids
+    # SLURM_JOB_GPUS names the allocated devices themselves, so take them rather than 0..num_gpus-1
+    return gpu_ids[:num_gpus] if len(gpu_ids) >= num_gpus else list(range(num_gpus))
+
+def motioncor2_footprint(job):
+    """ Estimated MB of GPU memory MotionCor2 needs for a movie; None when its header cannot be read."""
+    try:
+        layout = read_image_layout(job["tiff_file"])
+    except (OSError, KeyError, TiffHeaderError):
+        return None
+    pixels = layout["width"] * layout["height"]
+    frames = job["frame_num"]
+    if job["scope"] == 3:
+        # EER frames are rendered at the sampling resolution and summed into fractions
+        pixels *= job["args"].eer_sampling ** 2
+        frames = math.ceil(frames / job["args"].eer_fraction)
+    return (frames * pixels * 2 + MOTIONCOR2_FRAME_BUFFERS * pixels * 4) / 2**20 + MOTIONCOR2_CONTEXT_MB
+
+def make_pipeline(cpu_workers, gpu_ids, gpu_slots=1, gpu_mem=None, serial_batch=1):
+    """ GPU slots run only MotionCor2; ctffind5 + stigma run on a separate CPU pool.
+
+    Several slots per GPU share its memory (gpu_mem MB each, default from nvidia-smi).
+    With serial_batch > 1 a slot runs up to that many waiting movies through one
+    MotionCor2 -Serial run.
+    """
+    def gpu_stage(job, gpu_id):
+        return run_motioncor2(job["tiff_file"], job["gain_out"], job["motioncor2_dir"], job["args"], job["frame_num"], gpu_id, job["scope"],
+                              job.get("attempt"))
+
+    def cpu_stage(job, mrc_file):
+        run_ctffind5_and_stigma(job["tiff_file"], mrc_file, job["ctffind5_dir"], job["stigma_dir"], job["args"], job["scope"], job["flag_dir"],
+                                job.get("attempt"))
+
+    memory = None
+    if gpu_slots > 1:
+        memory = {gpu_id: gpu_mem for gpu_id in gpu_ids} if gpu_mem else gpu_memory(gpu_ids)
+        if memory is None:
+            print(f"GPU memory unknown, running {gpu_slots} MotionCor2 slots per GPU without memory admission")
+    return GpuCpuPipeline(gpu_stage, cpu_stage, gpu_ids, cpu_workers=cpu_workers, cpu_backlog=2 * cpu_workers,
+                          slots_per_gpu=gpu_slots, memory=memory, footprint=motioncor2_footprint if memory else None,
+                          gpu_batch_stage=run_motioncor2_serial if serial_batch > 1 else None, batch_size=serial_batch,
+                          batch_key=motioncor2_batch_key)
+
+def task_job(task):
+    """ Pipeline job for one spooled movie. 'task' holds the same options as the command line."""
+    args = argparse.Namespace(**task["args"])
+    return dict(tiff_file=Path(task["tiff_file"]), frame_num=task["frame_num"], gain_out=Path(args.gain_out),
+                motioncor2_dir=Path(args.motioncor2_dir), ctffind5_dir=Path(args.ctffind5_dir),
+                stigma_dir=Path(args.stigma_dir), args=args, scope=args.scope_id, flag_dir=Path(args.flag_dir),
+                attempt=task.get("attempt"))
+
+def serve(spool_dir, num_gpus=None, idle_exit=1800, cpu_workers=4, stats_interval=60, avoid_grace=60, live_share=0.5,
+          gpu_slots=1, gpu_mem=None, serial_batch=1):
+    """ Persistent worker: keep the node and pull movies from the spool whenever a GPU slot is free."""
+    owner = owner_name()
+    init_spool(spool_dir)
+    requeued = requeue_stale(spool_dir)
+    if requeued:
+        print(f"Requeued {requeued} task(s) left by dead workers")
+    gpu_ids = worker_gpus(num_gpus)
+    print(f"Worker {owner} serving {spool_dir} on GPU(s) {','.join(map(str, gpu_ids))} ({gpu_slots} slot(s) each), "
+          f"{cpu_workers} CPU worker(s)")
+
+    # inotify wakes us as soon as a task lands, scandir fallback covers NFS
+    watcher = MovieWatcher(Path(spool_dir) / "new", suffixes=(".json",), fallback_interval=0.2)
+    running = {}
+    lanes = LaneShare(live_share)   # live tasks first, but backfill keeps its share of the GPUs
+    last_work = time.monotonic()
+    last_stats = time.monotonic()
+    # The lease lets workers and watchers on other hosts requeue our tasks if this node dies
+    renew_lease(spool_dir, owner)
+    last_lease = time.monotonic()
+    def accept(task):
+        # A retry that failed on every GPU here is left for another worker for a while
+        if task.get("avoid") and avoided_gpus(task["avoid"], gpu_ids) >= set(gpu_ids):
+            return time.time() - task.get("queued_at", 0) > avoid_grace
+        return True
+
+    with make_pipeline(cpu_workers, gpu_ids, gpu_slots, gpu_mem, serial_batch) as pipeline:
+        while True:
+            for task_path, (job, future) in list(running.items()):
+                if not future.done():
+                    continue
+                error = future.exception()
+                if error is not None:
+                    print(f"Task {task_path.name} failed: {error}")
+                    record_failure(job, error)
+                finish_task(task_path, error is None)
+                del running[task_path]
+                last_work = time.monotonic()
+
+            for gpu_id in pipeline.idle_gpus():
+                claimed = claim_task(spool_dir, owner, accept, prefer=lane_prefix(lanes.preferred()))
+                if claimed is None:
+                    break
+                task_path, task = claimed
+                lanes.claimed(task.get("lane"))
+                job = task_job(task)
+                job["args"].gpu_slots = gpu_slots
+                avoid = avoided_gpus(task.get("avoid"), gpu_ids)
+                if gpu_id in avoid:
+                    # Failed on this GPU before: let another GPU of the node take it
+                    running[task_path] = (job, pipeline.submit(job, avoid=avoid))
+                else:
+                    running[task_path] = (job, pipeline.submit(job, gpu_id))
+                last_work = time.monotonic()
+
+            if time.monotonic() - last_lease > LEASE_INTERVAL:
+                renew_lease(spool_dir, owner)
+                last_lease = time.monotonic()
+
+            if time.monotonic() - last_stats > stats_interval:
+                print(pipeline.stats())
+                last_stats = time.monotonic()
+
+            if not running:
+                if stop_requested(spool_dir) and pending_count(spool_dir) == 0:
+                    print("Watcher finished, worker exiting")
+                    break
+                if time.monotonic() - last_work > idle_exit:
+                    print(f"No task for {idle_exit}s, worker exiting")
+                    break
+            watcher.poll(timeout=0.1 if running else 5)
+        print(pipeline.stats())
+    watcher.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument('--tiff_files', nargs='+', help='List of tiff files to process', required=True)
-    parser.add_argument('--gain_out', type=str, help='Gain reference output path', required=True)
-    parser.add_argument('--binning', type=int, default=1, help='Binning factor', required=True)
+    parser.add_argument('--serve', type=str, default=None, help='Run as a persistent worker pulling tasks from this spool directory')
+    parser.add_argument('--num_gpus', type=int, default=None, help='Number of GPUs to use (default: discovered from CUDA_VISIBLE_DEVICES / SLURM / nvidia-smi)')
+    parser.add_argument('--idle_exit', type=float, default=1800, help='Seconds without tasks before a persistent worker exits')
+    parser.add_argument('--cpu_workers', type=int, default=4, help='Concurrent ctffind5/stigma jobs fed by the GPU slots')
+    parser.add_argument('--live_share', type=float, default=0.5, help='Share of GPU slots live-lane tasks get while backfill tasks are waiting')
+    parser.add_argument('--gpu_slots', type=int, default=1, help='Concurrent MotionCor2 runs per GPU, as far as GPU memory allows')
+    parser.add_argument('--gpu_mem', type=float, default=None, help='MB of GPU memory per GPU for the slots (default: 90%% of nvidia-smi memory.total)')
+    parser.add_argument('--serial_batch', type=int, default=1, help='Waiting movies one GPU slot runs through a single MotionCor2 -Serial run (1: one run per movie)')
+    parser.add_argument('--tiff_files', nargs='+', help='List of tiff files to process')
+    parser.add_argument('--gain_out', type=str, help='Gain reference output path')
+    parser.add_argument('--binning', type=int, default=1, help='Binning factor')
     parser.add_argument('--patch', type=int, default=5, help='Patch size')
-    parser.add_argument('--dose', type=float, help='Dose per frame', required=True)
-    parser.add_argument('--pixel_size', type=float, help='Pixel size', required=True)
+    parser.add_argument('--dose', type=float, help='Dose per frame')
+    parser.add_argument('--pixel_size', type=float, help='Pixel size')
     parser.add_argument('--accel_kv', type=float, default=300, help='Acceleration voltage in kV')
     parser.add_argument('--cs_mm', type=float, default=2.7, help='Spherical aberration in mm')
     parser.add_argument('--amp_contrast', type=float, default=0.07, help='Amplitude contrast')
@@ -201,12 +404,15 @@ if __name__ == "__main__":
     parser.add_argument('--min_defocus', type=float, default=5000.0, help='Minimum defocus')
     parser.add_argument('--max_defocus', type=float, default=50000.0, help='Maximum defocus')
     parser.add_argument('--defocus_step', type=float, default=100.0, help='Defocus step')
-    parser.add_argument('--frame_num', type=int, help='Number of frames in the movie', required=True)
-    parser.add_argument('--motioncor2_dir', type=str, help='Directory for MotionCor2 output', required=True)
-    parser.add_argument('--ctffind5_dir', type=str, help='Directory for ctffind5 output', required=True)
-    parser.add_argument('--stigma_dir', type=str, help='Directory for stigma output', required=True)
-    parser.add_argument('--scope_id', type=int, help='BioEM facility microscope number', required=True)
-    parser.add_argument('--flag_dir', type=str, help='Directory for done-flag', required=True)
+    parser.add_argument('--frame_num', type=int, nargs='+', help='Number of frames in each movie (one value, or one per tiff file)')
+    parser.add_argument('--motioncor2_dir', type=str, help='Directory for MotionCor2 output')
+    parser.add_argument('--ctffind5_dir', type=str, help='Directory for ctffind5 output')
+    parser.add_argument('--stigma_dir', type=str, help='Directory for stigma output')
+    parser.add_argument('--scope_id', type=int, help='BioEM facility microscope number')
+    parser.add_argument('--flag_dir', type=str, help='Directory for done-flag')
+    parser.add_argument('--journal_dir', type=str, default=None, help='Session ledger journal directory; replaces done-flags when given')
+    parser.add_argument('--attempts', type=int, nargs='+', default=None, help='Attempt number of each tiff file, stamped on its journal events')
+    parser.add_argument('--avoid', type=str, nargs='*', default=[], help='host:gpu places where these movies failed before (retries)')
 
     parser.add_argument("-esamp", "--eer_sampling", type=float, default=2, help="EER sampling mode for MotionCor2")
     parser.add_argument("-efrac", "--eer_fraction", type=float, default=40, help="EER Fractionation for MotionCor2")
@@ -216,4 +422,13 @@ if __name__ == "__main__":
     parser.add_argument("-m3", "--mag3", type=str, default="0", help="Distort_ang for MotionCor2 < 1.6.4")
 
     args = parser.parse_args()
-    main(args)
+    if args.serve is not None:
+        serve(args.serve, args.num_gpus, args.idle_exit, args.cpu_workers, live_share=args.live_share,
+              gpu_slots=args.gpu_slots, gpu_mem=args.gpu_mem, serial_batch=args.serial_batch)
+    else:
+        # Per-chunk mode: everything describing the chunk is required
+        required = ['tiff_files', 'gain_out', 'dose', 'pixel_size', 'frame_num', 'motioncor2_dir', 'ctffind5_dir', 'stigma_dir', 'scope_id', 'flag_dir']
+        missing = [name for name in required if getattr(args, name) is None]
+        if missing:
+            parser.error(f"the following arguments are required: {', '.join('--' + name for name in missing)}")
+        main(args)
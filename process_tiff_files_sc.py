@@ -3,10 +3,9 @@ import os
 import subprocess
 import argparse
 from pathlib import Path
-import multiprocessing
-import pandas as pd
-import io
-import math
+from ctffind_results import read_ctffind5_txt
+from stigma import WORKER_CALIBRATION, stigma_correction
+from pipeline import run_on_gpus, discover_gpus
 os.environ['PATH'] += '/home/software/cuda-12.6.2/bin'
 
 ld_library_path = os.environ.get('LD_LIBRARY_PATH', '')
@@ -17,67 +16,7 @@ os.environ['PATH'] += ':/usr/local/bin:/home/software/ctffind-5.0.2'
 
 TEMPLATE_BASH_SCRIPT = Path("/home/pp/code/template.sh")
 
-CTFFIND5_COLUMNS = ['Micrograph Number', 'Defocus 1 [Angstroms]', 'Defocus 2 [Angstroms]', 'Azimuth of Astigmatism',
-    'Additional Phase Shift [Radians]', 'Cross Correlation', 'CTF Rings Fit Spacing [Angstroms]',
-    'Estimated Tilt Axis Angle', 'Estimated Tilt Angle', 'Estimated Sample Thickness [Angstroms]']
-
-def read_ctffind5_txt(txt_file):
-    data_lines = []
-    with open(txt_file, 'r') as file:
-        for line in file:
-            line = line.strip()
-            if not line.startswith('#') and line:  # 跳过以#开头的注释行和空行
-                data_lines.append(line)
-    data = data_lines[-1]
-    df = pd.read_csv(io.StringIO(data), delim_whitespace=True, header=None, names=CTFFIND5_COLUMNS)
-    return df 
-
-def calculate_stigma(defocus_u, defocus_v, stigma_angle, scope, obj_stigma_x=0, obj_stigma_y=0):
-    # Constants from the original Perl script
-    if scope == 1:    
-        x_TEMstigma_step = 38.01
-        y_TEMstigma_step = 36.81
-        y_TEMstigma_angle = -23.61
-        x_TEMstigma_angle = -68.67
-    elif scope == 2:
-        x_TEMstigma_step = 37.01
-        y_TEMstigma_step = 35.58
-        x_TEMstigma_angle = 63.98
-        y_TEMstigma_angle = 19.06
-    elif scope == 3:
-        x_TEMstigma_step = 37.01
-        y_TEMstigma_step = 35.58
-        x_TEMstigma_angle = -19.06
-        y_TEMstigma_angle = -63.98
-
-      
-    # Calculations for Lx
-    x_angle_diff = x_TEMstigma_angle - stigma_angle
-    kx1 = math.sin(math.radians(x_angle_diff)) / math.cos(math.radians(x_angle_diff))
-    x_angle_diff += 90
-    kx2 = math.sin(math.radians(x_angle_diff)) / math.cos(math.radians(x_angle_diff))
-
-    Lx_sub1 = math.sqrt((kx1 * kx1 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * kx1 * kx1))
-    Lx_sub2 = math.sqrt((kx2 * kx2 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * kx2 * kx2))
-    Lx = 0.0001 * defocus_u * defocus_v * (Lx_sub1 - Lx_sub2) / x_TEMstigma_step
-
-    # Calculations for Ly
-    y_angle_diff = y_TEMstigma_angle - stigma_angle
-    ky1 = math.sin(math.radians(y_angle_diff)) / math.cos(math.radians(y_angle_diff))
-    y_angle_diff += 90
-    ky2 = math.sin(math.radians(y_angle_diff)) / math.cos(math.radians(y_angle_diff))
-
-    Ly_sub1 = math.sqrt((ky1 * ky1 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * ky1 * ky1))
-    Ly_sub2 = math.sqrt((ky2 * ky2 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * ky2 * ky2))
-    Ly = 0.0001 * defocus_u * defocus_v * (Ly_sub1 - Ly_sub2) / y_TEMstigma_step
-
-    # Calculate new stigma values
-    new_stigma_x = obj_stigma_x + Lx
-    new_stigma_x = -1 * new_stigma_x
-    new_stigma_y = obj_stigma_y + Ly
-    new_stigma_y = -1 * new_stigma_y
-
-    return "{:.5f}".format(new_stigma_x), "{:.5f}".format(new_stigma_y)
+STIGMA_CALIBRATION = WORKER_CALIBRATION["sc"]
 
 def process_tiff_file(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_dir, args, frame_num, gpu_id, scope, flag_dir):
     filename_without_extension = os.path.splitext(os.path.basename(tiff_file))[0]
@@ -124,18 +63,20 @@ def process_tiff_file(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_
     ctf_params = read_ctffind5_txt(txt_file)
 
     
-    defocus_u = ctf_params['Defocus 1 [Angstroms]'].values[0]
-    defocus_v = ctf_params['Defocus 2 [Angstroms]'].values[0]
+    defocus_u = ctf_params.defocus_1
+    defocus_v = ctf_params.defocus_2
     defocus_u_s = "{:.1f}".format(defocus_u)
     defocus_v_s = "{:.1f}".format(defocus_v)
     delta_def = defocus_u - defocus_v
     delta_def_s = "{:.1f}".format(delta_def)
-    stigma_angle = ctf_params['Azimuth of Astigmatism'].values[0]
+    stigma_angle = ctf_params.astig_azimuth
     stigma_angle_s = "{:.1f}".format(stigma_angle)
     name_str = str(tiff_file)
     num_tiff = name_str[-8:-4]
     
-    new_stigma_y, new_stigma_x = calculate_stigma(defocus_u, defocus_v, stigma_angle, scope)
+    # Stigmator correction with this variant's calibration conventions (stigma.py)
+    new_stigma_x, new_stigma_y = ("{:.5f}".format(value) for value in
+                                  stigma_correction(defocus_u, defocus_v, stigma_angle, STIGMA_CALIBRATION[scope]))
 
 
 
@@ -159,12 +100,10 @@ def main(args):
     scope = args.scope_id
     flag_dir = Path(args.flag_dir)
 
-    with multiprocessing.Pool(processes=4) as pool:
-        pool.starmap(
-            process_tiff_file,
-            [(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_dir, args, frame_num, gpu_id, scope, flag_dir)
-             for tiff_file, gpu_id in zip(tiff_files, range(len(tiff_files)))]
-        )
+    # Each movie goes to whichever GPU frees up first; chunks may be longer than the number of GPUs
+    run_on_gpus(lambda tiff_file, gpu_id: process_tiff_file(tiff_file, gain_out, motioncor2_dir, ctffind5_dir, stigma_dir,
+                                                            args, frame_num, gpu_id, scope, flag_dir),
+                tiff_files, discover_gpus())
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -0,0 +1,58 @@
+import time
+
+### Retry policy for movies whose worker reported a failure.
+###
+### Only the failed movie is resubmitted, after an exponential backoff, and at
+### most max_attempts times in total. Each retry carries the "host:gpu" places of
+### the earlier failures, so workers run it on another GPU (and with
+### --retry_exclude_nodes SLURM puts it on another node).
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=3, backoff=30.0, factor=2.0, max_backoff=600.0):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+
+    def should_retry(self, attempts):
+        return attempts < self.max_attempts
+
+    def delay(self, attempts):
+        """ Seconds to wait before attempt number attempts + 1."""
+        return min(self.max_backoff, self.backoff * self.factor ** max(0, attempts - 1))
+
+
+class RetryQueue:
+    """ Failed movies waiting for their backoff to expire."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self._waiting = {}      # movie -> (due time, frame_num, attempts, avoid)
+
+    def schedule(self, movie, frame_num, attempts, avoid=(), now=None):
+        """ Queue a retry. Returns the delay, or None when the movie used up its attempts."""
+        if not self.policy.should_retry(attempts):
+            self._waiting.pop(movie, None)
+            return None
+        now = time.monotonic() if now is None else now
+        delay = self.policy.delay(attempts)
+        self._waiting[movie] = (now + delay, frame_num, attempts, sorted(set(avoid)))
+        return delay
+
+    def due(self, now=None):
+        """ Pop the retries whose backoff has expired: [(movie, frame_num, attempts, avoid)]."""
+        now = time.monotonic() if now is None else now
+        ready = [(movie, entry) for movie, entry in self._waiting.items() if entry[0] <= now]
+        for movie, _entry in ready:
+            del self._waiting[movie]
+        return [(movie, frame_num, attempts, avoid) for movie, (_due, frame_num, attempts, avoid) in sorted(ready)]
+
+    def next_in(self, default):
+        """ Seconds until the next retry is due, at most 'default'."""
+        if not self._waiting:
+            return default
+        return max(0.0, min(default, min(entry[0] for entry in self._waiting.values()) - time.monotonic()))
+
+    def __len__(self):
+        return len(self._waiting)
@@ -10,10 +10,33 @@ import io
 import math
 from concurrent.futures import ProcessPoolExecutor
 import time
-import tifffile
 import pwd 
 import grp
 import shutil
+import shlex
+import queue
+import json
+from movie_watcher import MovieWatcher, MOVIE_SUFFIXES
+from stability import StabilityTracker
+from tiff_header import count_frames, get_frame_counts, is_complete
+from batching import BatchPolicy, BATCH_MODES
+from slurm_backend import ArraySubmitter, SBATCH_CMD, SQUEUE_CMD, SACCT_CMD, LIVE_STATES, PACKINGS, GPUS_PER_NODE, sbatch, parse_command, resource_args
+from ledger import Ledger, ledger_paths
+from archive import Archiver
+from permissions import PermissionEngine
+from gain import convert_gain, GAIN_CACHE_DIR
+from executors import EXECUTORS, SlurmArrayExecutor, SpoolExecutor, LocalExecutor
+from retry import RetryPolicy, RetryQueue
+from lanes import LANES, LanePolicy, LatencyStats
+from throttle import SubmissionThrottle
+from costmodel import CostModel, similar_cost, backlog_eta, slot_report
+
+WORKER_PYTHON = "/home/pp/conda/pp-1.0/bin/python"
+WORKER_SCRIPT = "/home/peiyuan/code/pp/process_tiff_files_long_stigma_corrected_with3.py"
+# sudo clears the environment; on a shared node the worker must only see the GPUs SLURM gave its job
+SUDO_SHARED_NODE = "sudo --preserve-env=CUDA_VISIBLE_DEVICES,SLURM_JOB_GPUS"
+# --executor local runs on a workstation: the worker next to this script, with this interpreter
+LOCAL_WORKER_SCRIPT = Path(__file__).resolve().with_name("process_tiff_files_long_stigma_corrected_with3.py")
 
 Mag_distort_mapping = {
     1: {
@@ -61,27 +84,6 @@ def get_distortion_params(scope, pixel_size):
         params = {"major_scale": 1.000, "minor_scale": 1.000, "distort_ang": 0.0}
     return params
 
-def is_file_stable(filepath, wait_time=0.5, check_interval=0.1):
-    """ Check if a file size remains constant over 'wait_time' seconds."""
-    previous_size = -1
-    stable_time = 0
-    while stable_time < wait_time:
-        current_size = filepath.stat().st_size
-        if current_size == previous_size:
-            stable_time += check_interval
-        else:
-            stable_time = 0
-            previous_size = current_size
-        time.sleep(check_interval)
-    return True
-
-def check_all_files_stable(tiff_files_chunk):
-    # 检查所有文件是否稳定
-    for file in tiff_files_chunk:
-        if not is_file_stable(file):
-            return False
-    return True
-
 MATCH_LIST = ["*.tif", "*.tiff"]
 
 def add_args(parser):
@@ -90,6 +92,7 @@ def add_args(parser):
     parser.add_argument('--input', type=str, default=None, help='Input directory contains .tif / .tiff')
     parser.add_argument('--gain', type=str, default=None, help="Gain reference file in dm4 format")
     parser.add_argument('-o','--output', type=str, default=None, help='Output directory')
+    parser.add_argument('--gain_cache', type=str, default=GAIN_CACHE_DIR, help="Shared cache of converted gain references ('' to disable)")
     
     # optics parameters
     parser.add_argument("-p", "--pixel_size", type=float, default=1, help="Pixel size in Angstrom")
@@ -116,331 +119,769 @@ def add_args(parser):
     parser.add_argument('-m', action='store_true', help='Apply magnification distortion')
 
     parser.add_argument("-sc", "--scope_num", type=int, help="BioEM facility microscope number")
-    return parser
 
-def get_tif_frame_count(tif_path):
-    with tifffile.TiffFile(tif_path) as tif:
-        return len(tif.pages)
-
-def recursive_chown_and_acl(path, uid, gid):
-    # 首先更改当前目录的所有权，并为用户添加 ACL 权限
-    os.chown(path, uid, gid)
-    subprocess.run(["setfacl", "-m", f"user:cryosparc-user:rwx", path], check=True)
-
-    # 遍历目录中的所有文件和子目录
-    for root, dirs, files in os.walk(path, topdown=True):
-        # 更改所有子目录的所有权，并为用户添加 ACL 权限
-        for dir_name in dirs:
-            dir_path = os.path.join(root, dir_name)
-            os.chown(dir_path, uid, gid)
-            subprocess.run(["setfacl", "-m", f"user:cryosparc-user:rwx", dir_path], check=True)
-        
-        # 更改所有文件的所有权，并为用户添加 ACL 权限
-        for file_name in files:
-            file_path = os.path.join(root, file_name)
-            os.chown(file_path, uid, gid)
-            subprocess.run(["setfacl", "-m", f"user:cryosparc-user:rwx", file_path], check=True)
-
-def submit_to_slurm(job_script):
-    cmd = ["sudo -u pp sbatch", job_script]
-    ### Submit job to slurm as user "pp" (Running this python script with sudo counts as running it as root, and root cannot submit jobs.)
-    subprocess.run(['sudo', '-u', 'pp', 'sbatch', job_script], check=True)
+    # execution backend
+    parser.add_argument("--executor", type=str, choices=EXECUTORS, default=None, help="slurm: job array per chunk; spool: persistent SLURM workers (--spool); local: worker processes on this machine's GPUs (default: spool if --spool is given, else slurm)")
+    parser.add_argument("--local_gpus", type=str, default=os.environ.get("CUDA_VISIBLE_DEVICES", "0,1,2,3"), help="Comma-separated GPU ids for --executor local")
+    parser.add_argument("--local_cpu_workers", type=int, default=2, help="ctffind5/stigma jobs per local worker process")
+
+    # persistent workers
+    parser.add_argument("--spool", type=str, default=None, help="Spool directory for persistent GPU workers; movies are queued there instead of one sbatch per chunk")
+    parser.add_argument("--workers", type=int, default=1, help="Number of persistent worker jobs to start with --spool (one node each, or one GPU each with --packing gpu)")
+
+    # node packing
+    parser.add_argument("--packing", type=str, choices=PACKINGS, default="node", help="node: every job takes a whole 4-GPU node; chunk: one GPU per movie of a chunk, node shared; gpu: single-GPU array tasks that SLURM packs onto shared nodes")
+    parser.add_argument("--cpus_per_gpu", type=int, default=2, help="CPUs (and concurrent ctffind5/stigma jobs) requested per GPU on shared nodes")
+
+    # slurm submission
+    parser.add_argument("--sbatch", type=str, default=" ".join(SBATCH_CMD), help="sbatch command, e.g. 'python slurm_stub.py sbatch' to test without a cluster")
+    parser.add_argument("--array_window", type=float, default=2.0, help="Seconds to collect ready chunks into one job array")
+    parser.add_argument("--squeue", type=str, default=" ".join(SQUEUE_CMD), help="squeue command used to adopt running jobs after a restart")
+    parser.add_argument("--sacct", type=str, default=" ".join(SACCT_CMD), help="sacct command used to find jobs that ended while the watcher was down")
+
+    # batching
+    parser.add_argument("--batch_mode", type=str, choices=BATCH_MODES, default="latency", help="latency: one movie per GPU per job, flush quickly; throughput: bigger jobs during a backlog")
+    parser.add_argument("--target_latency", type=float, default=None, help="Seconds a ready movie may wait for a partial chunk to fill (default 10 for latency, 120 for throughput)")
+    parser.add_argument("--gpus", type=int, default=None, help="GPUs available to this session (default 4 per SLURM node/worker, or the number of --local_gpus)")
+    parser.add_argument("--gpu_slots", type=int, default=1, help="Concurrent MotionCor2 runs per GPU, as far as the worker finds GPU memory for them")
+    parser.add_argument("--serial_batch", type=int, default=1, help="Waiting movies a GPU slot runs through one MotionCor2 -Serial run, their ctffind5 starting as each is aligned (1: off)")
+
+    # live / backfill lanes
+    parser.add_argument("--live_share", type=float, default=0.5, help="Share of GPUs for the newest movies (live lane) while a backlog is waiting")
+    parser.add_argument("--live_window", type=float, default=120, help="Movies acquired within this many seconds go to the live lane, older ones to backfill")
+    parser.add_argument("--backfill_nice", type=int, default=100, help="sbatch --nice of backfill job arrays (0: same priority as live)")
+
+    # backpressure: ready movies beyond this stay here, where batching and lanes still apply
+    parser.add_argument("--max_queued_jobs", type=int, default=8, help="Hold ready movies back while this many jobs are pending on the partition (or tasks waiting in the spool)")
+    parser.add_argument("--reconcile_interval", type=float, default=60, help="Seconds between checks for in-flight movies whose job ended without reporting them (node crash, OOM, time limit, scancel)")
+    parser.add_argument("--queue_lookahead", type=float, default=60, help="Seconds of work, at the observed throughput, handed to the executor beyond one movie per GPU")
+
+    # raw movie archiving (with --output)
+    parser.add_argument("--archive_workers", type=int, default=2, help="Parallel copies of raw movies to the output directory")
+    parser.add_argument("--archive_mbps", type=float, default=0, help="Total archive bandwidth limit in MB/s (0: unlimited)")
+    parser.add_argument("--archive_no_verify", action='store_true', help="Skip the checksum verification of archived movies")
+
+    # failed movies
+    parser.add_argument("--max_attempts", type=int, default=3, help="Attempts per movie, including the first; failed movies are resubmitted alone")
+    parser.add_argument("--retry_backoff", type=float, default=30, help="Seconds before the first retry, doubled for each further one")
+    parser.add_argument("--retry_exclude_nodes", action='store_true', help="Keep SLURM retries off the nodes the movie failed on (sbatch --exclude)")
+    return parser
 
+def split_readable(tiff_files_chunk, tracker, processed_files, unreadable_attempts, ledger, max_attempts=5):
+    """ Split a chunk into movies with a readable frame count and their counts.
+
+    Movies whose header cannot be read yet are handed back to the stability tracker;
+    after max_attempts they are marked failed in the ledger and left alone.
+    """
+    frame_nums = get_frame_counts(tiff_files_chunk)
+    retry, corrupt = [], []
+    for f, n in zip(tiff_files_chunk, frame_nums):
+        if n > 0:
+            unreadable_attempts.pop(f, None)
+            continue
+        unreadable_attempts[f] = unreadable_attempts.get(f, 0) + 1
+        (corrupt if unreadable_attempts[f] >= max_attempts else retry).append(f)
+    if retry:
+        print(f"Cannot read frame count of {','.join(f.name for f in retry)}, will retry")
+        processed_files.difference_update(retry)
+        tracker.add(retry)
+    if corrupt:
+        print(f"Cannot read frame count of {','.join(f.name for f in corrupt)} after {max_attempts} attempts, giving up")
+        for f in corrupt:
+            del unreadable_attempts[f]
+        ledger.mark(corrupt, "failed", finished_at=time.time(), error="frame count unreadable")
+    readable = [(f, n) for f, n in zip(tiff_files_chunk, frame_nums) if n > 0]
+    return [f for f, _ in readable], [n for _, n in readable]
+
+def reconcile_in_flight(ledger, executor, ingest=None):
+    """ Match the movies the ledger has in flight with the executor's jobs, after a restart.
+
+    Returns (adopted, lost, unsubmitted) ledger rows: movies whose job is still
+    queued or running (or cannot be checked), movies whose job ended without
+    reporting them, as (row, job state), and movies that never got a job id.
+    Job states are taken before ingest() reads the journals, so a job that ends
+    in between has its result applied instead of being taken for lost; job ids
+    of another executor count as lost ('UNKNOWN').
+    """
+    job_ids = {row["job_id"] for row in ledger.rows("submitted", "running") if row["job_id"] is not None}
+    try:
+        states = executor.job_states(sorted(job_ids))
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Cannot query job states ({e}), adopting {len(job_ids)} job(s) unchecked")
+        states = None
+    if ingest is not None:
+        ingest()
+    adopted, lost, unsubmitted = [], [], []
+    for row in ledger.rows("submitted", "running"):
+        if row["job_id"] is None:
+            unsubmitted.append(row)
+            continue
+        # Jobs submitted after the snapshot are too new to judge
+        if states is None or row["job_id"] not in job_ids:
+            adopted.append(row)
+            continue
+        state = states.get(row["job_id"], "UNKNOWN")
+        if state in LIVE_STATES:
+            adopted.append(row)
+        else:
+            lost.append((row, state))
+    return adopted, lost, unsubmitted
 
-def create_slurm_script(script_path, project_name, tiff_files_chunk, gain_out, args, frame_num, motioncor2_dir, ctffind5_dir, stigma_dir, flag_dir, scope, nums,major_scale,minor_scale,distort_ang):
+def submit_to_slurm(job_script, sbatch_cmd=SBATCH_CMD):
+    ### Submit job to slurm as user "pp" (Running this python script with sudo counts as running it as root, and root cannot submit jobs.)
+    return sbatch(job_script, sbatch_cmd)
+
+def worker_args(tiff_files_chunk, gain_out, args, frame_nums, motioncor2_dir, ctffind5_dir, stigma_dir, flag_dir, journal_dir, scope, major_scale, minor_scale, distort_ang, avoid=(), attempts=None):
+    # Worker command line for one chunk; retries also list where the movie failed before.
+    # The attempt numbers come back on the journal events, so reports of an earlier attempt are told apart
+    avoid_args = ["--avoid", *avoid] if avoid else []
+    attempt_args = ["--attempts", *map(str, attempts)] if attempts and None not in attempts else []
+    return ["--tiff_files", *map(str, tiff_files_chunk), "--gain_out", str(gain_out),
+            "--binning", str(args.binning), "--patch", str(args.patch), "--dose", str(args.dose), "--pixel_size", str(args.pixel_size),
+            "--mag1", str(major_scale), "--mag2", str(minor_scale), "--mag3", str(distort_ang),
+            "--accel_kv", str(args.accel_kv), "--cs_mm", str(args.cs_mm), "--amp_contrast", str(args.amp_contrast),
+            "--spectrum_size", str(args.spectrum_size), "--eer_fraction", str(args.eer_fraction),
+            "--min_res", str(args.min_res), "--max_res", str(args.max_res), "--min_defocus", str(args.min_defocus),
+            "--max_defocus", str(args.max_defocus), "--flag_dir", str(flag_dir), "--eer_sampling", str(args.eer_sampling),
+            "--defocus_step", str(args.defocus_step), "--frame_num", *map(str, frame_nums),
+            "--motioncor2_dir", str(motioncor2_dir), "--ctffind5_dir", str(ctffind5_dir), "--stigma_dir", str(stigma_dir),
+            "--scope_id", str(scope), "--journal_dir", str(journal_dir), "--gpu_slots", str(args.gpu_slots),
+            "--serial_batch", str(args.serial_batch), *attempt_args, *avoid_args]
+
+def create_slurm_script(script_path, job_name, manifest_path, exclusive=True):
+    # Job array script: task N runs the worker with line N+1 of the manifest.
+    # Without 'exclusive' the GPUs of each task come from the sbatch command line (--packing),
+    # and the task arguments carry --num_gpus
     with open(script_path, 'w') as f:
         f.write("#!/bin/bash\n")
-        f.write(f"#SBATCH --job-name=T{scope}-{nums}-{project_name}\n")
-        f.write(f"#SBATCH --gres=gpu:4\n")
+        f.write(f"#SBATCH --job-name={job_name}\n")
+        if exclusive:
+            f.write(f"#SBATCH --gres=gpu:4\n")
         f.write(f"#SBATCH --partition=pp\n")
-        f.write(f"#SBATCH --exclusive\n")
+        if exclusive:
+            f.write(f"#SBATCH --exclusive\n")
         f.write(f"#SBATCH --output=/home/pp/out/2.out\n")
         f.write(f"#SBATCH --error=/home/pp/err/2.err\n")
-        f.write(f"sudo /home/pp/conda/pp-1.0/bin/python /home/peiyuan/code/pp/process_tiff_files_long_stigma_corrected_with3.py --tiff_files {' '.join(map(str, tiff_files_chunk))} --gain_out {gain_out} "
-                f"--binning {args.binning} --patch {args.patch} --dose {args.dose} --pixel_size {args.pixel_size} "
-                f"--mag1 {str(major_scale)} --mag2 {str(minor_scale)} --mag3 {str(distort_ang)} "
-                f"--accel_kv {args.accel_kv} --cs_mm {args.cs_mm} --amp_contrast {args.amp_contrast} --spectrum_size {args.spectrum_size} --eer_fraction {args.eer_fraction} "
-                f"--min_res {args.min_res} --max_res {args.max_res} --min_defocus {args.min_defocus} --max_defocus {args.max_defocus} --flag_dir {flag_dir} --eer_sampling {args.eer_sampling} "
-                f"--defocus_step {args.defocus_step} --frame_num {frame_num} --motioncor2_dir {motioncor2_dir} --ctffind5_dir {ctffind5_dir} --stigma_dir {stigma_dir} --scope_id {scope}\n")
-
-def main(args):
-    ### Get input_dir
-    input_dir = Path(args.input) if args.input is not None else Path(os.getcwd())
-    print(f"Input directory is {str(input_dir)}")
-
+        f.write(f'TASK_ARGS=$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" {shlex.quote(str(manifest_path))})\n')
+        sudo = "sudo" if exclusive else SUDO_SHARED_NODE
+        f.write(f"eval {sudo} {WORKER_PYTHON} {WORKER_SCRIPT} \"$TASK_ARGS\"\n")
+
+def create_worker_task(tiff_file, frame_num, gain_out, args, motioncor2_dir, ctffind5_dir, stigma_dir, flag_dir, journal_dir, scope, major_scale, minor_scale, distort_ang, attempt=None):
+    # Same options create_slurm_script puts on the worker command line, for one movie
+    return {
+        "tiff_file": str(tiff_file),
+        "frame_num": frame_num,
+        "attempt": attempt,
+        "args": {
+            "gain_out": str(gain_out), "binning": args.binning, "patch": args.patch, "dose": args.dose,
+            "pixel_size": args.pixel_size, "mag1": str(major_scale), "mag2": str(minor_scale), "mag3": str(distort_ang),
+            "accel_kv": args.accel_kv, "cs_mm": args.cs_mm, "amp_contrast": args.amp_contrast,
+            "spectrum_size": args.spectrum_size, "eer_fraction": args.eer_fraction, "eer_sampling": args.eer_sampling,
+            "min_res": args.min_res, "max_res": args.max_res, "min_defocus": args.min_defocus,
+            "max_defocus": args.max_defocus, "defocus_step": args.defocus_step,
+            "motioncor2_dir": str(motioncor2_dir), "ctffind5_dir": str(ctffind5_dir), "stigma_dir": str(stigma_dir),
+            "flag_dir": str(flag_dir), "journal_dir": str(journal_dir), "scope_id": scope,
+        },
+    }
 
-    ### Attempt to acquire scope_num
-    if args.input is None and args.scope_num is None:
-        if input_dir.parts[2][:5] == "Titan":
-            scope = input_dir.parts[2][5]
+def create_worker_slurm_script(script_path, project_name, spool_dir, job_tag, index, live_share=0.5, gpus=None, cpus_per_gpu=2,
+                               gpu_slots=1, serial_batch=1):
+    # A persistent worker takes a whole node, or only 'gpus' GPUs of a shared one (--packing)
+    with open(script_path, 'w') as f:
+        f.write("#!/bin/bash\n")
+        f.write(f"#SBATCH --job-name={job_tag}-worker{index}-{project_name}\n")
+        if gpus is None:
+            f.write(f"#SBATCH --gres=gpu:4\n")
+            f.write(f"#SBATCH --partition=pp\n")
+            f.write(f"#SBATCH --exclusive\n")
+            sudo, cpu_args = "sudo", ""
         else:
-            print('Please check current path or specify input path')
-            sys.exit(1)
-    print(f"Preprocess for Titan{scope}")
-
-    scope = int(scope)
-
-    
-    ### Get anisotropic magnification distortion from scope and pixel size
-    if scope != 3 and args.m == False:
-        params = get_distortion_params(scope, args.pixel_size)
-    else: 
-        params = {"major_scale": 1.000, "minor_scale": 1.000, "distort_ang": 0.0}
-    print(f"Will use -mag parameters:{params}")
-    major_scale = params["major_scale"]
-    minor_scale = params["minor_scale"]
-    distort_ang = params["distort_ang"]
-
-
-    if scope == 3:
-        input_dir_data = input_dir / "data"
-    else:
-        input_dir_data = input_dir
-    
-    ### Get project name from input_dir path
-    project_name = os.path.basename(input_dir)
+            for option in resource_args(gpus, cpus_per_gpu):
+                f.write(f"#SBATCH {option}\n")
+            f.write(f"#SBATCH --partition=pp\n")
+            sudo, cpu_args = SUDO_SHARED_NODE, f" --num_gpus {gpus} --cpu_workers {gpus * cpus_per_gpu}"
+        f.write(f"#SBATCH --output=/home/pp/out/2.out\n")
+        f.write(f"#SBATCH --error=/home/pp/err/2.err\n")
+        f.write(f"{sudo} {WORKER_PYTHON} {WORKER_SCRIPT} --serve {spool_dir} --live_share {live_share} --gpu_slots {gpu_slots} "
+                f"--serial_batch {serial_batch}{cpu_args}\n")
+
+class SessionError(Exception):
+    pass
+
+def resolve_scope(args, input_dir):
+    ### Microscope number from --scope_num, else from a /<root>/Titan<N>/<session> path
+    if args.scope_num is not None:
+        return int(args.scope_num)
+    if len(input_dir.parts) > 2 and input_dir.parts[2][:5] == "Titan":
+        return int(input_dir.parts[2][5])
+    raise SessionError('Please check current path or specify input path')
+
+def create_executor(args, make_task, task_args, script_dir, job_tag, project_name, default_spool):
+    """ Executor chosen by --executor, and the number of GPUs it runs on."""
+    sbatch_cmd = parse_command(args.sbatch)
+    executor_name = args.executor or ("spool" if args.spool is not None else "slurm")
+    if executor_name == "slurm":
+        # sbatch runs on a background thread, ready chunks are grouped into job arrays
+        def write_array_script(script_path, manifest_path, num_tasks, index):
+            create_slurm_script(script_path, f"{job_tag}-a{index}-{project_name}", manifest_path, exclusive=args.packing == "node")
+        submitter = ArraySubmitter(script_dir, write_array_script, sbatch_cmd, batch_window=args.array_window)
+        num_gpus = args.gpus or GPUS_PER_NODE
+        executor = SlurmArrayExecutor(submitter, task_args, exclude_nodes=args.retry_exclude_nodes,
+                                      squeue_cmd=parse_command(args.squeue), sacct_cmd=parse_command(args.sacct),
+                                      backfill_nice=args.backfill_nice, packing=args.packing, gpus=num_gpus,
+                                      cpus_per_gpu=args.cpus_per_gpu)
+        return executor, num_gpus
+    if executor_name == "spool":
+        # Persistent workers are started once; movies are then queued in the spool instead of submitted
+        if args.spool is None:
+            raise SessionError("--executor spool needs --spool")
+        spool_dir = Path(args.spool)
+        worker_gpus = {"node": None, "chunk": GPUS_PER_NODE, "gpu": 1}[args.packing]
+        def start_workers():
+            for index in range(args.workers):
+                script_path = Path(script_dir) / f"slurm_worker_{index}.sh"
+                create_worker_slurm_script(script_path, project_name, spool_dir, job_tag, index, args.live_share,
+                                           worker_gpus, args.cpus_per_gpu, args.gpu_slots, args.serial_batch)
+                os.chmod(script_path, 0o755)
+                submit_to_slurm(script_path, sbatch_cmd)
+            print(f"Started {args.workers} persistent worker(s) on spool {spool_dir}")
+        return SpoolExecutor(spool_dir, make_task, start_workers), (worker_gpus or GPUS_PER_NODE) * args.workers
+    # One worker process per local GPU, fed from a local spool
+    spool_dir = Path(args.spool) if args.spool is not None else Path(default_spool)
+    gpu_ids = [gpu.strip() for gpu in args.local_gpus.split(",") if gpu.strip()]
+    worker_cmd = [sys.executable, str(LOCAL_WORKER_SCRIPT), "--serve", str(spool_dir), "--num_gpus", "1",
+                  "--cpu_workers", str(args.local_cpu_workers), "--idle_exit", "86400", "--live_share", str(args.live_share),
+                  "--gpu_slots", str(args.gpu_slots), "--serial_batch", str(args.serial_batch)]
+    return LocalExecutor(spool_dir, make_task, worker_cmd, gpu_ids, script_dir), len(gpu_ids)
+
+class Session:
+    """ One microscope session: directories, gain, ledger, watcher and the movies waiting for submission.
+
+    run_slurm2.py runs one Session with its own executor; pp_scheduler.py runs
+    several on a shared one. Setup problems raise SessionError.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        ### Get input_dir
+        input_dir = Path(args.input) if args.input is not None else Path(os.getcwd())
+        print(f"Input directory is {str(input_dir)}")
+
+        ### Attempt to acquire scope_num
+        scope = resolve_scope(args, input_dir)
+        print(f"Preprocess for Titan{scope}")
+
+        ### Get anisotropic magnification distortion from scope and pixel size
+        if scope != 3 and args.m == False:
+            params = get_distortion_params(scope, args.pixel_size)
+        else:
+            params = {"major_scale": 1.000, "minor_scale": 1.000, "distort_ang": 0.0}
+        print(f"Will use -mag parameters:{params}")
+        self.major_scale = params["major_scale"]
+        self.minor_scale = params["minor_scale"]
+        self.distort_ang = params["distort_ang"]
+
+        if scope == 3:
+            input_dir_data = input_dir / "data"
+        else:
+            input_dir_data = input_dir
+
+        ### Get project name from input_dir path
+        project_name = os.path.basename(input_dir)
+
+        ### Get and make output_dir. Get user uid & gid from args.output
+        output_dir = Path(args.output) if args.output is not None else input_dir
+        uid = gid = None
+        if args.output is not None :
+            username = output_dir.parts[2]
+            try:
+                user_info = pwd.getpwnam(username)
+                uid = user_info.pw_uid
+                gid = user_info.pw_gid
+                print(f"username:{username}")
+                print(f"uid:{uid}")
+                print(f"gid:{gid}")
+            except Exception as e:
+                raise SessionError(e)
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        ### Chown output_dir if exists in args
+        if args.output is not None :
+            os.chown(output_dir, uid, gid)
+
+        ### Set gain file fullpath from project name
+        gain_out = str(output_dir / f"{project_name}_gain.mrc")
+
+        ### Convert gain file from dm4 if needed and chown
+        if Path(gain_out).exists():
+            print(f"Converted gain file found")
+        elif args.gain is None:
+            # K3 sessions come with a .dm4, Falcon (Titan3) sessions with a .gain
+            gain_files = glob.glob(os.path.join(input_dir, "*.gain" if scope == 3 else "*.dm4"))
+            if not gain_files:
+                raise SessionError(f"No gain reference file found, please check agian.")
+            gain_in = gain_files[0]
 
-    ### Get and make output_dir. Get user uid & gid from args.output
-    output_dir = Path(args.output) if args.output is not None else input_dir
-    if args.output is not None :
-        username = output_dir.parts[2]
-        try:
-            user_info = pwd.getpwnam(username)
-            uid = user_info.pw_uid
-            gid = user_info.pw_gid
-            print(f"username:{username}")
-            print(f"uid:{uid}")
-            print(f"gid:{gid}")
-        except Exception as e:
-            print(e)
-            sys.exit(1)
-    output_dir.mkdir(parents=True, exist_ok=True)
+            # Copy a backup gain file to output_dir
+            if args.output is not None:
+                shutil.copy(gain_in, output_dir / os.path.basename(gain_in))
+            print(f"Gain {gain_in}: {convert_gain(gain_in, gain_out, args.gain_cache)}")
+        else:   # If specified gain file
+            gain = Path(args.gain)
+            gain_in = str(gain)
 
-    ### Chown output_dir if exists in args 
-    if args.output is not None :
-        os.chown(output_dir, uid, gid)   
-    
-    ### Set gain file fullpath from project name 
-    gain_out = str(output_dir / f"{project_name}_gain.mrc")
-
-    ### Convert gain file from dm4 if needed and chown
-    if Path(gain_out).exists():
-        print(f"Converted gain file found")
-    elif args.gain is None and scope != 3:
-        dm4_files = glob.glob(os.path.join(input_dir, "*.dm4"))
-        if dm4_files:
-            gain_in = dm4_files[0]
-            
             # Copy a backup dm4 file to output_dir
             if args.output is not None:
                 dm4_file_copy = output_dir / os.path.basename(gain_in)
-                shutil.copy(gain_in, dm4_file_copy)  
-
-            #### Trick: Running this script with sudo will clear the evironment, so we must start from source ~/.bashrc
-            subprocess.run('bash -c "source ~/.bashrc && module load pp && dm2mrc {} {}"'.format(gain_in, gain_out), shell=True, check=True)
+                shutil.copy(gain_in, dm4_file_copy)
+
+            if str(gain).endswith('.dm4') or str(gain).endswith('.gain'):
+                print(f"Gain {gain_in}: {convert_gain(gain_in, gain_out, args.gain_cache)}")
+        if args.output is not None :
+            os.chown(gain_out, uid, gid)
+
+        ### Maybe useless
+        if not (input_dir.exists() and input_dir.is_dir()):
+            raise SessionError(f"Input directory {input_dir} does not exist")
+
+        #### Prepare directories and chown them
+        motioncor2_dir = output_dir / "motioncor2"
+        motioncor2_dir.mkdir(parents=True, exist_ok=True)
+        ctffind5_dir = output_dir / "ctffind5"
+        ctffind5_dir.mkdir(parents=True, exist_ok=True)
+        stigma_dir = input_dir / "stigma"
+        stigma_dir.mkdir(parents=True, exist_ok=True)
+        script_dir = input_dir / "slurm"
+        script_dir.mkdir(parents=True, exist_ok=True)
+        flag_dir = input_dir / "flag"
+        flag_dir.mkdir(parents=True, exist_ok=True)
+        ledger_db, journal_dir = ledger_paths(input_dir)
+        self.ledger = Ledger(ledger_db, journal_dir)
+        if args.output is not None :
+            os.chown(flag_dir, uid, gid)
+            os.chown(ledger_db.parent, uid, gid)
+            os.chown(journal_dir, uid, gid)
+            os.chown(script_dir, uid, gid)
+            os.chown(stigma_dir, uid, gid)
+            os.chown(ctffind5_dir, uid, gid)
+            os.chown(motioncor2_dir, uid, gid)
+
+        self.scope = scope
+        self.input_dir, self.input_dir_data, self.output_dir = input_dir, input_dir_data, output_dir
+        self.project_name, self.gain_out = project_name, gain_out
+        self.uid, self.gid = uid, gid
+        self.motioncor2_dir, self.ctffind5_dir, self.stigma_dir = motioncor2_dir, ctffind5_dir, stigma_dir
+        self.script_dir, self.flag_dir, self.ledger_db, self.journal_dir = script_dir, flag_dir, ledger_db, journal_dir
+        self.job_tag = f"T{scope}"
+        self.executor = None
+
+    def attempt(self, tiff_file):
+        # Movies are marked submitted, with their attempt number, before they go to the executor
+        row = self.ledger.get(tiff_file)
+        return row["attempts"] if row is not None else None
+
+    def make_task(self, tiff_file, frame_num):
+        return create_worker_task(tiff_file, frame_num, self.gain_out, self.args, self.motioncor2_dir, self.ctffind5_dir, self.stigma_dir,
+                                  self.flag_dir, self.journal_dir, self.scope, self.major_scale, self.minor_scale, self.distort_ang,
+                                  self.attempt(tiff_file))
+
+    def task_args(self, tiff_files_chunk, frame_nums, avoid=()):
+        return worker_args(tiff_files_chunk, self.gain_out, self.args, frame_nums, self.motioncor2_dir, self.ctffind5_dir, self.stigma_dir,
+                           self.flag_dir, self.journal_dir, self.scope, self.major_scale, self.minor_scale, self.distort_ang, avoid,
+                           [self.attempt(tiff_file) for tiff_file in tiff_files_chunk])
+
+    def start(self, executor, num_gpus, throttle=None):
+        """ Start watching and submitting to 'executor' (already started); 'throttle' is shared when the executor is."""
+        args = self.args
+        ledger = self.ledger
+        self.executor = executor
+
+        ### Ownership and ACLs are applied to outputs as they appear, so the final pass has little left to do
+        self.permissions = PermissionEngine(self.uid, self.gid) if args.output is not None else None
+
+        ### Raw movies are copied to the output in the background; unfinished copies of an earlier run are resumed
+        self.archiver = None
+        if args.output is not None:
+            self.archiver = Archiver(ledger, self.output_dir, self.permissions, workers=args.archive_workers,
+                                     bandwidth=args.archive_mbps * 1e6 or None, verify=not args.archive_no_verify)
+            resumed = self.archiver.resume()
+            if resumed:
+                print(f"Resuming {resumed} archive copies")
+
+        #### Number of files per job submission is decided by the batching policy; every MotionCor2 slot counts
+        if args.gpus is not None:
+            num_gpus = args.gpus
+        slots = num_gpus * args.gpu_slots
+        self.policy = BatchPolicy(args.batch_mode, slots, args.target_latency)
+        print(f"Batching: {self.policy}")
+        if throttle is None:
+            throttle = SubmissionThrottle(slots, args.queue_lookahead, args.max_queued_jobs)
+            print(f"Submission: {throttle}")
+        self.throttle = throttle
+        self.slots = slots
+
+        ### Stage runtimes of finished movies train the cost model behind chunk composition and the ETA
+        self.cost_model = CostModel()
+        for row in ledger.rows("done"):
+            self.cost_model.observe_row(self.cost_group(row["name"], row["gpu_slots"]), row)
+        print(f"Cost model: {self.cost_model}")
+        self.features = {}          # movie -> (frame count, file size)
+        self.next_eta = time.monotonic()
+        self.eta_busy = False
+        self.processed_files = set()
+        self.new_tiff_files = []
+        self.ready_since = {}       # movie -> time it was reported stable
+        self.acquired = {}          # movie -> mtime, i.e. end of acquisition
+        self.lanes = LanePolicy(args.live_share, args.live_window)
+        self.latency = LatencyStats()
+        self.in_flight = set()      # names submitted and not reported done/failed yet
+        self.next_reconcile = time.monotonic() + args.reconcile_interval
+        self.lost_suspects = {}     # name -> job id found ended without a result on the last check
+        self.timeout = 0
+        self.idle_since = time.monotonic()
+
+        ### Movies are reported by the watcher as they land; their state lives in the session ledger
+        self.watcher = MovieWatcher(self.input_dir_data, MOVIE_SUFFIXES)
+        migrated = ledger.import_done_flags(self.flag_dir)
+        print(f"Ledger {self.ledger_db}: {ledger.counts()} ({migrated} done flag(s) imported)")
+        ### Movies are submitted once closed (or quiet) and their TIFF/EER structure is complete
+        self.tracker = StabilityTracker(validator=is_complete)
+        self.unreadable_attempts = {}   # movie -> times its frame count could not be read
+        print(f"Watching {self.input_dir_data} ({'inotify' if self.watcher.uses_inotify else 'scandir'} + scandir fallback)")
+
+        ### Failed movies are resubmitted one by one after a backoff, away from the GPUs/nodes they failed on
+        self.retries = RetryQueue(RetryPolicy(args.max_attempts, args.retry_backoff))
+        self.submit_failures = queue.Queue()    # filled from the sbatch thread, handled by the scan loop
+
+        ### After a restart, movies already in flight keep their jobs instead of being submitted twice;
+        ### movies whose job ended without a result are retried, unsubmitted ones go through the tracker again
+        adopted, lost, unsubmitted = reconcile_in_flight(ledger, executor, lambda: self.handle_events(ledger.ingest()))
+        if adopted or lost or unsubmitted:
+            print(f"In-flight movies: {len(adopted)} adopted, {len(lost)} lost, {len(unsubmitted)} never submitted")
+        self.processed_files.update(Path(row["path"]) for row in adopted)
+        self.in_flight.update(row["name"] for row in adopted)
+        for row, state in lost:
+            self.fail_lost(row, state)
+        if unsubmitted:
+            ledger.mark([row["name"] for row in unsubmitted], "stable", force=True)
+
+    def fail_lost(self, row, state):
+        # The job of this movie ended without a journal event for it: fail it and retry like a reported failure
+        self.ledger.mark(row["name"], "failed", finished_at=time.time(), error=f"job {row['job_id']} ended {state} without a result")
+        self.ledger.record_outcome(row["name"], "failed")
+        self.processed_files.add(Path(row["path"]))
+        self.in_flight.discard(row["name"])
+        self.schedule_retry(row["name"])
+
+    def reconcile(self):
+        """ Fail in-flight movies whose job ended without reporting them, so they stop holding places."""
+        _adopted, lost, _unsubmitted = reconcile_in_flight(self.ledger, self.executor,
+                                                           lambda: self.handle_events(self.ledger.ingest()))
+        # Journal lines of a job that just ended may not be visible yet (NFS): two checks in a row must agree
+        suspects = {row["name"]: row["job_id"] for row, _state in lost}
+        lost = [(row, state) for row, state in lost if self.lost_suspects.get(row["name"]) == row["job_id"]]
+        self.lost_suspects = suspects
+        for row, state in lost:
+            print(f"{row['name']}: job {row['job_id']} ended {state} without a result")
+            self.fail_lost(row, state)
+
+    def record_job(self, movies, job_id):
+        if job_id is None:
+            self.ledger.mark(movies, "failed", error="submission failed")
+            for movie in movies:
+                self.submit_failures.put(Path(movie).name)
         else:
-            print(f"No gain reference file found, please check agian.")
-            sys.exit(1)
-    elif args.gain is None and scope == 3:
-        gain_files = glob.glob(os.path.join(input_dir, "*.gain"))
-        if gain_files:
-            gain_in = gain_files[0]
-            
-            # Copy a backup dm4 file to output_dir
-            if args.output is not None:
-                gain_file_copy = output_dir / os.path.basename(gain_in)
-                shutil.copy(gain_in, gain_file_copy)  
-            gain_out_temp = str(output_dir / f"{project_name}_gain_temp.mrc")
-            #### Trick: Running this script with sudo will clear the evironment, so we must start from source ~/.bashrc
-            subprocess.run('bash -c "source ~/.bashrc && module load pp && tif2mrc {} {}"'.format(gain_in, gain_out_temp), shell=True, check=True)
-            subprocess.run('bash -c "source ~/.bashrc && module load pp && source activate eman2 && e2proc2d.py --process math.reciprocal {} {}"'.format(gain_out_temp, gain_out), shell=True, check=True)
+            self.ledger.mark(movies, "submitted", job_id=job_id)
+
+    def schedule_retry(self, name):
+        row = self.ledger.get(name)
+        avoid = [f"{outcome['host']}:{outcome['gpu_id']}" for outcome in self.ledger.outcomes(name)
+                 if outcome["outcome"] == "failed" and outcome["host"] and outcome["gpu_id"] is not None]
+        delay = self.retries.schedule(Path(row["path"]), row["frame_num"], row["attempts"] or 1, avoid)
+        if delay is None:
+            print(f"{name}: giving up after {row['attempts']} attempt(s)")
         else:
-            print(f"No gain reference file found, please check agian.")
-            sys.exit(1)
-    else:   # If specified gain file
-        gain = Path(args.gain)
-        gain_in = str(gain)
+            print(f"{name}: retry in {delay:.0f}s" + (f", avoiding {','.join(avoid)}" if avoid else ""))
+
+    def handle_events(self, events):
+        # Worker progress from the ledger journal; finished movies give the observed runtime
+        for event in events:
+            if event["state"] == "done":
+                self.in_flight.discard(event["name"])
+                if self.permissions is not None:
+                    outputs = event["fields"].get("outputs") or {}
+                    self.permissions.apply_many(p for p in outputs.values() if Path(p).is_relative_to(self.output_dir))
+                row = self.ledger.get(event["name"])
+                if row["started_at"] is not None and row["finished_at"] is not None:
+                    self.policy.observe_runtime(row["finished_at"] - row["started_at"])
+                self.throttle.observe_done(row["finished_at"])
+                if row["acquired_at"] is not None and row["finished_at"] is not None:
+                    self.latency.add(row["lane"], row["finished_at"] - row["acquired_at"])
+                self.cost_model.observe_row(self.cost_group(row["name"], row["gpu_slots"]), row)
+            elif event["state"] == "failed":
+                self.in_flight.discard(event["name"])
+                print(f"{event['name']} failed: {event['fields'].get('error')}")
+                self.schedule_retry(event["name"])
+        if self.latency.report_due():
+            print(self.latency)
+
+    def next_wait(self, default=5, blocked=False):
+        """ Seconds this session can wait for new movies before it has something to do."""
+        ## Don't wait at all if a full chunk is pending, only briefly while some movies
+        ## are still being written, and never past a flush deadline or a due retry.
+        ## While the throttle holds chunks back, only finished movies (the journal) can free places.
+        chunk_size = self.policy.chunk_size(len(self.new_tiff_files))
+        oldest_wait = time.monotonic() - min(self.ready_since.values()) if self.ready_since else 0.0
+        if blocked:
+            wait = min(self.tracker.next_check(default), 1.0)
+        elif len(self.new_tiff_files) >= chunk_size:
+            wait = 0
+        elif self.new_tiff_files:
+            wait = min(self.tracker.next_check(default), self.policy.flush_in(oldest_wait))
+        else:
+            wait = self.tracker.next_check(default)
+        return self.retries.next_in(wait)
+
+    def poll(self, timeout):
+        """ New movies, stability, worker progress and due retries. Returns the newly discovered movies."""
+        ledger = self.ledger
+        discovered = self.watcher.poll(timeout=timeout)
+        self.tracker.add(ledger.discover((f for f in discovered if f not in self.processed_files), max_attempts=self.args.max_attempts))
+        self.tracker.mark_closed(self.watcher.take_closed())
+
+        ## Only movies that finished writing are queued for submission
+        now = time.monotonic()
+        settled = self.tracker.poll()
+        if settled:
+            ledger.mark(settled, "stable", stable_at=time.time())
+        for tiff_file, reason in self.tracker.take_abandoned():
+            print(f"{tiff_file.name}: {reason}, unchanged for {self.tracker.give_up_after:.0f}s, giving up")
+            ledger.mark(tiff_file, "failed", finished_at=time.time(), error=reason)
+        for tiff_file in settled:
+            self.new_tiff_files.append(tiff_file)
+            self.ready_since[tiff_file] = now
+            try:
+                st = tiff_file.stat()
+                self.acquired[tiff_file] = st.st_mtime
+                self.features[tiff_file] = (count_frames(tiff_file), st.st_size)
+            except OSError:
+                self.acquired[tiff_file] = None
+        self.new_tiff_files.sort()
+
+        self.handle_events(ledger.ingest())
+        while not self.submit_failures.empty():
+            name = self.submit_failures.get()
+            self.in_flight.discard(name)
+            ledger.record_outcome(name, "failed")
+            self.schedule_retry(name)
+
+        if time.monotonic() >= self.next_reconcile:
+            self.next_reconcile = time.monotonic() + self.args.reconcile_interval
+            self.reconcile()
+
+        ## Retries go out alone, each carrying the places it already failed on
+        for tiff_file, frame_num, attempts, avoid in self.retries.due():
+            ledger.mark(tiff_file, "submitted", force=True, attempts=attempts + 1, submitted_at=time.time(),
+                        job_id=None, host=None, gpu_id=None, started_at=None, finished_at=None, error=None)
+            self.in_flight.add(tiff_file.name)
+            self.executor.submit([tiff_file], [frame_num], self.record_job, avoid, ledger.get(tiff_file)["lane"])
+
+        if time.monotonic() >= self.next_eta:
+            self.next_eta = time.monotonic() + 60
+            self.publish_eta()
+
+        ## Idle time in 5s polls since the last new movie or submission
+        if discovered:
+            self.idle_since = time.monotonic()
+        return discovered
+
+    def cost_group(self, name, gpu_slots=None):
+        # Movies of one group cost about the same per frame; runs sharing a GPU take longer each
+        return (self.scope, Path(name).suffix.lower(), self.args.binning, self.args.patch, gpu_slots or self.args.gpu_slots)
+
+    def movie_cost(self, tiff_file):
+        """ Predicted MotionCor2 seconds of a ready movie."""
+        frames, size = self.features.get(tiff_file, (None, None))
+        return self.cost_model.predict(self.cost_group(tiff_file.name), frames, size)
+
+    def publish_eta(self):
+        """ Print when the waiting and in-flight movies should be done, and write it to <ledger dir>/eta.json."""
+        busy = bool(self.new_tiff_files or self.in_flight)
+        if not busy and not self.eta_busy:
+            return
+        self.eta_busy = busy
+        now = time.time()
+        gpu_seconds = sum(self.movie_cost(tiff_file) for tiff_file in self.new_tiff_files)
+        cpu_tail = 0.0
+        for name in self.in_flight:
+            row = self.ledger.get(name)
+            if row is None or row["aligned_at"] is not None:
+                continue
+            predicted = self.cost_model.predict(self.cost_group(name), row["frame_num"], row["size"])
+            if row["started_at"] is not None:
+                predicted = max(0.0, predicted - (now - row["started_at"]))
+            gpu_seconds += predicted
+        if busy:
+            last = self.new_tiff_files[-1].name if self.new_tiff_files else next(iter(self.in_flight))
+            cpu_tail = self.cost_model.predict(self.cost_group(last), None, None, "cpu")
+        # GPUs shared with other sessions (pp_scheduler.py) make this an optimistic estimate
+        eta = backlog_eta(gpu_seconds, cpu_tail, self.slots, now)
+        status = {"waiting": len(self.new_tiff_files), "in_flight": len(self.in_flight), "retrying": len(self.retries),
+                  "gpu_seconds": round(gpu_seconds, 1), "eta": round(eta, 1), "updated_at": round(now, 1)}
+        eta_path = self.ledger_db.parent / "eta.json"
+        tmp_path = eta_path.with_name(eta_path.name + ".tmp")
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(status, f)
+            os.replace(tmp_path, eta_path)
+        except OSError as e:
+            print(f"Cannot write {eta_path}: {e}")
+        if busy:
+            print(f"Backlog: {status['waiting']} waiting, {status['in_flight']} in flight, "
+                  f"ETA {time.strftime('%H:%M', time.localtime(eta))} (~{(eta - now) / 60:.0f} min)")
+
+    def ready_chunk(self, room=None):
+        """ [(movie, lane)] due for submission now: a full chunk at once, a partial chunk once its oldest
+        movie reached the target latency. The newest movies (live lane) go before the backlog.
+
+        The chunk is cut down to 'room' (the throttle's free places, at least one movie).
+        """
+        chunk_size = self.policy.chunk_size(len(self.new_tiff_files))
+        oldest_wait = time.monotonic() - min(self.ready_since.values()) if self.ready_since else 0.0
+        if len(self.new_tiff_files) >= chunk_size:
+            count = chunk_size
+        elif self.new_tiff_files and self.policy.should_flush(oldest_wait):
+            count = len(self.new_tiff_files)
+        else:
+            return []
+        if room is not None:
+            count = min(count, max(1, room))
+        # Backfill movies of similar cost go together, so a chunk is not held up by one slow movie
+        return self.lanes.pick(self.new_tiff_files, self.acquired, count,
+                               arrange=lambda backlog, places: similar_cost(backlog, places, self.movie_cost))
+
+    def oldest_ready(self):
+        return min(self.ready_since.values()) if self.ready_since else math.inf
+
+    def submit_chunk(self, chunk):
+        """ Hand a chunk from ready_chunk() to the executor. Returns the number of movies submitted."""
+        args = self.args
+        lanes = dict(chunk)
+        tiff_files_chunk = [tiff_file for tiff_file, _lane in chunk]
+        self.new_tiff_files = [tiff_file for tiff_file in self.new_tiff_files if tiff_file not in lanes]
+        acquired, sizes = {}, {}
+        for tiff_file in tiff_files_chunk:
+            self.ready_since.pop(tiff_file, None)
+            acquired[tiff_file] = self.acquired.pop(tiff_file, None)
+            sizes[tiff_file] = self.features.pop(tiff_file, (None, None))[1]
+
+        # Mark these files as processed
+        self.processed_files.update(tiff_files_chunk)
+
+        # Frame count of every movie, read from the headers; unreadable ones go back to the tracker
+        tiff_files_chunk, frame_nums = split_readable(tiff_files_chunk, self.tracker, self.processed_files,
+                                                     self.unreadable_attempts, self.ledger)
+        if not tiff_files_chunk:
+            return 0
+
+        # Files in new_tiff_files have already been reported stable by the tracker
+        if self.scope == 3:
+            nums = ','.join([str(file)[-14:-8] for file in tiff_files_chunk])
+        else:
+            nums = ','.join([str(file)[-8:-4] for file in tiff_files_chunk])
+        print(f"Ready for {nums}")
+
+        Eer_frac_path = self.motioncor2_dir / "fraction"
+
+        if not Eer_frac_path.exists() and self.scope == 3:
+            frame_num = frame_nums[0]
+            dose_per_frame = args.dose / frame_num
+            print("EER fractionation file do not exists!")
+            with open(str(Eer_frac_path), 'w', encoding='utf-8') as file:
+                # 将变量连接起来并用制表符隔开
+                line = f"{frame_num}\t{args.eer_fraction}\t{dose_per_frame}\n"
+                # 将结果写入文件
+                file.write(line)
+
+        for tiff_file, frame_num in zip(tiff_files_chunk, frame_nums):
+            # A movie submitted before a restart (failed, or without a job id) continues with its next attempt;
+            # the row is forced back to 'submitted' so that reconcile and the journal see this submission
+            row = self.ledger.get(tiff_file)
+            attempts = (row["attempts"] if row is not None else 0) + 1
+            self.ledger.mark(tiff_file, "submitted", force=True, submitted_at=time.time(), frame_num=frame_num, attempts=attempts,
+                             lane=lanes[tiff_file], acquired_at=acquired[tiff_file], size=sizes[tiff_file],
+                             job_id=None, host=None, gpu_id=None, started_at=None, finished_at=None, error=None)
+        self.in_flight.update(tiff_file.name for tiff_file in tiff_files_chunk)
+        # The job id lands in the ledger once the executor knows it (sbatch runs in the background);
+        # each lane goes separately so the executor can put live movies first
+        for lane in LANES:
+            movies = [(tiff_file, frame_num) for tiff_file, frame_num in zip(tiff_files_chunk, frame_nums) if lanes[tiff_file] == lane]
+            if movies:
+                self.executor.submit([m for m, _ in movies], [n for _, n in movies], self.record_job, lane=lane)
+
+        if self.archiver is not None:
+            self.archiver.enqueue(tiff_files_chunk)
+
+        self.timeout = 0
+        self.idle_since = time.monotonic()
+        return len(tiff_files_chunk)
+
+    def check_idle(self):
+        """ Count idle minutes; True once the session saw no input for 30 minutes and has nothing in flight or to retry."""
+        idle_polls = int((time.monotonic() - self.idle_since) // 5)
+        if idle_polls > self.timeout:
+            self.timeout = idle_polls
+            if self.timeout % 12 == 0 :
+                print(f"no input, waited {self.timeout // 12} minute(s)")
+        return self.timeout > 360 and not self.in_flight and not self.retries
+
+    def close(self):
+        """ Final bookkeeping once the session is over; the executor is closed by its owner."""
+        self.watcher.close()
+        self.handle_events(self.ledger.ingest())
+        print(f"Ledger: {self.ledger.counts()}")
+        for line in slot_report(self.ledger.rows("done")):
+            print(line)
+        if self.archiver is not None:
+            print("Waiting for archive copies to finish.")
+            self.archiver.close()
+            print(self.archiver.stats())
+        if self.args.output is not None:
+            print("Setting premissions.")
+            checked, changed = self.permissions.apply_tree(self.output_dir)
+            print(f"Premissions set on directory {self.output_dir} ({changed} of {checked} remaining entries changed, {self.permissions.changed} in total).")
 
-        # Copy a backup dm4 file to output_dir
-        if args.output is not None:
-            dm4_file_copy = output_dir / os.path.basename(gain_in)
-            shutil.copy(gain_in, dm4_file_copy) 
-
-        if str(gain).endswith('.dm4'):
-            subprocess.run('bash -c "source ~/.bashrc && module load pp && dm2mrc {} {}"'.format(gain_in, gain_out), shell=True, check=True)
-        elif str(gain).endswith('.gain'):
-            gain_out_temp = str(output_dir / f"{project_name}_gain_temp.mrc")
-            subprocess.run('bash -c "source ~/.bashrc && module load pp && tif2mrc {} {}"'.format(gain_in, gain_out_temp), shell=True, check=True)
-            subprocess.run('bash -c "source ~/.bashrc && module load pp && source activate eman2 && e2proc2d.py --process math.reciprocal {} {}"'.format(gain_out_temp, gain_out), shell=True, check=True)
-
-        # subprocess.run(cmd, check=True)
-    if args.output is not None :
-        os.chown(gain_out, uid, gid)
-
-    ### Maybe useless
-    assert input_dir.exists() and input_dir.is_dir(), f"Input directory {input_dir} does not exist"
-    # assert gain.exists() and gain.suffix == ".dm4", f"Gain reference file {gain} does not exist"
-
-    #### Prepare directories and chown them
-    motioncor2_dir = output_dir / "motioncor2"
-    motioncor2_dir.mkdir(parents=True, exist_ok=True)
-    ctffind5_dir = output_dir / "ctffind5"
-    ctffind5_dir.mkdir(parents=True, exist_ok=True)
-    stigma_dir = input_dir / "stigma"
-    stigma_dir.mkdir(parents=True, exist_ok=True)
-    script_dir = input_dir / "slurm"
-    script_dir.mkdir(parents=True, exist_ok=True)
-    flag_dir = input_dir / "flag"
-    flag_dir.mkdir(parents=True, exist_ok=True)
-    if args.output is not None :
-        os.chown(flag_dir, uid, gid)
-        os.chown(script_dir, uid, gid)
-        os.chown(stigma_dir, uid, gid)
-        os.chown(ctffind5_dir, uid, gid)
-        os.chown(motioncor2_dir, uid, gid)
-
-    #### Number of files per job submission
-    chunk_size = 4  
-    processed_files = set()
-    timeout = 0
-
-    ### Loop for file scanning
+def main(args):
+    try:
+        session = Session(args)
+        ### Ready movies go to the chosen executor; all of them report progress through the ledger journal
+        executor, num_gpus = create_executor(args, session.make_task, session.task_args, session.script_dir, session.job_tag,
+                                             session.project_name, session.input_dir / "local_spool")
+    except SessionError as e:
+        print(e)
+        sys.exit(1)
+    executor.start()
+    print(f"Executor: {executor.name}")
+    session.start(executor, num_gpus)
+
+    ### Loop for file scanning; chunks the executor has no room for wait in the ready queue
+    blocked = False
     while True:
-        ## Scan for tiff files and initialize list by done_flags 
-        tiff_files = list(input_dir_data.glob("*.tif")) + list(input_dir_data.glob("*.tiff")) + list(input_dir_data.glob("*.eer"))
-        tiff_files = sorted(tiff_files)
-        undone_files = []
-        for tiff_file in tiff_files:
-            done_flag = flag_dir / (tiff_file.name + ".done")
-            if not done_flag.exists():
-                undone_files.append(tiff_file)
-
-        ## Filter out already processed files
-        new_tiff_files = [f for f in undone_files if f not in processed_files]
-
-        if len(new_tiff_files) >= chunk_size:
-            tiff_files_chunk = new_tiff_files[:chunk_size]
-
-            # Mark these files as processed
-            processed_files.update(tiff_files_chunk)
-
-            # Get movie shape from the first file
-            if check_all_files_stable(tiff_files_chunk):  
-                if scope == 3:
-                    nums = ','.join([str(file)[-14:-8] for file in tiff_files_chunk])
-                    print(f"Ready for {nums}")
-                else:
-                    nums = ','.join([str(file)[-8:-4] for file in tiff_files_chunk])
-                    print(f"Ready for {nums}")
-
-            Eer_frac_path = motioncor2_dir / "fraction"
-                
-            if not Eer_frac_path.exists() and scope == 3:
-                
-                frame_num = get_tif_frame_count(tiff_files_chunk[0])
-                if frame_num == 0:
-                    frame_num = get_tif_frame_count(tiff_files_chunk[1])
-                if frame_num == 0:            
-                    frame_num = get_tif_frame_count(tiff_files_chunk[2])
-                if frame_num == 0:                
-                    frame_num = get_tif_frame_count(tiff_files_chunk[3])
-                if frame_num == 0:    
-                    continue
-                dose_per_frame = args.dose / frame_num
-                print("EER fractionation file do not exists!")
-                with open(str(Eer_frac_path), 'w', encoding='utf-8') as file:
-                    # 将变量连接起来并用制表符隔开
-                    line = f"{frame_num}\t{args.eer_fraction}\t{dose_per_frame}\n"
-                    # 将结果写入文件
-                    file.write(line)
-            else:
-                frame_num = get_tif_frame_count(tiff_files_chunk[0])
-                if frame_num == 0:
-                    frame_num = get_tif_frame_count(tiff_files_chunk[1])
-                if frame_num == 0:
-                    frame_num = get_tif_frame_count(tiff_files_chunk[2])
-                if frame_num == 0:
-                    frame_num = get_tif_frame_count(tiff_files_chunk[3])
-                if frame_num == 0:
-                    continue
-                dose_per_frame = args.dose / frame_num
-
-            # Create SLURM script and submit job
-            chunk_index = len(processed_files) // chunk_size
-            script_path = script_dir / f"slurm_job_{chunk_index}.sh"
-            create_slurm_script(script_path, project_name, tiff_files_chunk, gain_out, args, frame_num,str(motioncor2_dir),str(ctffind5_dir),str(stigma_dir),str(flag_dir), scope,nums,major_scale,minor_scale,distort_ang)
-            os.chmod(script_path, 0o755)
-            submit_to_slurm(script_path)
-            
-            if args.output is not None :
-                for tiff_chunk_file in tiff_files_chunk:
-                # 构造目标文件路径
-                    destination = os.path.join(output_dir, os.path.basename(tiff_chunk_file))
-                    shutil.copy2(tiff_chunk_file, destination)
-                    os.chown(destination, uid, gid)
-                        
-            timeout = 0        
-
-            # Wait a bit before scanning again
-            time.sleep(5)  # Adjust the sleep interval as needed
-        
-        elif timeout < 8:
-            timeout += 1
-        
-            time.sleep(5)
-        elif len(new_tiff_files) > 0:
-            tiff_files_chunk = new_tiff_files
-
-            # Mark these files as processed
-            processed_files.update(tiff_files_chunk)
-
-            # Get movie shape from the first file
-            if check_all_files_stable(tiff_files_chunk):  
-                if scope == 3:
-                    nums = ','.join([str(file)[-14:-8] for file in tiff_files_chunk])
-                    print(f"Ready for {nums}")
-                else:
-                    nums = ','.join([str(file)[-8:-4] for file in tiff_files_chunk])
-                    print(f"Ready for {nums}")
-            frame_num = get_tif_frame_count(tiff_files_chunk[0])
-            
-
-            # Create SLURM script and submit job
-            chunk_index = len(processed_files) // chunk_size
-            script_path = script_dir / f"slurm_job_{chunk_index}.sh"
-            create_slurm_script(script_path, project_name, tiff_files_chunk, gain_out, args, frame_num,str(motioncor2_dir),str(ctffind5_dir),str(stigma_dir),str(flag_dir),scope,nums,major_scale,minor_scale,distort_ang)
-            os.chmod(script_path, 0o755)
-            submit_to_slurm(script_path)
-
-
-            if args.output is not None :
-                for tiff_chunk_file in tiff_files_chunk:
-                # 构造目标文件路径
-                    destination = os.path.join(output_dir, os.path.basename(tiff_chunk_file))
-                    shutil.copy2(tiff_chunk_file, destination)
-                    os.chown(destination, uid, gid)
-
-            timeout = 0        
-
-            # Wait a bit before scanning again
-            time.sleep(5)  # Adjust the sleep interval as needed
-        else:
-            timeout += 1
-            if timeout % 12 == 0 :
-                print(f"no input, waited {timeout // 12} minute(s)")
-            time.sleep(5)
-        
-        if timeout > 360:
+        session.poll(session.next_wait(blocked=blocked))
+        executor.poll()
+
+        room = session.throttle.room(len(session.in_flight), executor.queue_depth())
+        tiff_files_chunk = session.ready_chunk(room)
+        blocked = bool(tiff_files_chunk) and room == 0
+        if tiff_files_chunk and not blocked:
+            session.submit_chunk(tiff_files_chunk)
+        elif not blocked and session.check_idle():
             print(f"No more input, terminating")
-            if args.output is not None:
-                print("Setting premissions.")
-                recursive_chown_and_acl(output_dir, uid, gid)
-                print(f"Premissions set on directory {output_dir}.")
+            executor.close()
+            session.close()
             sys.exit(1)
 
 
-        
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     args = add_args(parser).parse_args()
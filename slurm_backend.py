@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import shlex
+import queue
+import threading
+import subprocess
+from pathlib import Path
+
+### Submission backend for run_slurm2.py. Ready chunks are handed to a background
+### thread that groups everything queued within 'batch_window' seconds into one
+### SLURM job array: a single generated script plus a manifest with one line of
+### worker arguments per array task. The scan loop never waits for sbatch.
+
+### Submit job to slurm as user "pp" (Running this python script with sudo counts as running it as root, and root cannot submit jobs.)
+SBATCH_CMD = ["sudo", "-u", "pp", "sbatch"]
+SQUEUE_CMD = ["sudo", "-u", "pp", "squeue"]
+SACCT_CMD = ["sudo", "-u", "pp", "sacct"]
+
+### How jobs take GPUs on the pp nodes (--packing):
+###   node   every job takes a whole node (--gres=gpu:4 --exclusive)
+###   chunk  one job-array task per chunk with one GPU per movie, up to a node; no --exclusive
+###   gpu    every chunk is split into single-GPU array tasks, so SLURM can pack
+###          partial chunks and several sessions onto the same node
+PACKINGS = ("node", "chunk", "gpu")
+GPUS_PER_NODE = 4
+
+# Job states in which a job will still run (or is running)
+LIVE_STATES = frozenset(("PENDING", "CONFIGURING", "RUNNING", "COMPLETING", "SUSPENDED", "RESIZING",
+                         "REQUEUED", "REQUEUE_HOLD", "REQUEUE_FED", "SIGNALING", "STAGE_OUT"))
+
+_JOB_ID_RE = re.compile(r"(\d+)")
+
+
+def parse_command(command):
+    """ '--sbatch "python slurm_stub.py sbatch"' style option -> argv list."""
+    return shlex.split(command) if isinstance(command, str) else list(command)
+
+
+def sbatch(job_script, sbatch_cmd=SBATCH_CMD, extra_args=()):
+    """ Submit 'job_script' and return its job id."""
+    result = subprocess.run([*sbatch_cmd, "--parsable", *extra_args, str(job_script)],
+                            check=True, capture_output=True, text=True)
+    match = _JOB_ID_RE.search(result.stdout)
+    if match is None:
+        raise RuntimeError(f"cannot parse job id from sbatch output {result.stdout!r}")
+    return match.group(1)
+
+
+def resource_args(gpus, cpus_per_gpu):
+    """ sbatch options for a job sharing its node: 'gpus' GPUs and cpus_per_gpu CPUs for each."""
+    return [f"--gres=gpu:{gpus}", f"--cpus-per-task={gpus * cpus_per_gpu}"]
+
+
+def _parse_states(output, wanted):
+    # "<job id>|<state>" lines; sacct may append " by <uid>" to CANCELLED
+    states = {}
+    for line in output.splitlines():
+        job_id, _, state = line.strip().partition("|")
+        if job_id in wanted and state.strip():
+            states[job_id] = state.split()[0]
+    return states
+
+
+def job_states(job_ids, squeue_cmd=SQUEUE_CMD, sacct_cmd=SACCT_CMD):
+    """ SLURM state of "<job id>" / "<array job id>_<task>" ids.
+
+    Queued and running jobs come from squeue, finished ones from sacct; jobs
+    neither knows are 'UNKNOWN'. Raises if squeue cannot be run; sacct is
+    optional, as not every cluster keeps accounting.
+    """
+    job_ids = list(job_ids)
+    if not job_ids:
+        return {}
+    wanted = set(job_ids)
+    result = subprocess.run([*squeue_cmd, "--me", "-h", "-r", "-o", "%i|%T"], check=True, capture_output=True, text=True)
+    states = _parse_states(result.stdout, wanted)
+    missing = wanted - set(states)
+    if missing:
+        base_ids = sorted({job_id.split("_")[0] for job_id in missing})
+        try:
+            result = subprocess.run([*sacct_cmd, "-n", "-P", "-X", "-o", "JobID,State", "-j", ",".join(base_ids)],
+                                    check=True, capture_output=True, text=True)
+            states.update(_parse_states(result.stdout, missing))
+        except (subprocess.CalledProcessError, OSError) as e:
+            print(f"sacct failed, finished jobs are reported as UNKNOWN: {e}")
+    return {job_id: states.get(job_id, "UNKNOWN") for job_id in job_ids}
+
+
+def queue_depth(partition, squeue_cmd=SQUEUE_CMD):
+    """ Number of jobs (array tasks counted one by one) pending on 'partition', from any user."""
+    result = subprocess.run([*squeue_cmd, "-h", "-r", "-p", partition, "-t", "PENDING", "-o", "%i"],
+                            check=True, capture_output=True, text=True)
+    return sum(1 for line in result.stdout.splitlines() if line.strip())
+
+
+class ArraySubmitter:
+    """ Background job-array submission.
+
+    submit(task_args, callback, sbatch_args) queues one array task (a list of
+    worker arguments); tasks with different extra sbatch arguments (e.g.
+    --exclude) go into separate arrays. callback(job_id) is called from the
+    submitter thread with "<array job id>_<task index>" once sbatch returned,
+    or None if the submission failed after 'retries' attempts.
+    script_writer(script_path, manifest_path, num_tasks, index) writes the
+    array script.
+    """
+
+    def __init__(self, script_dir, script_writer, sbatch_cmd=SBATCH_CMD, batch_window=2.0,
+                 max_array=1000, retries=3):
+        self.script_dir = Path(script_dir)
+        self.script_writer = script_writer
+        self.sbatch_cmd = parse_command(sbatch_cmd)
+        self.batch_window = batch_window
+        self.max_array = max_array
+        self.retries = retries
+        self.submitted_arrays = 0
+        self.submitted_tasks = 0
+        self._unsent = 0            # tasks queued or collected, sbatch not returned yet
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._index = self._next_index()
+        self._thread = threading.Thread(target=self._run, name="array-submitter", daemon=True)
+        self._thread.start()
+
+    def _next_index(self):
+        # Continue numbering after a watcher restart instead of overwriting manifests
+        indices = [int(p.stem.split("_")[-1]) for p in self.script_dir.glob("slurm_array_*.tasks")
+                   if p.stem.split("_")[-1].isdigit()]
+        return max(indices, default=-1) + 1
+
+    def submit(self, task_args, callback=None, sbatch_args=()):
+        with self._lock:
+            self._unsent += 1
+        self._queue.put((list(task_args), callback, tuple(sbatch_args)))
+
+    def pending(self):
+        return self._unsent
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.max_array:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                entry = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if entry is None:
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                break
+            groups = {}
+            for task_args, callback, sbatch_args in batch:
+                groups.setdefault(sbatch_args, []).append((task_args, callback))
+            for sbatch_args, group in groups.items():
+                self._submit_batch(group, sbatch_args)
+
+    def _submit_batch(self, batch, sbatch_args=()):
+        index = self._index
+        self._index += 1
+        manifest_path = self.script_dir / f"slurm_array_{index}.tasks"
+        script_path = self.script_dir / f"slurm_array_{index}.sh"
+        with open(manifest_path, 'w') as f:
+            for task_args, _callback in batch:
+                f.write(shlex.join(map(str, task_args)) + "\n")
+        self.script_writer(script_path, manifest_path, len(batch), index)
+        os.chmod(script_path, 0o755)
+
+        job_id = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                job_id = sbatch(script_path, self.sbatch_cmd, [f"--array=0-{len(batch) - 1}", *sbatch_args])
+                break
+            except (subprocess.CalledProcessError, RuntimeError, OSError) as e:
+                print(f"sbatch of {script_path.name} failed (attempt {attempt}/{self.retries}): {e}")
+                time.sleep(2 ** attempt)
+        with self._lock:
+            self._unsent -= len(batch)
+            if job_id is not None:
+                self.submitted_tasks += len(batch)
+        if job_id is not None:
+            self.submitted_arrays += 1
+            print(f"Submitted job array {job_id} with {len(batch)} task(s)")
+        for task_index, (_task_args, callback) in enumerate(batch):
+            if callback is not None:
+                callback(None if job_id is None else f"{job_id}_{task_index}")
+
+    def close(self, wait=True):
+        self._queue.put(None)
+        if wait:
+            self._thread.join()
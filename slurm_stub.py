@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+### Stand-in for the SLURM client commands, to run run_slurm2.py without a cluster:
+###
+###   python slurm_stub.py sbatch [--parsable] [--array=0-N] [options] script.sh
+###   python slurm_stub.py squeue [-h] [-r] [-t STATES] [-o "%i|%T"]
+###   python slurm_stub.py sacct [-n] [-P] [-o JobID,State] [-j ids]
+###
+### Jobs are recorded, with their other sbatch options, in $SLURM_STUB_DIR (default /tmp/slurm_stub)/jobs.json.
+### With SLURM_STUB_RUN=1 every (array) task is run locally in the background with
+### SLURM_JOB_ID / SLURM_ARRAY_JOB_ID / SLURM_ARRAY_TASK_ID set, and its exit code is
+### written next to jobs.json, which is what squeue/sacct report (PENDING without
+### SLURM_STUB_RUN, then RUNNING and COMPLETED/FAILED). Use e.g.
+### --sbatch "python slurm_stub.py sbatch" --squeue "python slurm_stub.py squeue".
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import subprocess
+from pathlib import Path
+
+STUB_DIR = Path(os.environ.get("SLURM_STUB_DIR", "/tmp/slurm_stub"))
+
+
+class _Jobs:
+    """ jobs.json under an exclusive lock."""
+
+    def __enter__(self):
+        STUB_DIR.mkdir(parents=True, exist_ok=True)
+        self._lock = open(STUB_DIR / "jobs.lock", 'w')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        path = STUB_DIR / "jobs.json"
+        self.data = json.loads(path.read_text()) if path.exists() else {"next_id": 1000, "jobs": {}}
+        return self.data
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            tmp = STUB_DIR / "jobs.json.tmp"
+            tmp.write_text(json.dumps(self.data))
+            os.replace(tmp, STUB_DIR / "jobs.json")
+        fcntl.flock(self._lock, fcntl.LOCK_UN)
+        self._lock.close()
+
+
+def _parse_array(spec):
+    if not spec:
+        return None
+    spec = spec.split("%")[0]
+    tasks = []
+    for part in spec.split(","):
+        if "-" in part:
+            lo, hi = part.split("-")
+            tasks.extend(range(int(lo), int(hi) + 1))
+        else:
+            tasks.append(int(part))
+    return tasks
+
+
+def _launch(job_id, task_id, script):
+    env = dict(os.environ, SLURM_JOB_ID=str(job_id))
+    name = str(job_id)
+    if task_id is not None:
+        env.update(SLURM_ARRAY_JOB_ID=str(job_id), SLURM_ARRAY_TASK_ID=str(task_id))
+        name = f"{job_id}_{task_id}"
+    log = open(STUB_DIR / f"{name}.out", 'w')
+    exit_file = STUB_DIR / f"{name}.exit"
+    subprocess.Popen(["sh", "-c", 'bash "$0"; echo $? > "$1"', str(script), str(exit_file)],
+                     env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+
+
+def cmd_sbatch(argv):
+    parser = argparse.ArgumentParser(prog="sbatch")
+    parser.add_argument("--parsable", action="store_true")
+    parser.add_argument("--array", type=str, default=None)
+    parser.add_argument("script")
+    args, options = parser.parse_known_args(argv)
+    tasks = _parse_array(args.array)
+    with _Jobs() as jobs:
+        job_id = jobs["next_id"]
+        jobs["next_id"] += 1
+        jobs["jobs"][str(job_id)] = {"script": os.path.abspath(args.script), "tasks": tasks,
+                                     "submit_time": time.time(), "run": os.environ.get("SLURM_STUB_RUN") == "1",
+                                     "options": options}
+    if os.environ.get("SLURM_STUB_RUN") == "1":
+        for task_id in (tasks if tasks is not None else [None]):
+            _launch(job_id, task_id, args.script)
+    print(job_id if args.parsable else f"Submitted batch job {job_id}")
+    return 0
+
+
+def _task_states(jobs):
+    """ (job id, state) of every job or array task in jobs.json."""
+    for job_id, job in sorted(jobs["jobs"].items(), key=lambda item: int(item[0])):
+        for task_id in (job["tasks"] if job["tasks"] is not None else [None]):
+            name = job_id if task_id is None else f"{job_id}_{task_id}"
+            exit_file = STUB_DIR / f"{name}.exit"
+            if not job["run"]:
+                state = "PENDING"
+            elif not exit_file.exists():
+                state = "RUNNING"
+            else:
+                code = exit_file.read_text().strip()
+                state = "COMPLETED" if code == "0" else "FAILED"
+            yield name, state
+
+
+def _format(fmt, job_id, state):
+    return fmt.replace("%i", job_id).replace("%T", state)
+
+
+def cmd_squeue(argv):
+    parser = argparse.ArgumentParser(prog="squeue", add_help=False)
+    parser.add_argument("-h", "--noheader", action="store_true")
+    parser.add_argument("-o", "--format", type=str, default="%i %T")
+    parser.add_argument("-t", "--states", type=str, default="PENDING,RUNNING")
+    args, _unknown = parser.parse_known_args(argv)
+    wanted = set(args.states.upper().split(",")) & {"PENDING", "RUNNING"}
+    with _Jobs() as jobs:
+        states = list(_task_states(jobs))
+    if not args.noheader:
+        print(_format(args.format, "JOBID", "STATE"))
+    for name, state in states:
+        if state in wanted:
+            print(_format(args.format, name, state))
+    return 0
+
+
+def cmd_sacct(argv):
+    parser = argparse.ArgumentParser(prog="sacct")
+    parser.add_argument("-n", "--noheader", action="store_true")
+    parser.add_argument("-P", "--parsable2", action="store_true")
+    parser.add_argument("-o", "--format", type=str, default="JobID,State")
+    parser.add_argument("-j", "--jobs", type=str, default=None)
+    args, _unknown = parser.parse_known_args(argv)
+    fields = [field.lower() for field in args.format.split(",")]
+    wanted = set(args.jobs.split(",")) if args.jobs else None
+    with _Jobs() as jobs:
+        states = list(_task_states(jobs))
+    separator = "|" if args.parsable2 else " "
+    if not args.noheader:
+        print(separator.join(field.capitalize() for field in fields))
+    for name, state in states:
+        if wanted is not None and name.split("_")[0] not in wanted:
+            continue
+        values = {"jobid": name, "state": state}
+        print(separator.join(values.get(field, "") for field in fields))
+    return 0
+
+
+COMMANDS = {"sbatch": cmd_sbatch, "squeue": cmd_squeue, "sacct": cmd_sacct}
+
+
+def main(argv):
+    name = Path(argv[0]).name
+    if name in COMMANDS:
+        return COMMANDS[name](argv[1:])
+    if len(argv) > 1 and argv[1] in COMMANDS:
+        return COMMANDS[argv[1]](argv[2:])
+    print(f"usage: {name} {{{','.join(COMMANDS)}}} ...", file=sys.stderr)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import socket
+from pathlib import Path
+
+### Spool directory used as a task queue between run_slurm2.py and the persistent
+### workers. Every task is one JSON file; a worker claims a task by renaming it
+### into its own claimed/ subdirectory, which is atomic on a shared filesystem,
+### so each task is taken by exactly one worker.
+###
+###   <spool>/new/<prio>-<seq>.json     waiting tasks (prio 0: live lane, 1: backfill, see lanes.py);
+###                                     live tasks are claimed newest first, backfill oldest first
+###   <spool>/claimed/<owner>/          tasks being processed by one worker
+###   <spool>/claimed/<owner>/.lease    touched by the worker while it lives; owners whose
+###                                     lease expired are requeued from any host
+###   <spool>/done/, <spool>/failed/    finished tasks
+###   <spool>/stop                      watcher has finished, workers exit when idle
+
+
+def spool_dirs(spool_dir):
+    spool_dir = Path(spool_dir)
+    return {name: spool_dir / name for name in ("new", "claimed", "done", "failed")}
+
+
+def init_spool(spool_dir):
+    for path in spool_dirs(spool_dir).values():
+        path.mkdir(parents=True, exist_ok=True)
+    stop_file = Path(spool_dir) / "stop"
+    if stop_file.exists():
+        stop_file.unlink()
+
+
+def lane_prefix(lane):
+    return "0-" if lane == "live" else "1-"
+
+
+def push_task(spool_dir, task):
+    """ Queue 'task' (a JSON-serialisable dict). Returns the task file path."""
+    new_dir = spool_dirs(spool_dir)["new"]
+    name = f"{lane_prefix(task.get('lane'))}{time.time_ns():020d}-{os.getpid()}-{Path(task.get('tiff_file', 'task')).stem}.json"
+    tmp_path = new_dir / f".{name}.tmp"
+    task.setdefault("queued_at", time.time())
+    with open(tmp_path, 'w') as f:
+        json.dump(task, f)
+    # Hidden temp file + rename so workers never see a half-written task
+    task_path = new_dir / name
+    os.rename(tmp_path, task_path)
+    return task_path
+
+
+LEASE_NAME = ".lease"
+LEASE_INTERVAL = 30         # seconds between renewals by a live worker
+LEASE_TIMEOUT = 300         # seconds without renewal after which an owner counts as dead
+
+
+def owner_name():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def renew_lease(spool_dir, owner):
+    """ Tell requeue_stale() on any host that 'owner' is still alive."""
+    lease = spool_dirs(spool_dir)["claimed"] / owner / LEASE_NAME
+    lease.parent.mkdir(parents=True, exist_ok=True)
+    lease.touch()
+
+
+def claim_task(spool_dir, owner, accept=None, prefer=None):
+    """ Take the next waiting task: the newest live one, else the oldest backfill one. Returns (claimed_path, task) or None.
+
+    accept(task) can decline tasks, which are then left for other workers.
+    Tasks whose name starts with 'prefer' (see lane_prefix) are tried first.
+    """
+    dirs = spool_dirs(spool_dir)
+    claimed_dir = dirs["claimed"] / owner
+    if not (claimed_dir / LEASE_NAME).exists():
+        renew_lease(spool_dir, owner)
+    with os.scandir(dirs["new"]) as it:
+        names = sorted(entry.name for entry in it if entry.name.endswith(".json") and not entry.name.startswith("."))
+    # The operator needs the stigma of the latest exposures, as in LanePolicy.pick
+    live = lane_prefix("live")
+    names = [name for name in reversed(names) if name.startswith(live)] + [name for name in names if not name.startswith(live)]
+    if prefer is not None:
+        names = [name for name in names if name.startswith(prefer)] + [name for name in names if not name.startswith(prefer)]
+    for name in names:
+        if accept is not None:
+            try:
+                with open(dirs["new"] / name) as f:
+                    if not accept(json.load(f)):
+                        continue
+            except FileNotFoundError:
+                continue
+        claimed_path = claimed_dir / name
+        try:
+            os.rename(dirs["new"] / name, claimed_path)
+        except FileNotFoundError:
+            # Another worker was faster
+            continue
+        with open(claimed_path) as f:
+            return claimed_path, json.load(f)
+    return None
+
+
+def finish_task(claimed_path, ok):
+    claimed_path = Path(claimed_path)
+    dest_dir = spool_dirs(claimed_path.parents[2])["done" if ok else "failed"]
+    os.rename(claimed_path, dest_dir / claimed_path.name)
+
+
+def requeue_stale(spool_dir, lease_timeout=LEASE_TIMEOUT):
+    """ Put back tasks claimed by workers that are no longer running.
+
+    Workers on this host are checked by pid; any other worker counts as dead once
+    its lease (or, without one, its claimed/ directory) is lease_timeout seconds old.
+    """
+    dirs = spool_dirs(spool_dir)
+    host = socket.gethostname()
+    requeued = 0
+    for owner_dir in dirs["claimed"].iterdir():
+        if not owner_dir.is_dir():
+            continue
+        owner_host, _, pid = owner_dir.name.rpartition("-")
+        if owner_host == host and pid.isdigit():
+            if _pid_alive(int(pid)):
+                continue
+        else:
+            try:
+                renewed = max(os.stat(path).st_mtime for path in (owner_dir, owner_dir / LEASE_NAME) if path.exists())
+            except (OSError, ValueError):
+                continue
+            if time.time() - renewed < lease_timeout:
+                continue
+        for task_path in owner_dir.glob("*.json"):
+            try:
+                os.rename(task_path, dirs["new"] / task_path.name)
+            except FileNotFoundError:
+                # Finished meanwhile, or requeued by another worker
+                continue
+            requeued += 1
+    return requeued
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def task_states(spool_dir, names):
+    """ Where each task file name is: 'PENDING' (new), 'RUNNING' (claimed), 'COMPLETED', 'FAILED' or 'UNKNOWN'."""
+    dirs = spool_dirs(spool_dir)
+    places = [("PENDING", dirs["new"]), ("COMPLETED", dirs["done"]), ("FAILED", dirs["failed"])]
+    if dirs["claimed"].exists():
+        places += [("RUNNING", owner_dir) for owner_dir in dirs["claimed"].iterdir() if owner_dir.is_dir()]
+    wanted = set(names)
+    states = {}
+    for state, directory in places:
+        if not directory.exists():
+            continue
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name in wanted:
+                    states[entry.name] = state
+    return {name: states.get(name, "UNKNOWN") for name in names}
+
+
+def pending_count(spool_dir):
+    with os.scandir(spool_dirs(spool_dir)["new"]) as it:
+        return sum(1 for entry in it if entry.name.endswith(".json") and not entry.name.startswith("."))
+
+
+def request_stop(spool_dir):
+    (Path(spool_dir) / "stop").touch()
+
+
+def stop_requested(spool_dir):
+    return (Path(spool_dir) / "stop").exists()
@@ -0,0 +1,121 @@
+import os
+import time
+from pathlib import Path
+
+_UNCHECKED = object()
+
+
+class StabilityTracker:
+    """ Decide when movies have finished being written.
+
+    All pending files are sampled together: each call to poll() stats every
+    pending file once and returns the ones whose size and mtime have not
+    changed for 'wait_time' seconds. Files reported closed by inotify
+    (IN_CLOSE_WRITE) are settled right away without waiting.
+
+    A 'validator' (e.g. tiff_header.is_complete) is a further condition, not a
+    shortcut: a multi-page TIFF is well-formed after every page it gets. It runs
+    once a file is closed or quiet, once per size/mtime; False keeps the file
+    pending until it changes again, True or None (cannot judge) settle it.
+
+    An empty or rejected file that stays unchanged for 'give_up_after' seconds
+    (an aborted or truncated movie) is dropped and reported by take_abandoned().
+    Until then it does not make next_check() ask for short polls.
+    """
+
+    def __init__(self, wait_time=0.5, check_interval=0.1, validator=None, give_up_after=600.0):
+        self.wait_time = wait_time
+        self.check_interval = check_interval
+        self.validator = validator
+        self.give_up_after = give_up_after
+        self._pending = {}      # path -> (size, mtime_ns, first time seen with that size/mtime, verdict or _UNCHECKED)
+        self._closed = set()
+        self._abandoned = []    # (path, reason)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __contains__(self, path):
+        return Path(path) in self._pending
+
+    def add(self, paths):
+        for path in paths:
+            self._pending.setdefault(Path(path), None)
+
+    def discard(self, path):
+        self._pending.pop(Path(path), None)
+
+    def mark_closed(self, names):
+        """ Names (or paths) whose writer has closed the file."""
+        self._closed.update(Path(name).name for name in names)
+
+    def poll(self):
+        """ Sample all pending files once and return those that settled, sorted."""
+        now = time.monotonic()
+        settled = []
+        for path, last in list(self._pending.items()):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            sample = (st.st_size, st.st_mtime_ns)
+            if last is None or last[:2] != sample:
+                last = (*sample, now, _UNCHECKED)
+                self._pending[path] = last
+            closed = path.name in self._closed
+            if not (closed or now - last[2] >= self.wait_time):
+                continue
+            if st.st_size == 0:
+                self._give_up(path, last, now, "empty file")
+                continue
+            if self.validator is not None:
+                # Only validate once per size/mtime, an unchanged incomplete file stays incomplete
+                if last[3] is _UNCHECKED:
+                    last = (*last[:3], self.validator(path))
+                    self._pending[path] = last
+                if last[3] is False:
+                    self._give_up(path, last, now, "incomplete movie structure")
+                    continue
+            self._closed.discard(path.name)
+            settled.append(path)
+        for path in settled:
+            del self._pending[path]
+        return sorted(settled)
+
+    def _give_up(self, path, last, now, reason):
+        if now - last[2] >= self.give_up_after:
+            del self._pending[path]
+            self._closed.discard(path.name)
+            self._abandoned.append((path, reason))
+
+    def _parked(self, last, now):
+        # Quiet and empty or rejected: nothing changes until the file does
+        return (last is not None and now - last[2] >= self.wait_time
+                and (last[0] == 0 or (self.validator is not None and last[3] is False)))
+
+    def take_abandoned(self):
+        """ [(path, reason)] of the files given up on since the last call."""
+        abandoned, self._abandoned = self._abandoned, []
+        return abandoned
+
+    def next_check(self, default):
+        """ Seconds the caller may block before poll() can report anything new."""
+        now = time.monotonic()
+        if all(self._parked(last, now) for last in self._pending.values()):
+            return default
+        return min(default, self.check_interval)
+
+    def wait(self, paths, timeout=None):
+        """ Block until all 'paths' have settled. Returns False on timeout."""
+        remaining = {Path(path) for path in paths}
+        self.add(remaining)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining.difference_update(self.poll())
+            remaining.intersection_update(self._pending)
+            if not remaining:
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.check_interval)
@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import math
+import argparse
+from pathlib import Path
+from typing import NamedTuple
+
+from ctffind_results import load_ctffind5_results
+
+### Objective stigmator correction from ctffind5 astigmatism.
+###
+### Each microscope has a calibration profile: step (A of astigmatism per
+### stigmator unit) and direction of the X and Y stigmators, plus how the two
+### computed corrections map onto the microscope's X/Y controls (swap, sign).
+### stigma_correction() handles one micrograph with math; stigma_corrections()
+### takes NumPy arrays for a whole session. The command line rebuilds stigma_dir
+### from existing ctffind5 results, e.g. after a calibration change:
+###
+###   python stigma.py --ctffind5_dir <out>/ctffind5 --stigma_dir <session>/stigma --scope 1
+###
+### Every worker variant takes its profiles from WORKER_CALIBRATION; --worker picks
+### the variant whose conventions a rebuilt session keeps.
+
+
+class StigmaCalibration(NamedTuple):
+    x_step: float
+    y_step: float
+    x_angle: float
+    y_angle: float
+    swap_xy: bool = False   # X control gets the Y correction and vice versa
+    sign: float = -1.0      # applied after (objective stigma + correction)
+
+
+# Constants from the original Perl script
+SCOPE_CALIBRATION = {
+    1: StigmaCalibration(x_step=38.01, y_step=36.81, x_angle=-68.67, y_angle=-23.61, swap_xy=True, sign=-1.0),
+    2: StigmaCalibration(x_step=37.01, y_step=35.58, x_angle=63.98, y_angle=19.06, swap_xy=True, sign=-1.0),
+    3: StigmaCalibration(x_step=37.01, y_step=35.58, x_angle=-19.06, y_angle=-63.98, swap_xy=False, sign=1.0),
+}
+
+# Profiles of each worker variant, so a session keeps the conventions it was processed with:
+#   with3                  process_tiff_files_long_stigma_corrected_with3.py (SCOPE_CALIBRATION)
+#   long_stigma_corrected  process_tiff_files_long_stigma_corrected.py, never calibrated for scope 3
+#   sc                     process_tiff_files_sc.py, scope 3 swapped and negated like scopes 1 and 2
+#   long                   process_tiff_files.py and process_tiff_files_long.py: scope 1 and 2
+#                          constants the other way round, no sign flip, only scope 1 swapped
+WORKER_CALIBRATION = {
+    "with3": SCOPE_CALIBRATION,
+    "long_stigma_corrected": {scope: SCOPE_CALIBRATION[scope] for scope in (1, 2)},
+    "sc": {**SCOPE_CALIBRATION,
+           3: StigmaCalibration(x_step=37.01, y_step=35.58, x_angle=-19.06, y_angle=-63.98, swap_xy=True, sign=-1.0)},
+    "long": {
+        1: StigmaCalibration(x_step=37.01, y_step=35.58, x_angle=19.06, y_angle=63.98, swap_xy=True, sign=1.0),
+        2: StigmaCalibration(x_step=38.01, y_step=36.81, x_angle=-68.67, y_angle=-23.61, swap_xy=False, sign=1.0),
+    },
+}
+
+
+def load_calibration(path, base=SCOPE_CALIBRATION):
+    """ {"1": {"x_step": ..., ...}, ...} JSON file -> profiles, on top of 'base'."""
+    profiles = dict(base)
+    with open(path) as f:
+        for scope, values in json.load(f).items():
+            profiles[int(scope)] = StigmaCalibration(**values)
+    return profiles
+
+
+def _axis_correction(xp, defocus_u, defocus_v, stigma_angle, axis_angle, step):
+    # xp is math for scalars or numpy for arrays
+    angle_diff = axis_angle - stigma_angle
+    k1 = xp.sin(xp.radians(angle_diff)) / xp.cos(xp.radians(angle_diff))
+    angle_diff = angle_diff + 90
+    k2 = xp.sin(xp.radians(angle_diff)) / xp.cos(xp.radians(angle_diff))
+
+    sub1 = xp.sqrt((k1 * k1 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * k1 * k1))
+    sub2 = xp.sqrt((k2 * k2 + 1) / (defocus_v * defocus_v + defocus_u * defocus_u * k2 * k2))
+    return 0.0001 * defocus_u * defocus_v * (sub1 - sub2) / step
+
+
+def _apply_profile(lx, ly, calibration, obj_stigma_x, obj_stigma_y):
+    new_x = calibration.sign * (obj_stigma_x + lx)
+    new_y = calibration.sign * (obj_stigma_y + ly)
+    if calibration.swap_xy:
+        return new_y, new_x
+    return new_x, new_y
+
+
+def stigma_correction(defocus_u, defocus_v, stigma_angle, calibration, obj_stigma_x=0, obj_stigma_y=0):
+    """ (stigma x, stigma y) for one micrograph."""
+    lx = _axis_correction(math, defocus_u, defocus_v, stigma_angle, calibration.x_angle, calibration.x_step)
+    ly = _axis_correction(math, defocus_u, defocus_v, stigma_angle, calibration.y_angle, calibration.y_step)
+    return _apply_profile(lx, ly, calibration, obj_stigma_x, obj_stigma_y)
+
+
+def stigma_corrections(defocus_u, defocus_v, stigma_angle, calibration, obj_stigma_x=0, obj_stigma_y=0):
+    """ Arrays of (stigma x, stigma y) for arrays of defocus U/V and astigmatism angle."""
+    import numpy as np
+    defocus_u = np.asarray(defocus_u, dtype=np.float64)
+    defocus_v = np.asarray(defocus_v, dtype=np.float64)
+    stigma_angle = np.asarray(stigma_angle, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lx = _axis_correction(np, defocus_u, defocus_v, stigma_angle, calibration.x_angle, calibration.x_step)
+        ly = _axis_correction(np, defocus_u, defocus_v, stigma_angle, calibration.y_angle, calibration.y_step)
+    return _apply_profile(lx, ly, calibration, obj_stigma_x, obj_stigma_y)
+
+
+def movie_number(stem, scope):
+    """ Movie number used in stigma file names, from the movie/micrograph name without extension."""
+    return stem[-10:-4] if scope == 3 else stem[-4:]
+
+
+def stigma_filename(number, stigma_x, stigma_y, avg_defocus, delta_defocus, stigma_angle, ctf_res):
+    return (f"{number}_X{stigma_x:+.5f}_Y{stigma_y:+.5f}_{avg_defocus:.1f}_{delta_defocus:.1f}_"
+            f"{stigma_angle:.1f}_{ctf_res:.2f}.txt")
+
+
+def write_stigma_file(stigma_dir, number, stigma_x, stigma_y, avg_defocus, delta_defocus, stigma_angle, ctf_res):
+    stigma_file = Path(stigma_dir) / stigma_filename(number, stigma_x, stigma_y, avg_defocus, delta_defocus,
+                                                     stigma_angle, ctf_res)
+    with open(stigma_file, 'w') as file:
+        file.write("# Columns: #1 - new stigma x; #2 - new stigma y\n")
+        file.write(f"{stigma_x:+.5f} {stigma_y:+.5f}\n")
+    return stigma_file
+
+
+def rebuild_stigma_dir(ctffind5_dir, stigma_dir, scope, calibration):
+    """ Recompute every stigma file from the ctffind5 results. Returns the number written."""
+    with os.scandir(ctffind5_dir) as it:
+        txt_files = sorted(entry.path for entry in it
+                           if entry.name.endswith(".txt") and not entry.name.endswith("_avrot.txt"))
+    results = load_ctffind5_results(txt_files)
+    if len(results) == 0:
+        return 0
+    stigma_x, stigma_y = stigma_corrections(results["defocus_1"], results["defocus_2"], results["astig_azimuth"],
+                                            calibration)
+    avg_defocus = (results["defocus_1"] + results["defocus_2"]) / 2
+    delta_defocus = results["defocus_1"] - results["defocus_2"]
+
+    # Stigma files carry the values in their name; old files of the recomputed movies are replaced
+    stigma_dir = Path(stigma_dir)
+    stigma_dir.mkdir(parents=True, exist_ok=True)
+    old_files = {}
+    with os.scandir(stigma_dir) as it:
+        for entry in it:
+            if "_X" in entry.name and entry.name.endswith(".txt"):
+                old_files.setdefault(entry.name.split("_X")[0], []).append(entry.path)
+    for i, name in enumerate(results["name"]):
+        number = movie_number(name, scope)
+        stigma_file = write_stigma_file(stigma_dir, number, stigma_x[i], stigma_y[i], avg_defocus[i], delta_defocus[i],
+                                        results["astig_azimuth"][i], results["ctf_fit_resolution"][i])
+        for old_file in old_files.pop(number, []):
+            if old_file != str(stigma_file):
+                os.unlink(old_file)
+    return len(results)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Rebuild stigma files from existing ctffind5 results")
+    parser.add_argument("--ctffind5_dir", type=str, required=True, help="ctffind5 output directory of the session")
+    parser.add_argument("--stigma_dir", type=str, required=True, help="Stigma directory to rebuild")
+    parser.add_argument("-sc", "--scope", type=int, required=True, help="BioEM facility microscope number")
+    parser.add_argument("--worker", type=str, choices=sorted(WORKER_CALIBRATION), default="with3",
+                        help="Worker variant that processed the session, whose calibration conventions apply")
+    parser.add_argument("--calibration", type=str, default=None, help="JSON file with per-scope calibration profiles")
+    args = parser.parse_args(argv)
+    profiles = WORKER_CALIBRATION[args.worker]
+    if args.calibration:
+        profiles = load_calibration(args.calibration, profiles)
+    if args.scope not in profiles:
+        parser.error(f"worker variant {args.worker} has no calibration for scope {args.scope}")
+    written = rebuild_stigma_dir(args.ctffind5_dir, args.stigma_dir, args.scope, profiles[args.scope])
+    print(f"Wrote {written} stigma file(s) to {args.stigma_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
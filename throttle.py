@@ -0,0 +1,57 @@
+import math
+import time
+
+### Backpressure for submissions: how much work may be handed to the executor.
+###
+### Movies handed over are locked into their job (chunk, order, lane); movies kept
+### in the session's ready queue can still be re-batched and reordered. So only
+### enough is handed over to keep the GPUs busy:
+###
+###   capacity = GPUs + observed throughput (movies/s) * lookahead
+###
+### i.e. one movie running per GPU plus 'lookahead' seconds of queued work to
+### cover the dispatch delay. Nothing is handed over while the executor's queue
+### (pending jobs on the partition, or waiting spool tasks) is at max_queued.
+
+
+class SubmissionThrottle:
+    def __init__(self, num_gpus, lookahead=60.0, max_queued=8, window=600.0):
+        self.num_gpus = max(1, num_gpus)
+        self.lookahead = lookahead
+        self.max_queued = max_queued
+        self.window = window
+        self._done = []         # finish times (epoch) within 'window'
+
+    def observe_done(self, finished_at=None):
+        # Finish times come from the ledger, so movies that finished while the watcher was down count where they belong
+        self._done.append(time.time() if finished_at is None else finished_at)
+
+    def throughput(self, now=None):
+        """ Finished movies per second over the last 'window' seconds, None until a few finished."""
+        now = time.time() if now is None else now
+        self._done = [t for t in self._done if now - t <= self.window]
+        if len(self._done) < 3:
+            return None
+        # At least a minute, so a burst of finishes does not read as a huge rate
+        return len(self._done) / max(now - min(self._done), 60.0)
+
+    def capacity(self, now=None):
+        """ Movies that may be in flight; twice the GPUs until the throughput is known."""
+        throughput = self.throughput(now)
+        if throughput is None:
+            return 2 * self.num_gpus
+        return self.num_gpus + max(1, math.ceil(throughput * self.lookahead))
+
+    def room(self, in_flight, queued, now=None):
+        """ Movies that may go out now with 'in_flight' movies and 'queued' jobs waiting, 0 while held back.
+
+        A chunk is cut down to this, the rest stays in the ready queue for the next places.
+        """
+        if queued >= self.max_queued:
+            return 0
+        return max(0, self.capacity(now) - in_flight)
+
+    def __str__(self):
+        throughput = self.throughput()
+        rate = f"{throughput * 3600:.0f} movies/h" if throughput is not None else "throughput not known yet"
+        return f"up to {self.capacity()} movie(s) in flight, {self.max_queued} queued job(s) ({rate})"
@@ -0,0 +1,229 @@
+import os
+import struct
+
+### Minimal TIFF / BigTIFF reader: walks the IFD chain without decoding any tags
+### it does not need. EER movies are BigTIFF/TIFF files with one IFD per frame.
+
+_CLASSIC = 42
+_BIG = 43
+
+_frame_count_cache = {}     # (path, size, mtime_ns) -> frame count
+
+### Tags whose values locate the image data
+STRIP_OFFSETS = 273
+STRIP_BYTE_COUNTS = 279
+TILE_OFFSETS = 324
+TILE_BYTE_COUNTS = 325
+
+### Tags describing a plain (single) image, used to read gain references
+IMAGE_WIDTH = 256
+IMAGE_LENGTH = 257
+BITS_PER_SAMPLE = 258
+COMPRESSION = 259
+SAMPLES_PER_PIXEL = 277
+SAMPLE_FORMAT = 339
+
+### TIFF field type -> struct code for the integer types used by offsets / byte counts
+_INT_TYPES = {1: "B", 3: "H", 4: "I", 16: "Q"}
+
+
+class TiffHeaderError(ValueError):
+    pass
+
+
+class TiffTruncatedError(TiffHeaderError):
+    pass
+
+
+class _TiffReader:
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+        head = os.pread(fd, 16, 0)
+        if len(head) < 8:
+            raise TiffTruncatedError("file too short for a TIFF header")
+        if head[:2] == b"II":
+            self.bo = "<"
+        elif head[:2] == b"MM":
+            self.bo = ">"
+        else:
+            raise TiffHeaderError("not a TIFF file")
+        version = struct.unpack(self.bo + "H", head[2:4])[0]
+        if version == _CLASSIC:
+            self.big = False
+            self.first_ifd = struct.unpack(self.bo + "I", head[4:8])[0]
+        elif version == _BIG:
+            if len(head) < 16:
+                raise TiffTruncatedError("file too short for a BigTIFF header")
+            self.big = True
+            self.first_ifd = struct.unpack(self.bo + "Q", head[8:16])[0]
+        else:
+            raise TiffHeaderError(f"unknown TIFF version {version}")
+        self.count_fmt = self.bo + ("Q" if self.big else "H")
+        self.offset_fmt = self.bo + ("Q" if self.big else "I")
+        self.count_size = 8 if self.big else 2
+        self.entry_size = 20 if self.big else 12
+        self.offset_size = 8 if self.big else 4
+
+    def read(self, offset, length):
+        data = os.pread(self.fd, length, offset)
+        if len(data) < length:
+            raise TiffTruncatedError(f"truncated read at offset {offset}")
+        return data
+
+    def ifd_offsets(self):
+        """ Yield the offset of every IFD in the chain. Stops at the first offset past EOF."""
+        offset = self.first_ifd
+        visited = set()
+        while offset:
+            if offset in visited:
+                raise TiffHeaderError(f"IFD loop at offset {offset}")
+            if offset + self.count_size > self.size:
+                raise TiffTruncatedError(f"IFD offset {offset} beyond end of file")
+            visited.add(offset)
+            yield offset
+            n = struct.unpack(self.count_fmt, self.read(offset, self.count_size))[0]
+            next_pos = offset + self.count_size + n * self.entry_size
+            offset = struct.unpack(self.offset_fmt, self.read(next_pos, self.offset_size))[0]
+
+    def read_tags(self, offset, wanted):
+        """ Integer values of the 'wanted' tags in the IFD at 'offset', and the next IFD offset."""
+        n = struct.unpack(self.count_fmt, self.read(offset, self.count_size))[0]
+        raw = self.read(offset + self.count_size, n * self.entry_size + self.offset_size)
+        entry_fmt = self.bo + ("HHQ" if self.big else "HHI")
+        head_size = struct.calcsize(entry_fmt)
+        inline_size = self.offset_size
+        tags = {}
+        for i in range(n):
+            pos = i * self.entry_size
+            tag, typ, count = struct.unpack_from(entry_fmt, raw, pos)
+            if tag not in wanted:
+                continue
+            code = _INT_TYPES.get(typ)
+            if code is None:
+                raise TiffHeaderError(f"tag {tag} has non-integer type {typ}")
+            fmt = f"{self.bo}{count}{code}"
+            nbytes = struct.calcsize(fmt)
+            if nbytes <= inline_size:
+                data = raw[pos + head_size:pos + head_size + nbytes]
+            else:
+                value_offset = struct.unpack_from(self.offset_fmt, raw, pos + head_size)[0]
+                if value_offset + nbytes > self.size:
+                    raise TiffTruncatedError(f"tag {tag} values beyond end of file")
+                data = self.read(value_offset, nbytes)
+            tags[tag] = struct.unpack(fmt, data)
+        next_offset = struct.unpack_from(self.offset_fmt, raw, n * self.entry_size)[0]
+        return tags, next_offset
+
+
+def _open(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        return fd, size, _TiffReader(fd, size)
+    except Exception:
+        os.close(fd)
+        raise
+
+
+def read_image_layout(path):
+    """ Geometry and strip/tile locations of the first image in a TIFF file, read from the header only."""
+    fd, _size, reader = _open(path)
+    try:
+        wanted = (IMAGE_WIDTH, IMAGE_LENGTH, BITS_PER_SAMPLE, COMPRESSION, SAMPLES_PER_PIXEL, SAMPLE_FORMAT,
+                  STRIP_OFFSETS, STRIP_BYTE_COUNTS, TILE_OFFSETS, TILE_BYTE_COUNTS)
+        tags, _next = reader.read_tags(reader.first_ifd, wanted)
+    finally:
+        os.close(fd)
+    if STRIP_OFFSETS not in tags:
+        raise TiffHeaderError("only strip-organised TIFF images are supported")
+    return {"byteorder": reader.bo, "width": tags[IMAGE_WIDTH][0], "height": tags[IMAGE_LENGTH][0],
+            "bits": tags.get(BITS_PER_SAMPLE, (1,))[0], "compression": tags.get(COMPRESSION, (1,))[0],
+            "samples": tags.get(SAMPLES_PER_PIXEL, (1,))[0], "sample_format": tags.get(SAMPLE_FORMAT, (1,))[0],
+            "strip_offsets": tags[STRIP_OFFSETS], "strip_byte_counts": tags[STRIP_BYTE_COUNTS]}
+
+
+def count_frames(path):
+    """ Number of IFDs (frames) in a TIFF/EER movie, read from the headers only.
+
+    Returns 0 when the header cannot be read, e.g. the file is still being written or is gone.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        # Deleted or renamed since it settled
+        return 0
+    key = (str(path), st.st_size, st.st_mtime_ns)
+    cached = _frame_count_cache.get(key)
+    if cached is not None:
+        return cached
+    try:
+        fd, _size, reader = _open(path)
+    except (OSError, TiffHeaderError):
+        return 0
+    count = 0
+    try:
+        for _ in reader.ifd_offsets():
+            count += 1
+    except TiffHeaderError:
+        # Chain runs past EOF: the file is incomplete, don't cache a partial count
+        return 0
+    finally:
+        os.close(fd)
+    if count:
+        _frame_count_cache[key] = count
+    return count
+
+
+def get_frame_counts(paths):
+    """ Frame count for every movie in 'paths', in the same order."""
+    return [count_frames(path) for path in paths]
+
+
+def is_complete(path):
+    """ Check that every strip/tile of every frame lies inside the file.
+
+    Returns True when the IFD chain ends cleanly and all image data is present,
+    False when the file is truncated (still being written), and None when the
+    file is not a TIFF we can judge, so callers should fall back to waiting.
+    """
+    try:
+        fd, size, reader = _open(path)
+    except TiffTruncatedError:
+        return False
+    except TiffHeaderError:
+        return None
+    except OSError:
+        return False
+    wanted = (STRIP_OFFSETS, STRIP_BYTE_COUNTS, TILE_OFFSETS, TILE_BYTE_COUNTS)
+    frames = 0
+    try:
+        offset = reader.first_ifd
+        visited = set()
+        while offset:
+            if offset in visited:
+                return None
+            if offset + reader.count_size > size:
+                return False
+            visited.add(offset)
+            tags, offset = reader.read_tags(offset, wanted)
+            if STRIP_OFFSETS in tags:
+                offsets, counts = tags[STRIP_OFFSETS], tags.get(STRIP_BYTE_COUNTS)
+            elif TILE_OFFSETS in tags:
+                offsets, counts = tags[TILE_OFFSETS], tags.get(TILE_BYTE_COUNTS)
+            else:
+                return None
+            if counts is None or len(counts) != len(offsets):
+                return None
+            for data_offset, nbytes in zip(offsets, counts):
+                if data_offset + nbytes > size:
+                    return False
+            frames += 1
+    except TiffTruncatedError:
+        # IFD or tag block cut off by EOF
+        return False
+    except TiffHeaderError:
+        return None
+    finally:
+        os.close(fd)
+    return frames > 0